@@ -4,6 +4,7 @@ import json
 import yaml
 import argparse
 import threading
+import multiprocessing
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
@@ -11,12 +12,21 @@ from fastapi.middleware.cors import CORSMiddleware
 from util.ConfigLoader import ConfigLoader
 from util.Loggers import print_centered
 from loader.HFLoader import load_model
+from loader.ModelRegistry import ModelRegistry
 from communicator.LLMCommunicator import LLMCommunicator
+from communicator.ModelPool import ModelPool
+from communicator.WorkerPool import WorkerPool
+from communicator.ServerReadiness import ServerReadiness
 from chatbot.Chatbot import Chatbot
 from gui.GUI import start_gradio
 
 from routes.route_hi import router as route_hi_router
+from routes.route_ready import router as route_ready_router
+from routes.route_pull import router as route_pull_router
+from routes.route_models import router as route_models_router
 from routes.route_completions import router as route_completions_router
+from routes.route_cache import router as route_cache_router
+from routes.route_metrics import router as route_metrics_router
 
 main_lock = threading.Lock()
 
@@ -26,7 +36,8 @@ main_lock = threading.Lock()
 # pip install gunicorn
 # ENV=test gunicorn --worker-class gthread --threads 4 --bind 127.0.0.1:8000 'app:start_server()'
 # NOTE: 
-# - avoid using Multi-Process worker in order to prevent multiple LLM instances.
+# - avoid using Multi-Process worker in order to prevent multiple LLM instances, set `workers.processes` instead
+#   to run inference in a supervised pool of processes sharing the memory-mapped model weights.
 # - in an environment doesn't allow binding external external-accessible ports (e.g. Paperspace), bind "127.0.0.1" instead of "0.0.0.0"
 def start_server():
     global main_lock
@@ -38,15 +49,50 @@ def start_server():
     print(f"=== ===  === ===  === ===\t\t CONFIGURATIONS \t\t=== ===  === ===  === ===")
     print(formatted_json)
 
-    # initiate LLM
-    LLMCommunicator.get()
+    # index the model files in the background, new and changed files are hashed
+    ModelRegistry.get().scan_async()
+
+    # inference runs in worker processes, this process only parses requests and streams responses
+    use_workers = config.get('workers', {}).get('processes', 0) > 0
+    if use_workers:
+        LLMCommunicator.set_pool(ModelPool(WorkerPool.get().communicator))
+
+    # initiate LLM in the background, the server answers `/hi` and `/ready` meanwhile
+    def load():
+        llm = LLMCommunicator.get()
+        if use_workers:
+            ServerReadiness.get().report(config['model'], ServerReadiness.LOADING)
+            pool = WorkerPool.get()
+            ready_timeout = config.get('workers', {}).get('ready_timeout', 600)
+            # the server is reported as failed with this error
+            if not pool.wait_ready(timeout=ready_timeout):
+                if pool.failed():
+                    raise RuntimeError(f"no inference worker could load the model: {pool.start_error()}")
+                raise RuntimeError(f"no inference worker was ready after {ready_timeout}s: {pool.start_error() or 'still loading'}")
+        LLMCommunicator.pool().preload()
+        return llm
+
+    def release_main_lock():
+        # the CLI Chatbot and the GUI start once the model is loaded
+        if main_lock.locked():
+            main_lock.release()
+
+    ServerReadiness.get().start(load, on_done=release_main_lock)
 
     # start the server
     print(f"=== ===  === ===  === ===\t\t SERVER STARTED \t\t=== ===  === ===  === ===")
 
     app = FastAPI()
     app.include_router(route_hi_router, prefix=config['url_prefix'])
+    app.include_router(route_ready_router, prefix=config['url_prefix'])
+    app.include_router(route_pull_router, prefix=config['url_prefix'])
+    app.include_router(route_models_router, prefix=config['url_prefix'])
     app.include_router(route_completions_router, prefix=config['url_prefix'])
+    app.include_router(route_cache_router, prefix=config['url_prefix'])
+
+    # scrapers expect `/metrics` at the root
+    if config.get('metrics', {}).get('enabled', True):
+        app.include_router(route_metrics_router)
 
     if config['allow_cors']:
         app.add_middleware(
@@ -56,9 +102,6 @@ def start_server():
             allow_methods=["*"],  # Allow all methods
             allow_headers=["*"],  # Allow all headers
         )
-    
-    if main_lock.locked():
-        main_lock.release()
 
     return app
 
@@ -74,6 +117,8 @@ def start_uvicorn():
         
 # local test server
 if __name__ == '__main__':
+    # the worker processes of the PyInstaller executable start here instead of running the app again
+    multiprocessing.freeze_support()
     print('initializing...')
     parser = argparse.ArgumentParser(description='Process model parameter.')
     parser.add_argument('--model', required=False, help='Model name to load configuration for')
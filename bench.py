@@ -0,0 +1,176 @@
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import urllib.request
+
+from util.ConfigLoader import ConfigLoader
+from benchmark.Workloads import load_workloads, BUILTIN_WORKLOADS
+from benchmark.LoadGenerator import LoadGenerator, HttpTarget, DirectTarget
+from benchmark.Report import summarize, compare
+
+
+# examples:
+# python bench.py --fake 1 --target direct
+# python bench.py --fake 1 --target http --serve 1 --concurrency 1,4,8 --output bench.json
+# python bench.py --target http --url http://127.0.0.1:8000/v1 --workloads short_qa,multi_turn --baseline bench.json
+# NOTE:
+# - with `--fake 1` no model is loaded and llama-cpp-python is not needed, the deterministic fake backend measures the overhead of the server itself.
+# - the report goes to stdout (or `--output`); with `--baseline`, regressions beyond `--max_regression` exit with 1.
+
+
+def start_local_server(config):
+    import uvicorn
+    from app import start_server
+
+    # a free port of the loopback interface
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    server = uvicorn.Server(uvicorn.Config(start_server(), host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True, name='bench-server')
+    thread.start()
+
+    base_url = f"http://127.0.0.1:{port}{config['url_prefix']}"
+    deadline = time.monotonic() + 600
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"{base_url}/ready", timeout=5) as response:
+                if response.status == 200:
+                    return server, base_url
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("the local server did not become ready")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the completion API.')
+    parser.add_argument('--model', required=False, help='Model name to load configuration for')
+    parser.add_argument('--target', required=False, default='direct', choices=['direct', 'http'], help='Call LLMCommunicator in this process, or the HTTP API')
+    parser.add_argument('--url', required=False, help='Base URL of a running server, e.g. http://127.0.0.1:8000/v1')
+    parser.add_argument('--serve', required=False, type=int, default=0, help='Start a server in this process for the http target')
+    parser.add_argument('--workloads', required=False, default=','.join(BUILTIN_WORKLOADS), help='Comma separated built-in workloads')
+    parser.add_argument('--workload_file', required=False, help='JSON file with further workloads')
+    parser.add_argument('--requests', required=False, type=int, default=16, help='Requests per workload')
+    parser.add_argument('--max_tokens', required=False, type=int, default=64, help='Completion tokens per request')
+    parser.add_argument('--context_words', required=False, type=int, default=1500, help='Words of the document of the long_context workload')
+    parser.add_argument('--turns', required=False, type=int, default=4, help='Turns of a multi_turn session')
+    parser.add_argument('--concurrency', required=False, default='1,4', help='Comma separated concurrency levels')
+    parser.add_argument('--stream', required=False, default='both', choices=['both', 'stream', 'full'], help='Stream the completions or not')
+    parser.add_argument('--warmup', required=False, type=int, default=1, help='Requests sent before measuring')
+    parser.add_argument('--n_threads', required=False, type=int, help='Override n_threads of the model')
+    parser.add_argument('--n_batch', required=False, type=int, help='Override n_batch of the model')
+    parser.add_argument('--n_ctx', required=False, type=int, help='Override n_ctx of the model')
+    parser.add_argument('--fake', required=False, type=int, default=0, help='Use the deterministic fake backend instead of the model')
+    parser.add_argument('--fake_token_ms', required=False, type=float, default=0.0, help='Decode latency per token of the fake backend')
+    parser.add_argument('--fake_prompt_token_ms', required=False, type=float, default=0.0, help='Prompt evaluation latency per token of the fake backend')
+    parser.add_argument('--output', required=False, help='Write the report to this file instead of stdout')
+    parser.add_argument('--baseline', required=False, help='Report of an earlier run to compare with')
+    parser.add_argument('--max_regression', required=False, type=float, default=0.2, help='Tolerated slowdown against the baseline, 0.2 = 20%%')
+    args = parser.parse_args()
+
+    config = ConfigLoader().load_config(args.model).get()
+    if args.model is not None:
+        config['model'] = args.model
+    config = ConfigLoader().load_config(config['model'], path='./llm_config/').get()
+    config['debug_mode'] = False
+
+    model_config = config['model_config']
+    if args.n_threads is not None:
+        model_config['n_threads'] = args.n_threads
+    if args.n_batch is not None:
+        model_config['n_batch'] = args.n_batch
+    if args.n_ctx is not None:
+        model_config['n_ctx'] = args.n_ctx
+    if args.fake:
+        model_config['backend'] = 'fake'
+        model_config['backend_options'] = {
+            'token_latency_ms': args.fake_token_ms,
+            'prompt_token_latency_ms': args.fake_prompt_token_ms,
+        }
+    # explicit settings are measured as they are, not replaced by a tuned profile
+    if args.n_threads is not None or args.n_batch is not None:
+        config.setdefault('autotune', {})['enabled'] = False
+    # the report should not depend on what earlier runs left in the caches
+    config.setdefault('response_cache', {})['enabled'] = False
+
+    workloads = load_workloads(
+        [name for name in args.workloads.split(',') if name],
+        requests=args.requests,
+        max_tokens=args.max_tokens,
+        context_words=args.context_words,
+        turns=args.turns,
+        path=args.workload_file
+    )
+    concurrency_levels = [int(level) for level in args.concurrency.split(',') if level]
+    stream_modes = {'both': [False, True], 'stream': [True], 'full': [False]}[args.stream]
+
+    server = None
+    if args.target == 'http':
+        if args.serve:
+            server, base_url = start_local_server(config)
+        elif args.url:
+            base_url = args.url
+        else:
+            base_url = f"http://{config['host']}:{config['port']}{config['url_prefix']}"
+        target = HttpTarget(base_url, model=args.model)
+    else:
+        from communicator.LLMCommunicator import LLMCommunicator
+        target = DirectTarget(LLMCommunicator.get())
+
+    report = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'target': target.name,
+        'model': config['model'],
+        'backend': model_config.get('backend', 'llama_cpp'),
+        'settings': {
+            'n_threads': model_config['n_threads'],
+            'n_batch': model_config['n_batch'],
+            'n_ctx': model_config['n_ctx'],
+            'batching': config.get('batching', {}).get('enabled', False),
+            'backend_options': model_config.get('backend_options'),
+        },
+        'runs': [],
+    }
+
+    try:
+        for workload in workloads:
+            for stream in stream_modes:
+                for concurrency in concurrency_levels:
+                    generator = LoadGenerator(target, concurrency=concurrency)
+                    if args.warmup:
+                        warmup = load_workloads(['short_qa'], requests=args.warmup, max_tokens=8)[0]
+                        LoadGenerator(target, concurrency=1).run(warmup, stream)
+
+                    results, duration = generator.run(workload, stream)
+                    run = summarize(results, duration, concurrency)
+                    report['runs'].append(run)
+                    print(f"{workload.name} {'stream' if stream else 'full'} c{concurrency}: {run['requests']} requests, {run['errors']} errors, "
+                          f"p50 {run['latency']['p50'] if run['latency'] else float('nan'):.3f}s, "
+                          f"{run['throughput_tokens_per_second'] or 0:.1f} tokens/s", file=sys.stderr)
+    finally:
+        if server is not None:
+            server.should_exit = True
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            report['regressions'] = compare(report, json.load(file), max_regression=args.max_regression)
+        exit_code = 1 if report['regressions'] else 0
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(output)
+    else:
+        print(output)
+
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
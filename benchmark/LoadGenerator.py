@@ -0,0 +1,160 @@
+import json
+import time
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RequestResult:
+    """
+    Timings of one completion, in seconds since the request was sent.
+    """
+    def __init__(self, workload, stream):
+        self.workload = workload
+        self.stream = stream
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.finished = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.text = ''
+        self.error = None
+
+    def token(self, text):
+        if text and self.first_token is None:
+            self.first_token = time.perf_counter()
+        self.text += text
+
+    def finish(self, usage=None):
+        self.finished = time.perf_counter()
+        if usage:
+            self.prompt_tokens = usage.get('prompt_tokens', 0)
+            self.completion_tokens = usage.get('completion_tokens', 0)
+
+    @property
+    def latency(self):
+        return self.finished - self.started
+
+    @property
+    def ttft(self):
+        # without streaming the first token arrives with the last one
+        return (self.first_token if self.first_token is not None else self.finished) - self.started
+
+    @property
+    def tpot(self):
+        if self.completion_tokens < 2 or self.first_token is None:
+            return None
+        return (self.finished - self.first_token) / (self.completion_tokens - 1)
+
+
+class HttpTarget:
+    """
+    Sends completions to `/chat/completions` of a running server.
+    """
+    name = 'http'
+
+    def __init__(self, base_url, model=None, timeout=600):
+        self.url = base_url.rstrip('/') + '/chat/completions'
+        self.model = model
+        self.timeout = timeout
+
+    def complete(self, messages, max_tokens, stream, result):
+        body = {'messages': messages, 'max_tokens': max_tokens, 'stream': stream}
+        if self.model:
+            body['model'] = self.model
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(body).encode('utf-8'),
+            # answers of earlier runs must not come from the response cache
+            headers={'Content-Type': 'application/json', 'Cache-Control': 'no-cache'},
+            method='POST'
+        )
+
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if not stream:
+                data = json.loads(response.read())
+                result.token(data['choices'][0]['message']['content'])
+                result.finish(data.get('usage'))
+                return
+
+            usage = None
+            for line in response:
+                line = line.decode('utf-8').strip()
+                if not line.startswith('data: ') or line == 'data: [DONE]':
+                    continue
+                chunk = json.loads(line[len('data: '):])
+                result.token(chunk['choices'][0]['delta'].get('content') or '')
+                usage = chunk.get('usage') or usage
+            result.finish(usage)
+
+
+class DirectTarget:
+    """
+    Calls `LLMCommunicator.complete_messages` in this process, without HTTP and streaming layers.
+    """
+    name = 'direct'
+
+    def __init__(self, llm):
+        self.llm = llm
+
+    def complete(self, messages, max_tokens, stream, result):
+        default_completion_config = self.llm.config['model_config']['default_completion_config']
+        response = self.llm.complete_messages(
+            messages,
+            max_tokens=max_tokens,
+            temperature=default_completion_config['temperature'],
+            repeat_penalty=default_completion_config['repeat_penalty'],
+            echo=False,
+            stream=stream,
+            frontend='bench',
+            details=True
+        )
+
+        if not stream:
+            result.token(response['choices'][0]['text'])
+            result.finish(response['usage'])
+            return
+
+        usage = None
+        for chunk in response:
+            result.token(chunk['choices'][0]['text'])
+            usage = chunk.get('usage') or usage
+        result.finish(usage)
+
+
+class LoadGenerator:
+    """
+    Replays the sessions of a workload against a target, `concurrency` sessions at a time.
+    """
+    def __init__(self, target, concurrency=1):
+        self.target = target
+        self.concurrency = max(1, concurrency)
+
+    def _run_session(self, workload, turns, stream, results, lock):
+        messages = workload.initial_messages()
+        for turn in turns:
+            messages = messages + [{'role': 'user', 'content': turn}]
+            result = RequestResult(workload.name, stream)
+            try:
+                self.target.complete(messages, workload.max_tokens, stream, result)
+            except Exception as e:
+                result.finished = time.perf_counter()
+                result.error = f"{type(e).__name__}: {e}"
+            with lock:
+                results.append(result)
+            if result.error is not None:
+                # the rest of the conversation depends on this answer
+                return
+            messages = messages + [{'role': 'assistant', 'content': result.text}]
+
+    def run(self, workload, stream):
+        """
+        :return: the results of all requests and the wall-clock seconds of the run
+        """
+        results = []
+        lock = threading.Lock()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='bench') as executor:
+            for turns in workload.sessions:
+                executor.submit(self._run_session, workload, turns, stream, results, lock)
+        return results, time.perf_counter() - started
@@ -0,0 +1,81 @@
+import math
+
+
+def percentile(values, p):
+    """
+    The `p`-th percentile of `values`, interpolated between the closest ranks.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    lower = math.floor(rank)
+    upper = math.ceil(rank)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def distribution(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return {
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values),
+    }
+
+
+def summarize(results, duration, concurrency):
+    """
+    The report of one run: TTFT, TPOT (time per output token after the first) and latency in seconds,
+    throughput in completion tokens per second of wall-clock time.
+    """
+    succeeded = [result for result in results if result.error is None]
+    completion_tokens = sum(result.completion_tokens for result in succeeded)
+    errors = [result.error for result in results if result.error is not None]
+
+    return {
+        'workload': results[0].workload if results else None,
+        'stream': results[0].stream if results else None,
+        'concurrency': concurrency,
+        'requests': len(results),
+        'errors': len(errors),
+        'first_errors': errors[:3],
+        'duration': duration,
+        'requests_per_second': len(succeeded) / duration if duration > 0 else None,
+        'throughput_tokens_per_second': completion_tokens / duration if duration > 0 else None,
+        'prompt_tokens': distribution([result.prompt_tokens for result in succeeded]),
+        'completion_tokens': distribution([result.completion_tokens for result in succeeded]),
+        'ttft': distribution([result.ttft for result in succeeded]),
+        'tpot': distribution([result.tpot for result in succeeded]),
+        'latency': distribution([result.latency for result in succeeded]),
+    }
+
+
+def run_key(run):
+    return f"{run['workload']}/{'stream' if run['stream'] else 'full'}/c{run['concurrency']}"
+
+
+def compare(report, baseline, max_regression=0.2):
+    """
+    Runs of `report` which are more than `max_regression` slower than the same runs of `baseline`,
+    by median latency or by throughput.
+    """
+    baseline_runs = {run_key(run): run for run in baseline.get('runs', [])}
+    regressions = []
+    for run in report['runs']:
+        base = baseline_runs.get(run_key(run))
+        if base is None or not run['latency'] or not base['latency']:
+            continue
+
+        latency, base_latency = run['latency']['p50'], base['latency']['p50']
+        if base_latency and latency > base_latency * (1 + max_regression):
+            regressions.append({'run': run_key(run), 'metric': 'latency.p50', 'baseline': base_latency, 'value': latency})
+
+        throughput, base_throughput = run['throughput_tokens_per_second'], base['throughput_tokens_per_second']
+        if base_throughput and throughput is not None and throughput < base_throughput * (1 - max_regression):
+            regressions.append({'run': run_key(run), 'metric': 'throughput_tokens_per_second', 'baseline': base_throughput, 'value': throughput})
+
+    return regressions
@@ -0,0 +1,114 @@
+import json
+import itertools
+
+
+_QUESTIONS = (
+    "What is the capital of France?",
+    "Explain in one sentence what a hash table is.",
+    "Name three prime numbers.",
+    "What does HTTP stand for?",
+    "Give me a synonym for fast.",
+    "How many days are there in a leap year?",
+    "What is the boiling point of water in Celsius?",
+    "Translate 'good morning' to Spanish.",
+)
+
+_FOLLOW_UPS = (
+    "Can you explain that in more detail?",
+    "Why is that?",
+    "Give me an example.",
+    "Summarize what we discussed so far.",
+    "What would be a common mistake here?",
+)
+
+_FILLER = (
+    "The", "server", "reads", "the", "request", "builds", "a", "prompt", "from", "the", "messages",
+    "and", "streams", "the", "answer", "back", "while", "the", "scheduler", "keeps", "the", "queue",
+    "short", "and", "the", "cache", "remembers", "recent", "prefixes", "of", "every", "conversation.",
+)
+
+
+class Workload:
+    """
+    A set of conversations replayed against a completion target.
+
+    Each session is a list of user messages sent one after the other, the answer to a turn is
+    part of the conversation of the next one; sessions run concurrently.
+    """
+    def __init__(self, name, sessions, max_tokens=64, system=None):
+        self.name = name
+        self.sessions = sessions
+        self.max_tokens = max_tokens
+        self.system = system
+
+    @property
+    def requests(self):
+        return sum(len(turns) for turns in self.sessions)
+
+    def initial_messages(self):
+        if self.system:
+            return [{'role': 'system', 'content': self.system}]
+        return []
+
+    @staticmethod
+    def from_dict(spec):
+        """
+        A workload from e.g. `{"name": "faq", "max_tokens": 32, "sessions": [["Hi", "And then?"]]}`;
+        `prompts` is a shortcut for single-turn sessions.
+        """
+        sessions = spec.get('sessions') or [[prompt] for prompt in spec.get('prompts', [])]
+        if not sessions:
+            raise ValueError(f"workload {spec.get('name')} has neither sessions nor prompts")
+        return Workload(spec['name'], sessions, max_tokens=spec.get('max_tokens', 64), system=spec.get('system'))
+
+
+def short_qa(requests=16, max_tokens=64):
+    questions = itertools.cycle(_QUESTIONS)
+    return Workload('short_qa', [[next(questions)] for _ in range(requests)], max_tokens=max_tokens)
+
+
+def long_context(requests=16, max_tokens=64, context_words=1500):
+    words = itertools.cycle(_FILLER)
+    document = ' '.join(next(words) for _ in range(context_words))
+    questions = itertools.cycle(_QUESTIONS)
+    # every request has its own document, so no prefix is shared between them
+    return Workload('long_context', [[f"Document {index}:\n{document}\n\nQuestion: {next(questions)}"] for index in range(requests)], max_tokens=max_tokens)
+
+
+def multi_turn(requests=16, max_tokens=64, turns=4):
+    questions = itertools.cycle(_QUESTIONS)
+    follow_ups = itertools.cycle(_FOLLOW_UPS)
+    sessions = []
+    for _ in range(max(1, requests // turns)):
+        sessions.append([next(questions)] + [next(follow_ups) for _ in range(turns - 1)])
+    return Workload('multi_turn', sessions, max_tokens=max_tokens, system="You are a helpful assistant.")
+
+
+BUILTIN_WORKLOADS = {
+    'short_qa': short_qa,
+    'long_context': long_context,
+    'multi_turn': multi_turn,
+}
+
+
+def load_workloads(names, requests=16, max_tokens=64, context_words=1500, turns=4, path=None):
+    """
+    The built-in workloads `names`, followed by the ones defined in the JSON file `path`.
+    """
+    workloads = []
+    for name in names:
+        if name not in BUILTIN_WORKLOADS:
+            raise ValueError(f"unknown workload: {name}, available: {', '.join(BUILTIN_WORKLOADS)}")
+        if name == 'long_context':
+            workloads.append(long_context(requests, max_tokens, context_words=context_words))
+        elif name == 'multi_turn':
+            workloads.append(multi_turn(requests, max_tokens, turns=turns))
+        else:
+            workloads.append(BUILTIN_WORKLOADS[name](requests, max_tokens))
+
+    if path:
+        with open(path, 'r', encoding='utf-8') as file:
+            specs = json.load(file)
+        workloads.extend(Workload.from_dict(spec) for spec in (specs if isinstance(specs, list) else [specs]))
+
+    return workloads
@@ -1,18 +1,17 @@
 import os
 import re
-import sys
 import json
 import threading
-import traceback
 from rich.console import Console
-from rich.markdown import Markdown
-from rich.live import Live
 
 from util.ConfigLoader import ConfigLoader
-from util.Loggers import print_centered, fill_row
+from util.Tracer import Tracer
+from util.Loggers import fill_row
 from util.Utilities import multi_line_input_with_stop_words, split_content_and_command
 from communicator.LLMCommunicator import LLMCommunicator
-from loader.HFLoader import load_model
+from communicator.StreamPipeline import StreamPipeline
+from chatbot.MarkdownStream import MarkdownStream
+from loader.HFLoader import pull_model
 
 class Chatbot:
     _lock = threading.Lock()
@@ -36,10 +35,9 @@ class Chatbot:
     def complete(self, messages=[]):
         with Chatbot._lock:
             config = ConfigLoader().get()
-            model_config = config['model_config']
-            default_completion_config = model_config['default_completion_config']
             llm = LLMCommunicator.get()
-            stream_batch_size = config['stream_batch_size']
+            model_config = llm.config['model_config']
+            default_completion_config = model_config['default_completion_config']
             context = ""
             
             default_max_tokens = default_completion_config['max_tokens']
@@ -52,6 +50,7 @@ class Chatbot:
             # print(f"default_repeat_penalty = {default_repeat_penalty}")
             # print(f"default_echo = {default_echo}")
 
+            trace = Tracer.get().start('cli')
             # Check if messages are provided and length is appropriate
             res = llm.complete_messages(
                 messages, 
@@ -59,45 +58,19 @@ class Chatbot:
                 temperature=default_temperature,
                 repeat_penalty=default_repeat_penalty,
                 echo=default_echo,
-                stream=True
+                stream=True,
+                frontend='cli',
+                trace=trace
             )
 
             # stream mode
             response_stream = res
-            def generate(batch_size=stream_batch_size):
-                prev_item = next(response_stream, None)  # Get the first item
-                bulk_text = ""
-                current_batch_size = 0
-                first_item = True
-
-                for item in response_stream:
-                    # option 1: directly yeild the current value
-                    # yield get_response_json(prev_item.choices[0].delta.content)
-
-                    # option 2: yield values in bulk
-                    bulk_text += prev_item['choices'][0]['text']
-                    current_batch_size += 1
-
-                    if current_batch_size == batch_size:
-                        if first_item:
-                            yield bulk_text
-                            first_item = False
-                        else:
-                            yield bulk_text
-
-                        bulk_text = ""
-                        current_batch_size = 0
-
-                    prev_item = item
-
-                # Handle the last item
-                if prev_item is not None:
-                    # option 1: directly yeild the current value
-                    # print(f"token[END] = {item['choices'][0]['delta']['content']}")
-
-                    # option 2: yield values in bulk
-                    bulk_text += prev_item['choices'][0]['text']
-                    yield bulk_text
+            pipeline = StreamPipeline.from_config(config, frontend='cli', trace=trace)
+            def generate():
+                try:
+                    yield from pipeline.run(response_stream)
+                finally:
+                    trace.finish()
 
             return generate()
 
@@ -135,17 +108,13 @@ class Chatbot:
             fill_row('─')
             self.console.print(f"{self.i18n['cb_assistant']}:\n", style="bold #AB68FF")
 
-            partial_response = ""
-            with Live(Markdown(""), console=self.console, auto_refresh=True) as live:
+            # completed markdown blocks are printed once, only the open one is re-rendered
+            with MarkdownStream(self.console, refresh_per_second=self.config.get('chatbot_refresh_per_second', 15)) as markdown:
                 for chunk in completion:
-                    text = chunk
-                    if text:
-                        partial_response += text
-                        # Update live display with partial markdown
-                        live.update(Markdown(partial_response))
+                    markdown.update(chunk)
 
             # Append full AI response to history
-            self.add_message("assistant", partial_response)
+            self.add_message("assistant", markdown.text)
 
         except Exception as e:
             self.console.print(f"Error: {e}", style="bold red")
@@ -162,9 +131,6 @@ class Chatbot:
     def load_model(self, model_name):
         print(f"Loading model {model_name}...")
         
-        # Offload
-        LLMCommunicator.pop()
-        
         # update config
         new_default_config = ConfigLoader.read_config('default.yaml')
         new_default_config['model'] = model_name
@@ -179,20 +145,22 @@ class Chatbot:
         print(f"=== ===  === ===  === ===\t\t CONFIGURATIONS \t\t=== ===  === ===  === ===")
         print(formatted_json)
         
-        # initiate LLM
-        LLMCommunicator.get()
+        # switch the default model, free when it is already resident in the pool
+        LLMCommunicator.pool().set_default(model_name)
 
     def pull_model(self, path1, path2, path3, config_name, base_config_name):
         print(f"Pulling model from {path1}/{path2}/{path3} as {config_name} from {base_config_name}...")
         
-        # create config
-        new_llm_config = ConfigLoader.read_config(f"{base_config_name}.yaml", path="./llm_config/")
-        new_llm_config['model_config']['hf_id'] = f"{path1}/{path2}"
-        new_llm_config['model_config']['hf_file'] = f"{path3}"
-        ConfigLoader.save_config(f"{config_name}.yaml", path="./llm_config/", config=new_llm_config)
+        def on_done(task):
+            if task.error is None:
+                self.console.print(f"Model {config_name} is downloaded, type \"/load {config_name}\" to use it.", style="bold green")
+            else:
+                self.console.print(f"Failed to download model {config_name}: {task.error}", style="bold red")
         
-        # pull model from HF
-        load_model(model_config=new_llm_config['model_config'])
+        # create config and pull model from HF in the background, the current model keeps serving
+        task = pull_model(f"{path1}/{path2}", path3, config_name, base_config_name, on_done=on_done)
+        if task is None:
+            self.console.print(f"Model {config_name} is already downloaded.", style="bold green")
 
     def run(self):
         """Run the chatbot, accepting input until the user types 'quit'."""
@@ -0,0 +1,125 @@
+import re
+import time
+
+from rich.live import Live
+from rich.markdown import Markdown
+
+
+_FENCE = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+_HEADING = re.compile(r"^ {0,3}#{1,6}(\s|$)")
+
+
+class MarkdownBlocks:
+    """
+    Splits streamed markdown into completed blocks and the block still being written.
+
+    A block is complete at a blank line, after a heading line, or at the end of a fenced code
+    block; blank lines inside a fence do not split it. Only the text added since the last call
+    is scanned.
+    """
+    def __init__(self):
+        self._text = ""
+        self._block_start = 0
+        self._scan_pos = 0
+        self._fence = None
+
+    @property
+    def tail(self):
+        """
+        The text of the open block.
+        """
+        return self._text[self._block_start:]
+
+    @property
+    def text(self):
+        return self._text
+
+    def _take(self, end):
+        block = self._text[self._block_start:end]
+        self._block_start = end
+        return block if block.strip() else None
+
+    def feed(self, text):
+        """
+        Add streamed text.
+
+        :return: the blocks completed by it
+        """
+        self._text += text
+        blocks = []
+
+        while True:
+            line_end = self._text.find('\n', self._scan_pos)
+            if line_end < 0:
+                break
+            line_start = self._scan_pos
+            line = self._text[line_start:line_end]
+            self._scan_pos = line_end + 1
+
+            if self._fence is not None:
+                if line.strip().startswith(self._fence) and line.strip().strip(self._fence[0]) == '':
+                    self._fence = None
+                    blocks.append(self._take(self._scan_pos))
+                continue
+
+            match = _FENCE.match(line)
+            if match:
+                # a fence also ends the paragraph before it
+                blocks.append(self._take(line_start))
+                self._fence = match.group(1)
+            elif not line.strip():
+                blocks.append(self._take(self._scan_pos))
+            elif _HEADING.match(line):
+                blocks.append(self._take(line_start))
+                blocks.append(self._take(self._scan_pos))
+
+        return [block for block in blocks if block is not None]
+
+
+class MarkdownStream:
+    """
+    Renders a streamed markdown answer to a `rich` console.
+
+    Re-rendering all of the answer on every chunk costs more the longer the answer gets;
+    instead completed blocks are printed once above a `Live` region and never parsed again,
+    and only the open block is re-rendered, at most `refresh_per_second` times per second.
+    """
+    def __init__(self, console, refresh_per_second=15):
+        self.console = console
+        self.refresh_interval = 1 / max(1, refresh_per_second)
+        self._blocks = MarkdownBlocks()
+        self._live = None
+        self._rendered_at = 0.0
+        self._dirty = False
+
+    @property
+    def text(self):
+        return self._blocks.text
+
+    def __enter__(self):
+        self._live = Live(Markdown(""), console=self.console, auto_refresh=False)
+        self._live.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self._render(force=True)
+        finally:
+            self._live.__exit__(exc_type, exc_value, traceback)
+
+    def update(self, text):
+        for block in self._blocks.feed(text):
+            self._live.console.print(Markdown(block))
+            self._dirty = True
+        if text:
+            self._dirty = True
+        self._render()
+
+    def _render(self, force=False):
+        now = time.monotonic()
+        if not self._dirty or (not force and now - self._rendered_at < self.refresh_interval):
+            return
+
+        self._live.update(Markdown(self._blocks.tail), refresh=True)
+        self._rendered_at = now
+        self._dirty = False
@@ -0,0 +1,76 @@
+import asyncio
+import threading
+
+
+_DONE = object()
+
+
+class _StreamError:
+    def __init__(self, error):
+        self.error = error
+
+
+class AsyncTokenStream:
+    """
+    Async iterator over a blocking token stream.
+
+    The stream is created and consumed on an inference worker thread, each item is handed
+    over to the event loop through an `asyncio.Queue`, so the loop never waits on the model.
+    Closing the iterator (or dropping it) stops the worker after its current token.
+
+    :param stream_factory: callable returning the blocking iterator, invoked on the worker thread
+    :param executor: the executor owning the inference worker thread(s)
+    """
+    def __init__(self, stream_factory, executor, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._cancelled = threading.Event()
+        self._finished = False
+        self._future = self._loop.run_in_executor(executor, self._pump, stream_factory)
+
+    def _put(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        except RuntimeError:
+            # the event loop is already closed, nobody is listening anymore
+            self._cancelled.set()
+
+    def _pump(self, stream_factory):
+        stream = None
+        try:
+            stream = stream_factory()
+            for item in stream:
+                if self._cancelled.is_set():
+                    break
+                self._put(item)
+        except BaseException as e:
+            self._put(_StreamError(e))
+        finally:
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+            self._put(_DONE)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._finished:
+            raise StopAsyncIteration
+
+        item = await self._queue.get()
+        if item is _DONE:
+            self._finished = True
+            raise StopAsyncIteration
+        if isinstance(item, _StreamError):
+            self._finished = True
+            raise item.error
+
+        return item
+
+    async def aclose(self):
+        self._cancelled.set()
+        self._finished = True
+
+    def __del__(self):
+        self._cancelled.set()
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+
+from util.Utilities import file_fingerprint
+from util.HostProbe import probe_host, host_fingerprint, memory_bandwidth
+
+
+_FILLER = (
+    "The server reads the request, builds a prompt from the messages and streams the answer back "
+    "while the scheduler keeps the queue short and the cache remembers recent prefixes. "
+)
+
+
+class AutoTuner:
+    """
+    Picks `n_threads` (decode), `n_threads_batch` (prompt evaluation), `n_batch` and `n_ubatch`
+    for a model on this host.
+
+    Decoding reads all weights once per token and is bound by the memory bandwidth, so it
+    often runs fastest on fewer threads than there are cores (e.g. the cores of one NUMA
+    node); prompt evaluation is bound by compute and uses all of them. Both are measured
+    for several thread counts on one loaded model, then the prompt throughput is measured
+    for several batch sizes, each of which needs a new context.
+
+    A profile is stored as `<root>/<model fingerprint>-<host fingerprint>-...json`, later
+    startups on the same host load it instead of measuring again.
+
+    :param share: the number of processes serving models on this host, each one gets this part of the cores
+    """
+    # fewer threads are preferred while they are at most this much slower than the fastest count
+    TOLERANCE = 0.03
+
+    def __init__(self, root, model_path, autotune_config=None, share=1, n_gpu_layers=0, n_ctx=2048):
+        autotune_config = autotune_config or {}
+        self.root = root
+        self.model_path = model_path
+        self.share = max(1, share)
+        self.n_ctx = n_ctx
+        self.retune = autotune_config.get('retune', False)
+        self.prompt_tokens = autotune_config.get('prompt_tokens', 512)
+        self.decode_tokens = autotune_config.get('decode_tokens', 16)
+        self.batch_sizes = sorted(autotune_config.get('batch_sizes', [128, 256, 512]))
+        self.repeat = max(1, autotune_config.get('repeat', 1))
+
+        self.host = probe_host()
+        key = f"{file_fingerprint(model_path)[:16]}-{host_fingerprint(self.host)[:16]}-share{self.share}-gpu{n_gpu_layers}"
+        self.profile_path = os.path.join(root, f"{key}.json")
+
+    def thread_candidates(self):
+        """
+        Powers of two up to the cores of this process, the cores of one NUMA node, and all cores (and one less).
+        """
+        cores = max(1, self.host['physical_cores'] // self.share)
+        node_cores = max(1, max(self.host['cores_per_numa_node']) // self.share)
+
+        candidates = {cores, min(cores, node_cores)}
+        if cores > 2:
+            candidates.add(cores - 1)
+        count = 1
+        while count < cores:
+            # very small counts are never the fastest on a large machine
+            if count >= cores // 8:
+                candidates.add(count)
+            count *= 2
+        return sorted(candidates)
+
+    def batch_candidates(self):
+        sizes = [size for size in self.batch_sizes if size <= self.n_ctx] or [min(self.batch_sizes)]
+        return [(size, size) for size in sizes]
+
+    def load(self):
+        """
+        The stored profile of this model and host, or None.
+        """
+        if self.retune:
+            return None
+        try:
+            with open(self.profile_path, 'r', encoding='utf-8') as file:
+                profile = json.load(file)
+            settings = profile['settings']
+            return profile if all(key in settings for key in ('n_threads', 'n_threads_batch', 'n_batch', 'n_ubatch')) else None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, profile):
+        os.makedirs(self.root, exist_ok=True)
+        temp_path = f"{self.profile_path}.tmp-{os.getpid()}"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(profile, file, indent=4)
+        os.replace(temp_path, self.profile_path)
+
+    def _prompt(self, backend, length):
+        text = _FILLER
+        tokens = backend.tokenize(text.encode('utf-8'), add_bos=True)
+        while len(tokens) < length:
+            text += _FILLER
+            tokens = backend.tokenize(text.encode('utf-8'), add_bos=True)
+        return tokens[:length]
+
+    def _prompt_throughput(self, backend, prompt):
+        best = None
+        for _ in range(self.repeat):
+            backend.reset()
+            start = time.perf_counter()
+            backend.evaluate(prompt)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return len(prompt) / best if best else 0.0
+
+    def _decode_throughput(self, backend, prompt):
+        # one token at a time after a short prompt, like the decode steps of a completion
+        best = None
+        token = prompt[-1]
+        for _ in range(self.repeat):
+            backend.reset()
+            backend.evaluate(prompt[:16])
+            start = time.perf_counter()
+            for _ in range(self.decode_tokens):
+                backend.evaluate([token])
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return self.decode_tokens / best if best else 0.0
+
+    @staticmethod
+    def _best(throughputs):
+        fastest = max(throughputs.values())
+        return min(key for key, value in throughputs.items() if value >= fastest * (1 - AutoTuner.TOLERANCE))
+
+    def tune(self, create_backend, n_batch=512, n_ubatch=None):
+        """
+        Measure the model and return its profile.
+
+        :param create_backend: called with `n_threads`, `n_threads_batch`, `n_batch` and `n_ubatch`, returns an `InferenceBackend` which is not loaded yet
+        """
+        started = time.perf_counter()
+        threads = self.thread_candidates()
+        length = min(max(self.prompt_tokens, max(self.batch_sizes)), self.n_ctx - self.decode_tokens - 16)
+        measurements = {'threads': [], 'batch': []}
+
+        backend = create_backend(n_threads=max(threads), n_threads_batch=max(threads), n_batch=n_batch, n_ubatch=n_ubatch)
+        backend.load()
+        try:
+            prompt = self._prompt(backend, length)
+            # the first evaluation faults in the weights and builds the compute graphs
+            backend.reset()
+            backend.evaluate(prompt[:16])
+
+            decode, prompt_eval = {}, {}
+            for count in threads:
+                backend.set_threads(count, count)
+                decode[count] = self._decode_throughput(backend, prompt)
+                prompt_eval[count] = self._prompt_throughput(backend, prompt)
+                measurements['threads'].append({
+                    'threads': count,
+                    'decode_tokens_per_second': decode[count],
+                    'prompt_tokens_per_second': prompt_eval[count],
+                })
+        finally:
+            backend.unload()
+
+        n_threads = AutoTuner._best(decode)
+        n_threads_batch = AutoTuner._best(prompt_eval)
+
+        batch = {}
+        for batch_size, ubatch_size in self.batch_candidates():
+            backend = create_backend(n_threads=n_threads, n_threads_batch=n_threads_batch, n_batch=batch_size, n_ubatch=ubatch_size)
+            backend.load()
+            try:
+                backend.reset()
+                backend.evaluate(prompt[:16])
+                batch[(batch_size, ubatch_size)] = self._prompt_throughput(backend, prompt)
+            finally:
+                backend.unload()
+            measurements['batch'].append({
+                'n_batch': batch_size,
+                'n_ubatch': ubatch_size,
+                'prompt_tokens_per_second': batch[(batch_size, ubatch_size)],
+            })
+        best_batch, best_ubatch = AutoTuner._best(batch)
+
+        # decoding reads every weight once per token, this shows how close it gets to the memory bandwidth
+        model_size = os.path.getsize(self.model_path)
+        bandwidth = memory_bandwidth()
+
+        return {
+            'settings': {
+                'n_threads': n_threads,
+                'n_threads_batch': n_threads_batch,
+                'n_batch': best_batch,
+                'n_ubatch': best_ubatch,
+            },
+            'decode_tokens_per_second': decode[n_threads],
+            'prompt_tokens_per_second': batch[(best_batch, best_ubatch)],
+            'decode_bytes_per_second': decode[n_threads] * model_size,
+            'memory_bandwidth': bandwidth,
+            'measurements': measurements,
+            'host': self.host,
+            'share': self.share,
+            'model_path': self.model_path,
+            'model_size': model_size,
+            'prompt_tokens': length,
+            'tuning_seconds': time.perf_counter() - started,
+            'created': time.time(),
+        }
@@ -0,0 +1,384 @@
+import time
+import uuid
+import queue
+import threading
+from collections import deque
+
+import numpy as np
+import llama_cpp
+
+from communicator.StreamPipeline import Utf8Repair, StopDetector
+from communicator.ContextWindow import ContextLengthError
+
+
+_DONE = object()
+
+
+class _SequenceError:
+    def __init__(self, error):
+        self.error = error
+
+
+class BatchSequence:
+    """
+    One completion decoded by the `BatchEngine`.
+
+    Iterating over the sequence yields completion chunks in the same shape as
+    `Llama.create_completion(stream=True)`, so it can be consumed by the existing frontends.
+    """
+    def __init__(self, prompt_tokens, max_tokens=256, temperature=0.0, top_p=1.0, top_k=0, min_p=0.0, repeat_penalty=1.1, presence_penalty=0.0, frequency_penalty=0.0, stop=None, seed=None, model='', echo_text=None):
+        self.id = f"cmpl-{uuid.uuid4()}"
+        self.created = int(time.time())
+        self.model = model
+        self.prompt_tokens = list(prompt_tokens)
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.min_p = min_p
+        self.repeat_penalty = repeat_penalty
+        self.presence_penalty = presence_penalty
+        self.frequency_penalty = frequency_penalty
+        self.stop = StopDetector(stop)
+        self.rng = np.random.default_rng(seed)
+
+        self.seq_id = None
+        self.n_past = 0
+        self.pending_tokens = list(prompt_tokens)
+        self.last_token = None
+        self.logits_index = None
+        self.completion_tokens = []
+        self.finish_reason = None
+
+        self._utf8 = Utf8Repair()
+        self._stopped = False
+        self._chunks = queue.Queue()
+        self._cancelled = threading.Event()
+
+        if echo_text:
+            self._chunks.put(self._chunk(echo_text))
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def prefilling(self):
+        return len(self.pending_tokens) > 0
+
+    def _chunk(self, text, finish_reason=None):
+        return {
+            'id': self.id,
+            'object': 'text_completion',
+            'created': self.created,
+            'model': self.model,
+            'choices': [{
+                'text': text,
+                'index': 0,
+                'logprobs': None,
+                'finish_reason': finish_reason
+            }]
+        }
+
+    def _push_token(self, token_bytes):
+        # the stop sequence itself is never sent, `_finish` follows right away
+        text, self._stopped = self.stop.feed(self._utf8.feed(token_bytes))
+        if text:
+            self._chunks.put(self._chunk(text))
+        return self._stopped
+
+    def _finish(self, finish_reason):
+        self.finish_reason = finish_reason
+        text = ""
+        if not self._stopped:
+            text, self._stopped = self.stop.feed(self._utf8.flush())
+            if not self._stopped:
+                text += self.stop.flush()
+        self._chunks.put(self._chunk(text, finish_reason=finish_reason))
+        self._chunks.put(_DONE)
+
+    def _fail(self, error):
+        self._chunks.put(_SequenceError(error))
+        self._chunks.put(_DONE)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self._chunks.get()
+        if item is _DONE:
+            self._chunks.put(_DONE)
+            raise StopIteration
+        if isinstance(item, _SequenceError):
+            raise item.error
+        return item
+
+    def close(self):
+        self._cancelled.set()
+
+
+class BatchEngine:
+    """
+    Continuous batching on top of a single `Llama` context.
+
+    Every admitted sequence gets its own KV-cache sequence id; each decode step packs the
+    next token of every generating sequence plus prompt chunks of newly joined sequences
+    into one `llama_batch`, so concurrent completions share the same forward passes.
+    Sequences join and leave between two decode steps.
+
+    :param llm: the loaded `Llama` instance, the engine must be its only user
+    :param n_parallel: maximum number of sequences decoded together
+    :param n_batch: maximum number of tokens per decode step
+    """
+    def __init__(self, llm, n_parallel=4, n_batch=512, model='', repeat_last_n=64):
+        self._llm = llm
+        self._ctx = llm._ctx.ctx
+        self._n_vocab = llm.n_vocab()
+        self._n_ctx = llm.n_ctx()
+        self._eos_token = llm.token_eos()
+        self._n_batch = n_batch
+        self._model = model
+        self._repeat_last_n = repeat_last_n
+
+        self._cond = threading.Condition()
+        self._waiting = deque()
+        self._active = []
+        self._free_seq_ids = list(range(n_parallel - 1, -1, -1))
+        self._stopped = False
+
+        self._stats = {
+            'decode_steps': 0,
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+            'max_concurrency': 0,
+        }
+
+        # the high-level Llama bookkeeping does not know about our sequences
+        self._llm.reset()
+        llama_cpp.llama_kv_cache_clear(self._ctx)
+        self._batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+
+        self._thread = threading.Thread(target=self._run, daemon=True, name='llm-batch-engine')
+        self._thread.start()
+
+    def submit(self, prompt, max_tokens=256, temperature=0.0, top_p=1.0, top_k=0, min_p=0.0, repeat_penalty=1.1, presence_penalty=0.0, frequency_penalty=0.0, stop=None, seed=None, echo=False):
+        """
+        Add a completion to the engine.
+
+        :param prompt: the prompt text, or a list of prompt token ids
+        :param echo: emit the prompt text as the first chunk
+        :return: a `BatchSequence` iterating over the completion chunks
+        """
+        if isinstance(prompt, str):
+            prompt_tokens = self._llm.tokenize(prompt.encode('utf-8'), special=True)
+        else:
+            prompt_tokens = list(prompt)
+
+        if len(prompt_tokens) >= self._n_ctx:
+            raise ContextLengthError(f"prompt of {len(prompt_tokens)} tokens exceeds the context window of {self._n_ctx} tokens")
+
+        sequence = BatchSequence(
+            prompt_tokens,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            min_p=min_p,
+            repeat_penalty=repeat_penalty,
+            presence_penalty=presence_penalty,
+            frequency_penalty=frequency_penalty,
+            stop=stop,
+            seed=seed,
+            model=self._model,
+            echo_text=(self._echo_text(prompt) if echo else None)
+        )
+
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("batch engine has been stopped")
+            self._waiting.append(sequence)
+            self._cond.notify()
+
+        return sequence
+
+    def _echo_text(self, prompt):
+        if isinstance(prompt, str):
+            return prompt
+        return self._llm.detokenize(list(prompt)).decode('utf-8', errors='ignore')
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+        llama_cpp.llama_batch_free(self._batch)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['active'] = len(self._active)
+            stats['waiting'] = len(self._waiting)
+            return stats
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self._waiting and not self._active:
+                    self._cond.wait()
+
+                if self._stopped:
+                    for sequence in list(self._waiting) + self._active:
+                        sequence._fail(RuntimeError("batch engine has been stopped"))
+                    return
+
+                # new sequences join between two decode steps
+                while self._waiting and self._free_seq_ids:
+                    sequence = self._waiting.popleft()
+                    sequence.seq_id = self._free_seq_ids.pop()
+                    self._active.append(sequence)
+
+                self._stats['max_concurrency'] = max(self._stats['max_concurrency'], len(self._active))
+
+            try:
+                self._step()
+            except Exception as e:
+                for sequence in self._active:
+                    self._release(sequence)
+                    sequence._fail(e)
+                self._active = []
+
+    def _step(self):
+        # a cancelled sequence did not end by itself, it must not look like one which did
+        for sequence in [s for s in self._active if s.cancelled]:
+            self._leave(sequence, 'cancelled')
+
+        if not self._active:
+            return
+
+        batch = self._batch
+        n_tokens = 0
+        scheduled = []
+
+        # one token for every generating sequence first, so decoding never starves
+        for sequence in self._active:
+            sequence.logits_index = None
+            if not sequence.prefilling:
+                self._add_token(batch, n_tokens, sequence.last_token, sequence.n_past, sequence.seq_id, True)
+                scheduled.append((sequence, [sequence.last_token], False))
+                sequence.logits_index = n_tokens
+                sequence.n_past += 1
+                n_tokens += 1
+
+        # then fill the rest of the batch with prompt chunks of joining sequences
+        for sequence in self._active:
+            if not sequence.prefilling or n_tokens >= self._n_batch:
+                continue
+
+            chunk = sequence.pending_tokens[:self._n_batch - n_tokens]
+            sequence.pending_tokens = sequence.pending_tokens[len(chunk):]
+            scheduled.append((sequence, chunk, True))
+            for i, token in enumerate(chunk):
+                is_last = (not sequence.pending_tokens) and i == len(chunk) - 1
+                self._add_token(batch, n_tokens, token, sequence.n_past, sequence.seq_id, is_last)
+                if is_last:
+                    sequence.logits_index = n_tokens
+                sequence.n_past += 1
+                n_tokens += 1
+
+        batch.n_tokens = n_tokens
+        result = llama_cpp.llama_decode(self._ctx, batch)
+        self._stats['decode_steps'] += 1
+
+        if result < 0:
+            raise RuntimeError(f"llama_decode failed with code {result}")
+
+        if result > 0:
+            # no room left in the KV cache: undo this step, then the longest sequence gives up its cells
+            for sequence, tokens, is_prompt in scheduled:
+                sequence.n_past -= len(tokens)
+                sequence.logits_index = None
+                if is_prompt:
+                    sequence.pending_tokens = tokens + sequence.pending_tokens
+                llama_cpp.llama_kv_cache_seq_rm(self._ctx, sequence.seq_id, sequence.n_past, -1)
+
+            self._leave(max(self._active, key=lambda s: s.n_past), 'length')
+            return
+
+        for sequence, tokens, is_prompt in scheduled:
+            if is_prompt:
+                self._stats['prompt_tokens'] += len(tokens)
+
+        for sequence in list(self._active):
+            if sequence.logits_index is None:
+                continue
+
+            token = self._sample(sequence, sequence.logits_index)
+            sequence.last_token = token
+            self._stats['completion_tokens'] += 1
+
+            if token == self._eos_token:
+                self._leave(sequence, 'stop')
+                continue
+
+            sequence.completion_tokens.append(token)
+            if sequence._push_token(self._llm.detokenize([token])):
+                self._leave(sequence, 'stop')
+            elif len(sequence.completion_tokens) >= sequence.max_tokens or sequence.n_past + 1 >= self._n_ctx:
+                self._leave(sequence, 'length')
+
+    def _add_token(self, batch, i, token, pos, seq_id, logits):
+        batch.token[i] = token
+        batch.pos[i] = pos
+        batch.n_seq_id[i] = 1
+        batch.seq_id[i][0] = seq_id
+        batch.logits[i] = logits
+
+    def _sample(self, sequence, logits_index):
+        logits_ptr = llama_cpp.llama_get_logits_ith(self._ctx, logits_index)
+        logits = np.ctypeslib.as_array(logits_ptr, shape=(self._n_vocab,)).astype(np.float32)
+
+        if sequence.repeat_penalty != 1.0:
+            recent = sequence.prompt_tokens + sequence.completion_tokens
+            recent = np.unique(np.array(recent[-self._repeat_last_n:], dtype=np.int64))
+            if len(recent) > 0:
+                values = logits[recent]
+                logits[recent] = np.where(values > 0, values / sequence.repeat_penalty, values * sequence.repeat_penalty)
+
+        # OpenAI penalties only look at the completion: once per token seen, and per occurrence
+        if (sequence.presence_penalty or sequence.frequency_penalty) and sequence.completion_tokens:
+            tokens, counts = np.unique(np.array(sequence.completion_tokens, dtype=np.int64), return_counts=True)
+            logits[tokens] -= counts * sequence.frequency_penalty + sequence.presence_penalty
+
+        if sequence.temperature <= 0:
+            return int(np.argmax(logits))
+
+        if 0 < sequence.top_k < self._n_vocab:
+            threshold = np.partition(logits, -sequence.top_k)[-sequence.top_k]
+            logits[logits < threshold] = -np.inf
+
+        logits = logits / sequence.temperature
+        probs = np.exp(logits - np.max(logits))
+        probs /= probs.sum()
+
+        if sequence.min_p > 0:
+            probs[probs < sequence.min_p * probs.max()] = 0.0
+            probs /= probs.sum()
+
+        if sequence.top_p < 1.0:
+            order = np.argsort(-probs)
+            cumulative = np.cumsum(probs[order])
+            keep = order[:int(np.searchsorted(cumulative, sequence.top_p)) + 1]
+            kept_probs = probs[keep] / probs[keep].sum()
+            return int(sequence.rng.choice(keep, p=kept_probs))
+
+        return int(sequence.rng.choice(self._n_vocab, p=probs))
+
+    def _release(self, sequence):
+        llama_cpp.llama_kv_cache_seq_rm(self._ctx, sequence.seq_id, -1, -1)
+        with self._cond:
+            self._free_seq_ids.append(sequence.seq_id)
+
+    def _leave(self, sequence, finish_reason):
+        self._active.remove(sequence)
+        self._release(sequence)
+        sequence._finish(finish_reason)
@@ -0,0 +1,242 @@
+import time
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+
+class InvalidRequestError(ValueError):
+    """
+    Raised when the messages or parameters of a request can not be completed, e.g. an unknown role.
+    """
+    pass
+
+
+class ContextLengthError(InvalidRequestError):
+    """
+    Raised when not even the last message fits into the context window.
+    """
+    pass
+
+
+class ContextWindow:
+    """
+    Makes a conversation fit into the context window of a model.
+
+    The prompt is counted in tokens; when it does not leave room for the completion, older
+    messages are removed according to `policy` (the system message and the last message are
+    always kept):
+    - `drop_oldest`: remove the oldest messages until the prompt fits.
+    - `keep_last`: keep only the last `keep_last_messages` messages, then drop more if needed.
+    - `summarize`: like `drop_oldest`, but the removed messages are summarized by the model in
+      the background; later requests replace them by that summary. The summary grows with the
+      conversation: the last one is extended by the newly removed messages, in as many steps
+      as needed to keep every summary request within the context window.
+
+    :param count_tokens: callable returning the number of prompt tokens of a list of messages
+    :param summarize: callable returning the completion text of a summary request (a list of messages), used by the `summarize` policy
+    """
+    POLICIES = ('drop_oldest', 'keep_last', 'summarize')
+
+    def __init__(self, n_ctx, count_tokens, context_config=None, summarize=None):
+        if context_config is None:
+            context_config = {}
+
+        self.n_ctx = n_ctx
+        self.policy = context_config.get('policy', 'drop_oldest')
+        self.keep_last_messages = context_config.get('keep_last_messages', 8)
+        self.completion_reserve = context_config.get('completion_reserve', 256)
+        self.max_summaries = context_config.get('max_summaries', 256)
+        self.summary_max_tokens = context_config.get('summary_max_tokens', 256)
+        self.summary_retry_seconds = context_config.get('summary_retry_seconds', 300)
+        if self.policy not in ContextWindow.POLICIES:
+            raise ValueError(f"unknown context policy: {self.policy}")
+
+        self._count_tokens = count_tokens
+        self._summarize = summarize
+        self._lock = threading.Lock()
+        # summaries and the time of failed summary requests, by the key of the summarized prefix
+        self._summaries = OrderedDict()
+        self._failures = OrderedDict()
+        self._summarizing = set()
+
+    @staticmethod
+    def _prefix_keys(messages):
+        # the key of `messages[:n]` is at index `n - 1`
+        digest = hashlib.sha256()
+        keys = []
+        for message in messages:
+            digest.update(json.dumps([message.get('role', 'user'), message.get('content', '')], ensure_ascii=False).encode('utf-8'))
+            keys.append(digest.hexdigest())
+        return keys
+
+    def _summary(self, keys, end):
+        # the summary of the longest prefix of at most `end` messages, as the length of that prefix and the summary
+        with self._lock:
+            for length in range(end, 0, -1):
+                summary = self._summaries.get(keys[length - 1])
+                if summary is not None:
+                    self._summaries.move_to_end(keys[length - 1])
+                    return length, summary
+            return 0, None
+
+    @staticmethod
+    def _summary_request(summary, messages):
+        transcript = "\n".join(f"{message.get('role', 'user')}: {message.get('content', '').strip()}" for message in messages)
+        if summary is None:
+            prompt = f"Summarize the following conversation in a few sentences, keep names, facts and decisions:\n\n{transcript}"
+        else:
+            prompt = f"Here is the summary of a conversation:\n\n{summary}\n\nRewrite it in a few sentences so that it also covers the following messages of the conversation, keep names, facts and decisions:\n\n{transcript}"
+        return [{'role': 'user', 'content': prompt}]
+
+    def _next_summary_request(self, summary, messages):
+        """
+        The request extending `summary` by as many of `messages` as fit into the context window,
+        and the number of these messages; a single message which does not fit is shortened.
+        """
+        limit = self.n_ctx - max(self.summary_max_tokens, self.completion_reserve)
+
+        def fits(request):
+            return self._count_tokens(request) <= limit
+
+        # the largest number of messages which fits
+        low, high = 1, len(messages)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if fits(ContextWindow._summary_request(summary, messages[:middle])):
+                low = middle
+            else:
+                high = middle - 1
+
+        request = ContextWindow._summary_request(summary, messages[:low])
+        if low == 1:
+            content = messages[0].get('content', '')
+            while not fits(request):
+                if not content:
+                    raise ContextLengthError(f"the summary does not leave room for the conversation in the context window of {self.n_ctx} tokens")
+                content = content[:len(content) // 2]
+                request = ContextWindow._summary_request(summary, [dict(messages[0], content=content)])
+        return request, low
+
+    def _with_summary(self, system, summary, rest):
+        note = f"Summary of the earlier conversation: {summary}"
+        if system:
+            content = f"{system[0].get('content', '')}\n\n{note}".strip()
+            return [dict(system[0], content=content)] + rest
+        return [{'role': 'user', 'content': note}, {'role': 'assistant', 'content': 'OK.'}] + rest
+
+    def _summarize_in_background(self, messages, keys):
+        if self._summarize is None:
+            return
+
+        # continue from the latest summary of this conversation; a summary which failed is not
+        # requested again for `summary_retry_seconds`, the following turns would fail the same way
+        done, summary = self._summary(keys, len(messages))
+        start_key = keys[done - 1] if done else ''
+        with self._lock:
+            failed_at = self._failures.get(start_key)
+            if start_key in self._summarizing or (failed_at is not None and time.monotonic() - failed_at < self.summary_retry_seconds):
+                return
+            self._summarizing.add(start_key)
+
+        def run():
+            nonlocal done, summary
+            try:
+                while done < len(messages):
+                    request, count = self._next_summary_request(summary, messages[done:])
+                    summary = self._summarize(request).strip()
+                    done += count
+                    with self._lock:
+                        self._summaries[keys[done - 1]] = summary
+                        while len(self._summaries) > self.max_summaries:
+                            self._summaries.popitem(last=False)
+            except Exception as e:
+                print(f"failed to summarize {len(messages) - done} messages: {e}")
+                with self._lock:
+                    self._failures[keys[done - 1] if done else ''] = time.monotonic()
+                    while len(self._failures) > self.max_summaries:
+                        self._failures.popitem(last=False)
+            finally:
+                with self._lock:
+                    self._summarizing.discard(start_key)
+
+        thread = threading.Thread(target=run, daemon=True, name='context-summary')
+        thread.start()
+
+    def fit(self, messages, max_tokens=None):
+        """
+        Fit `messages` and the completion into the context window.
+
+        :param messages: the conversation, starting with the system message if there is one; it is not modified
+        :param max_tokens: the requested completion length, None or 0 for as long as the context allows
+        :return: the messages to use, the completion length to use and a report of the decisions
+        """
+        system = [messages[0]] if messages and messages[0].get('role') == 'system' else []
+        history = list(messages[len(system):])
+
+        requested = max_tokens if max_tokens and max_tokens > 0 else None
+        reserve = min(requested or self.completion_reserve, self.completion_reserve, self.n_ctx - 1)
+        prompt_limit = self.n_ctx - reserve
+
+        report = {
+            'n_ctx': self.n_ctx,
+            'policy': self.policy,
+            'truncated': False,
+            'dropped_messages': 0,
+            'summarized_messages': 0,
+        }
+
+        prompt_tokens = self._count_tokens(system + history)
+        fitted = system + history
+        keys = ContextWindow._prefix_keys(history) if self.policy == 'summarize' else None
+
+        if prompt_tokens > prompt_limit:
+            report['truncated'] = True
+            start = 0
+
+            if self.policy == 'keep_last':
+                start = max(0, len(history) - self.keep_last_messages)
+
+            while True:
+                # a conversation never starts with an assistant message
+                while start < len(history) - 1 and history[start].get('role') != 'user':
+                    start += 1
+
+                fitted = system + history[start:]
+                if self.policy == 'summarize' and start > 0:
+                    # the summary may not cover the latest removed messages yet, these are dropped
+                    summarized, summary = self._summary(keys, start)
+                    if summary is not None:
+                        candidate = self._with_summary(system, summary, history[start:])
+                        candidate_tokens = self._count_tokens(candidate)
+                        if candidate_tokens <= prompt_limit:
+                            fitted, prompt_tokens = candidate, candidate_tokens
+                            report['summarized_messages'] = summarized
+                            break
+
+                prompt_tokens = self._count_tokens(fitted)
+                if prompt_tokens <= prompt_limit:
+                    break
+                if start >= len(history) - 1:
+                    raise ContextLengthError(f"the last message needs {prompt_tokens} tokens, the context window of {self.n_ctx} tokens leaves {prompt_limit} tokens for the prompt")
+                start += 1
+
+            report['dropped_messages'] = start - report['summarized_messages']
+            if self.policy == 'summarize' and start > 0 and report['summarized_messages'] < start:
+                # the next turn of this conversation gets the summary instead of nothing
+                self._summarize_in_background(history[:start], keys[:start])
+
+        completion_limit = self.n_ctx - prompt_tokens
+        report['requested_max_tokens'] = requested
+        report['max_tokens'] = min(requested, completion_limit) if requested is not None else completion_limit
+        report['prompt_tokens'] = prompt_tokens
+        return fitted, report['max_tokens'], report
+
+    def stats(self):
+        with self._lock:
+            return {
+                'policy': self.policy,
+                'summaries': len(self._summaries),
+                'summarizing': len(self._summarizing),
+                'failed_summaries': len(self._failures),
+            }
@@ -0,0 +1,132 @@
+import re
+import time
+import zlib
+import array
+
+from communicator.InferenceBackend import InferenceBackend
+
+
+_SPECIAL = re.compile(r"(<\|[^|<>]*\|>|</?s>)")
+_PIECE = re.compile(r"\s*\S+|\s+")
+
+_WORDS = (
+    " the", " model", " answers", " with", " a", " short", " and", " deterministic", " text",
+    " for", " benchmarks", " of", " server", " overhead", " every", " token", " is", " chosen",
+    " from", " this", " list", " so", " runs", " can", " be", " compared", ".", ",",
+)
+
+
+class FakeState:
+    def __init__(self, input_ids):
+        self.input_ids = input_ids
+        self.n_tokens = len(input_ids)
+
+
+class FakeBackend(InferenceBackend):
+    """
+    Deterministic synthetic backend which needs no model file.
+
+    Text is split into words and whitespace, every piece gets a stable token id; completions
+    are built from a fixed list of words, chosen from a hash of the context and the seed, so
+    the same request always gets the same answer. Evaluating a prompt token takes
+    `prompt_token_latency_ms` and decoding one takes `token_latency_ms` (or the inverse of
+    `prompt_tokens_per_second` and `tokens_per_second` when these are set), loading takes
+    `load_ms`; with all of them at 0 only the Python layers above the backend are measured.
+    A completion ends after `completion_tokens` tokens (with EOS), or at `max_tokens` when it
+    is not set.
+    """
+    name = 'fake'
+    uses_model_file = False
+
+    BOS = 1
+    EOS = 2
+
+    def __init__(self, model_path='', token_latency_ms=0.0, prompt_token_latency_ms=0.0, tokens_per_second=None, prompt_tokens_per_second=None, load_ms=0.0, completion_tokens=None, seed=0, vocab_size=32000, **kwargs):
+        super().__init__(model_path, **kwargs)
+        self.token_latency = 1 / tokens_per_second if tokens_per_second else max(0.0, float(token_latency_ms)) / 1000
+        self.prompt_token_latency = 1 / prompt_tokens_per_second if prompt_tokens_per_second else max(0.0, float(prompt_token_latency_ms)) / 1000
+        self.load_latency = max(0.0, float(load_ms)) / 1000
+        self.completion_tokens = completion_tokens
+        self.seed = seed
+        self.vocab_size = vocab_size
+
+        self._pieces = {FakeBackend.BOS: '<s>', FakeBackend.EOS: '</s>'}
+        self._words = [self._token_id(word) for word in _WORDS]
+        self._input_ids = array.array('i')
+        self._generated = 0
+        self._seed = seed
+
+    def load(self):
+        start = time.perf_counter()
+        if self.load_latency:
+            time.sleep(self.load_latency)
+        return {'tensor_mapping': time.perf_counter() - start}
+
+    def _token_id(self, piece):
+        token = 3 + zlib.crc32(piece.encode('utf-8')) % (self.vocab_size - 3)
+        self._pieces[token] = piece
+        return token
+
+    def token_bos(self):
+        return FakeBackend.BOS
+
+    def token_eos(self):
+        return FakeBackend.EOS
+
+    def token_text(self, token):
+        return self._pieces.get(token, '')
+
+    def tokenize(self, text, add_bos=True, special=False):
+        text = text.decode('utf-8', errors='ignore')
+        tokens = [FakeBackend.BOS] if add_bos else []
+        parts = _SPECIAL.split(text) if special else [text]
+        for part in parts:
+            if special and part == '<s>':
+                tokens.append(FakeBackend.BOS)
+            elif special and part == '</s>':
+                tokens.append(FakeBackend.EOS)
+            elif special and _SPECIAL.fullmatch(part):
+                tokens.append(self._token_id(part))
+            else:
+                tokens.extend(self._token_id(piece) for piece in _PIECE.findall(part))
+        return tokens
+
+    def detokenize(self, tokens):
+        return ''.join(self._pieces.get(token, '') for token in tokens if token not in (FakeBackend.BOS, FakeBackend.EOS)).encode('utf-8')
+
+    def context_tokens(self):
+        return self._input_ids.tolist()
+
+    def rewind(self, n_tokens):
+        del self._input_ids[n_tokens:]
+        self._generated = 0
+
+    def evaluate(self, tokens):
+        # a single token is a decode step, several are a prompt
+        if len(tokens) == 1 and self.token_latency:
+            time.sleep(self.token_latency)
+        elif len(tokens) > 1 and self.prompt_token_latency:
+            time.sleep(len(tokens) * self.prompt_token_latency)
+        self._input_ids.extend(tokens)
+
+    def sample(self, temperature=0.8, repeat_penalty=1.1, **sampling):
+        # the answer only depends on the context and the seed
+        if self.completion_tokens is not None and self._generated >= self.completion_tokens:
+            return FakeBackend.EOS
+        self._generated += 1
+        state = zlib.crc32(self._input_ids.tobytes(), self._seed & 0xffffffff)
+        return self._words[state % len(self._words)]
+
+    def set_seed(self, seed):
+        self._seed = seed
+
+    def complete(self, prompt, max_tokens=16, temperature=0.8, repeat_penalty=1.1, stop=None, stream=False, seed=None, **sampling):
+        # requests without a seed get the configured one, not the one of the previous request
+        return super().complete(prompt, max_tokens=max_tokens, temperature=temperature, repeat_penalty=repeat_penalty, stop=stop, stream=stream, seed=self.seed if seed is None else seed, **sampling)
+
+    def save_state(self):
+        return FakeState(array.array('i', self._input_ids))
+
+    def load_state(self, state):
+        self._input_ids = array.array('i', state.input_ids)
+        self._generated = 0
@@ -0,0 +1,254 @@
+import time
+import uuid
+import importlib
+
+from communicator.StreamPipeline import Utf8Repair, StopDetector
+
+
+# backends by the name used as `model_config.backend`; a module is only imported once a model uses it
+BACKENDS = {
+    'llama_cpp': 'communicator.LlamaCppBackend:LlamaCppBackend',
+    'fake': 'communicator.FakeBackend:FakeBackend',
+}
+
+
+def register_backend(name, path):
+    """
+    Make the backend class at `path` (`package.module:Class`) available as `model_config.backend: name`.
+    """
+    BACKENDS[name] = path
+
+
+def backend_class(name):
+    """
+    The backend class of `name`, a registered name or the `package.module:Class` path of a backend defined elsewhere.
+    """
+    path = BACKENDS.get(name or 'llama_cpp', name)
+    if ':' not in path:
+        raise ValueError(f"unknown backend: {name}, available: {', '.join(BACKENDS)}")
+
+    module_name, class_name = path.split(':', 1)
+    cls = getattr(importlib.import_module(module_name), class_name)
+    if not issubclass(cls, InferenceBackend):
+        raise TypeError(f"{path} is not an InferenceBackend")
+    return cls
+
+
+class InferenceBackend:
+    """
+    The inference engine behind an `LLMCommunicator`.
+
+    A backend loads the model, owns its tokenizer (`tokenize`, `detokenize`, `token_bos`,
+    `token_eos`, `token_text`) and a context of evaluated tokens (`evaluate`, `rewind`,
+    `context_tokens`, `reset`, `save_state`, `load_state`), and samples the next token from
+    it (`sample`). `complete` is built on top of these; engines with a generation loop of
+    their own (e.g. a server in another process) override it instead. Completions have the
+    shape of `llama_cpp` completions: chunks with `choices[0].text` and `finish_reason`, and
+    full responses which also carry the `usage`.
+
+    The batch engine, the prefix cache and the KV snapshots work on a llama.cpp context
+    directly, they are only used with backends which declare to support them.
+
+    :param options: the `model_config.backend_options` of the model
+    """
+    name = None
+    # the model is a file below `model_root`, which is downloaded and registered
+    uses_model_file = True
+    supports_batching = False
+    supports_prefix_cache = False
+    supports_snapshots = False
+    # the thread counts and batch sizes change the speed of the backend, see `AutoTuner`
+    supports_tuning = False
+
+    def __init__(self, model_path, n_ctx=2048, n_threads=None, n_threads_batch=None, n_batch=512, n_ubatch=None, n_gpu_layers=0, use_mmap=True, use_mlock=False, prefetch='none', **options):
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.n_threads = n_threads
+        self.n_threads_batch = n_threads_batch
+        self.n_batch = n_batch
+        self.n_ubatch = n_ubatch
+        self.n_gpu_layers = n_gpu_layers
+        self.use_mmap = use_mmap
+        self.use_mlock = use_mlock
+        self.prefetch = prefetch
+        self.options = options
+        self._prompt_eval_seconds = 0.0
+
+    def load(self):
+        """
+        Load the model.
+
+        :return: the seconds spent in each loading phase, e.g. `{'file_open': 0.1, 'tensor_mapping': 1.2}`
+        """
+        raise NotImplementedError
+
+    def unload(self):
+        pass
+
+    def tokenize(self, text, add_bos=True, special=False):
+        """
+        The token ids of the UTF-8 bytes `text`.
+
+        :param special: parse special tokens like `</s>` in `text` instead of tokenizing them as text
+        """
+        raise NotImplementedError
+
+    def detokenize(self, tokens):
+        """
+        The UTF-8 bytes of `tokens`, a piece of a multi-byte character may be cut off at the end.
+        """
+        raise NotImplementedError
+
+    def token_bos(self):
+        raise NotImplementedError
+
+    def token_eos(self):
+        raise NotImplementedError
+
+    def token_text(self, token):
+        """
+        The text of `token` in the vocabulary, e.g. `<s>` for BOS.
+        """
+        raise NotImplementedError
+
+    def context_tokens(self):
+        """
+        The token ids evaluated in the context.
+        """
+        raise NotImplementedError
+
+    def reset(self):
+        self.rewind(0)
+
+    def rewind(self, n_tokens):
+        """
+        Keep only the first `n_tokens` tokens of the context.
+        """
+        raise NotImplementedError
+
+    def evaluate(self, tokens):
+        """
+        Evaluate `tokens` following the tokens already in the context.
+        """
+        raise NotImplementedError
+
+    def sample(self, temperature=0.8, repeat_penalty=1.1, **sampling):
+        """
+        The next token after the context, `sampling` holds the further `LLMCommunicator.SAMPLING_PARAMS` but `seed`.
+        """
+        raise NotImplementedError
+
+    def set_seed(self, seed):
+        pass
+
+    def set_threads(self, n_threads, n_threads_batch):
+        """
+        Decode with `n_threads` and evaluate prompts with `n_threads_batch` threads from now on.
+        """
+        raise NotImplementedError
+
+    def save_state(self):
+        raise NotImplementedError
+
+    def load_state(self, state):
+        raise NotImplementedError
+
+    def set_cache(self, cache):
+        pass
+
+    def prompt_eval_ms(self):
+        """
+        The milliseconds spent evaluating prompts since the model was loaded, or None when not known.
+        """
+        return self._prompt_eval_seconds * 1000
+
+    def complete(self, prompt, max_tokens=16, temperature=0.8, repeat_penalty=1.1, stop=None, stream=False, seed=None, **sampling):
+        """
+        Complete the token ids `prompt`.
+
+        :param stop: stop sequences, the completion ends before the first one of them
+        :return: the completion, or an iterator over its chunks when `stream` is True
+        """
+        chunks = self._generate(list(prompt), max_tokens, temperature, repeat_penalty, stop, seed, sampling)
+        if stream:
+            return chunks
+
+        text = ''
+        finish_reason = None
+        for chunk in chunks:
+            text += chunk['choices'][0]['text']
+            finish_reason = chunk['choices'][0]['finish_reason'] or finish_reason
+            usage = chunk.get('usage')
+        response = self._chunk(chunk['id'], text, finish_reason)
+        response['usage'] = usage
+        return response
+
+    def _chunk(self, completion_id, text, finish_reason=None):
+        return {
+            'id': completion_id,
+            'object': 'text_completion',
+            'created': int(time.time()),
+            'model': self.model_path,
+            'choices': [{
+                'text': text,
+                'index': 0,
+                'logprobs': None,
+                'finish_reason': finish_reason
+            }]
+        }
+
+    def _generate(self, prompt, max_tokens, temperature, repeat_penalty, stop, seed, sampling):
+        completion_id = f"cmpl-{uuid.uuid4()}"
+        if max_tokens is None or max_tokens <= 0:
+            max_tokens = self.n_ctx
+        max_tokens = min(max_tokens, self.n_ctx - len(prompt))
+        if seed is not None:
+            self.set_seed(seed)
+
+        # tokens the context already starts with are not evaluated again, but the last
+        # prompt token always is, the first completion token is sampled from its logits
+        shared = 0
+        for old, new in zip(self.context_tokens(), prompt[:-1]):
+            if old != new:
+                break
+            shared += 1
+        start = time.perf_counter()
+        self.rewind(shared)
+        self.evaluate(prompt[shared:])
+        self._prompt_eval_seconds += time.perf_counter() - start
+
+        utf8 = Utf8Repair()
+        stop_detector = StopDetector(stop)
+        eos = self.token_eos()
+        completion_tokens = 0
+        finish_reason = 'length'
+        stopped = False
+        for _ in range(max(0, max_tokens)):
+            token = self.sample(temperature=temperature, repeat_penalty=repeat_penalty, **sampling)
+            if token == eos:
+                finish_reason = 'stop'
+                break
+
+            completion_tokens += 1
+            text, stopped = stop_detector.feed(utf8.feed(self.detokenize([token])))
+            if text:
+                yield self._chunk(completion_id, text)
+            if stopped:
+                finish_reason = 'stop'
+                break
+            self.evaluate([token])
+
+        if not stopped:
+            text, stopped = stop_detector.feed(utf8.flush())
+            if not stopped:
+                text += stop_detector.flush()
+            if text:
+                yield self._chunk(completion_id, text)
+
+        chunk = self._chunk(completion_id, '', finish_reason)
+        chunk['usage'] = {
+            'prompt_tokens': len(prompt),
+            'completion_tokens': completion_tokens,
+            'total_tokens': len(prompt) + completion_tokens,
+        }
+        yield chunk
@@ -1,27 +1,54 @@
+import os
+import time
+import asyncio
+import functools
 import threading
-
-from llama_cpp import Llama
+from concurrent.futures import ThreadPoolExecutor
 
 from util.ConfigLoader import ConfigLoader
 from util.Utilities import detect_os, convert_path, load_file_content
+from util.Metrics import Metrics
+from util.Tracer import UNTRACED
+from util.HostProbe import physical_cores
 from loader.HFLoader import load_model
+from loader.ModelRegistry import ModelRegistry
+from communicator.RequestScheduler import RequestScheduler
+from communicator.AsyncTokenStream import AsyncTokenStream
+from communicator.ModelPool import ModelPool
+from communicator.ServerReadiness import ServerReadiness
+from communicator.PromptBuilder import PromptBuilder
+from communicator.ContextWindow import ContextWindow, InvalidRequestError
+from communicator.InferenceBackend import backend_class
+from communicator.AutoTuner import AutoTuner
 
 class LLMCommunicator:
+    # sampling parameters of a request which are passed on to the backend as they are
+    SAMPLING_PARAMS = ('top_p', 'top_k', 'min_p', 'presence_penalty', 'frequency_penalty', 'seed')
+
     _lock = threading.Lock()
-    _instance = None
+    _pool = None
     
-    def __init__(self):
-        self.initialize()
+    def __init__(self, model_name=None):
+        self.initialize(model_name)
+        
+    def initialize(self, model_name=None):
+        config = ConfigLoader().get()
+        if model_name is not None and model_name != config['model']:
+            config = ConfigLoader().get_model_config(model_name)
         
-    def initialize(self):
-        # load model
-        load_model()
+        # load model, unless the backend needs no model file (e.g. `fake`)
+        backend = backend_class(config['model_config'].get('backend', 'llama_cpp'))
+        model_path = f"{convert_path(config['model_root'])}/{config['model_config']['hf_id']}/{config['model_config']['hf_file']}"
+        if backend.uses_model_file and not os.path.exists(model_path):
+            ServerReadiness.get().report(config['model'], ServerReadiness.DOWNLOADING)
+        if backend.uses_model_file:
+            load_model(model_config=config['model_config'])
         
         # initialize
         print(f"=== ===  === ===  === ===\t\t INIT LLM \t\t=== ===  === ===  === ===")
-        self.config = ConfigLoader().get()
+        self.config = config
+        self.model_name = config['model']
         
-        config = ConfigLoader().get()
         model_config = config['model_config']
         debug_mode = config['debug_mode']
         
@@ -32,10 +59,47 @@ class LLMCommunicator:
         self._debug_mode = debug_mode
         self._model_path = f"{convert_path(config['model_root'])}/{config['model_config']['hf_id']}/{config['model_config']['hf_file']}"
         self._n_threads = model_config['n_threads']
+        self._n_threads_batch = model_config.get('n_threads_batch')
         self._n_batch = model_config['n_batch']
+        self._n_ubatch = model_config.get('n_ubatch')
         self._n_gpu_layers = (model_config['n_gpu_layers'] if config['use_gpu'] else 0)
         self._n_ctx = model_config['n_ctx']
         self._verbose = model_config['verbose']
+        self._use_mmap = model_config.get('use_mmap', True)
+        self._use_mlock = model_config.get('use_mlock', False)
+        self._prefetch = model_config.get('prefetch', 'none')
+        self._warmup = model_config.get('warmup', False)
+        self._warmup_tokens = model_config.get('warmup_tokens', 4)
+        self._backend_class = backend
+        self._backend_options = model_config.get('backend_options', {}) or {}
+
+        # `n_threads: auto` tunes this model only; without tuning, all physical cores are used
+        autotune_config = config.get('autotune', {})
+        self._autotune_config = autotune_config
+        self._autotune = (autotune_config.get('enabled', False) or self._n_threads == 'auto') and backend.supports_tuning
+        self._autotune_root = f"{convert_path(config['model_root'])}/.autotune"
+        self._autotune_share = config.get('workers', {}).get('processes', 0) or 1
+        if self._n_threads == 'auto':
+            self._n_threads = max(1, physical_cores() // self._autotune_share)
+        self.tuning_profile = None
+
+        # the batch engine, the prefix cache and the KV snapshots work on the llama.cpp context itself
+        batching_config = config.get('batching', {})
+        self._batching = batching_config.get('enabled', False) and backend.supports_batching
+        self._n_parallel = batching_config.get('n_parallel', 4) if self._batching else 1
+
+        prefix_cache_config = config.get('prefix_cache', {})
+        self._prefix_cache_enabled = prefix_cache_config.get('enabled', False) and not self._batching and backend.supports_prefix_cache
+        self._prefix_cache_capacity = int(prefix_cache_config.get('capacity_mb', 2048)) * 1024 * 1024
+        self._prefix_cache_min_match = prefix_cache_config.get('min_match_tokens', 16)
+
+        self._context_config = config.get('context', {})
+
+        kv_snapshots_config = config.get('kv_snapshots', {})
+        self._kv_snapshots_enabled = kv_snapshots_config.get('enabled', False) and not self._batching and backend.supports_snapshots
+        self._kv_snapshots_root = f"{convert_path(config['model_root'])}/.kv_snapshots"
+        self._kv_snapshots_max_size = int(kv_snapshots_config.get('max_size_mb', 4096)) * 1024 * 1024
+        self._kv_snapshots_min_tokens = kv_snapshots_config.get('min_prefix_tokens', 64)
 
         # fix "_model_path" for Windows
         if detect_os() == 'windows':
@@ -59,10 +123,23 @@ class LLMCommunicator:
             print(f"hf_id \t\t\t = {hf_id}")
             print(f"hf_file \t\t = {hf_file}")
             print(f"n_threads \t\t = {self._n_threads}")
+            print(f"n_threads_batch \t = {self._n_threads_batch}")
             print(f"n_batch \t\t = {self._n_batch}")
+            print(f"n_ubatch \t\t = {self._n_ubatch}")
+            print(f"autotune \t\t = {self._autotune}")
             print(f"n_gpu_layers \t\t = {self._n_gpu_layers}")
             print(f"n_ctx \t\t\t = {self._n_ctx}")
             print(f"verbose \t\t = {self._verbose}")
+            print(f"use_mmap \t\t = {self._use_mmap}")
+            print(f"use_mlock \t\t = {self._use_mlock}")
+            print(f"prefetch \t\t = {self._prefetch}")
+            print(f"warmup \t\t\t = {self._warmup}")
+            print(f"warmup_tokens \t\t = {self._warmup_tokens}")
+            print(f"backend \t\t = {backend.name or backend.__name__}")
+            print(f"batching \t\t = {self._batching}")
+            print(f"n_parallel \t\t = {self._n_parallel}")
+            print(f"prefix_cache \t\t = {self._prefix_cache_enabled}")
+            print(f"kv_snapshots \t\t = {self._kv_snapshots_enabled}")
             print(f"target_model_path \t = {self._model_path}")
             print(f"system_prompt                             = {self.system_prompt}")
             print(f"system_prompt_start_token                 = {self.system_prompt_start_token}")
@@ -77,7 +154,15 @@ class LLMCommunicator:
             print(f"assistant_followup_prompt_end_token       = {self.assistant_followup_prompt_end_token}")
             print(f"end_tokens                                = {self.end_tokens}")
         
-        self._llm = None
+        self._backend = None
+        self._engine = None
+        self.load_timings = {}
+        self.prefix_cache = None
+        self.snapshot_store = None
+        self.context_window = None
+        self.scheduler = RequestScheduler(config.get('scheduler'), slots=self._n_parallel, name=self.model_name)
+        self._metrics = Metrics.get()
+        self._executor = ThreadPoolExecutor(max_workers=self.scheduler.slots, thread_name_prefix='llm-inference')
 
         # load templates
         self._sys_template = None
@@ -93,153 +178,538 @@ class LLMCommunicator:
             print(f"sys_template \t\t = {self._sys_template}")
             print(f"user_template \t\t = {self._user_template}")
 
+        self._prompt_builder = PromptBuilder(model_config, sys_template=self._sys_template, user_template=self._user_template)
+
     def load_model(self):
-        self._llm = Llama(
-            model_path=self._model_path,
-            n_threads=self._n_threads,
-            n_batch=self._n_batch,
-            n_gpu_layers=self._n_gpu_layers,
-            n_ctx=self._n_ctx,
+        timings = {}
+        ServerReadiness.get().report(self.model_name, ServerReadiness.LOADING)
+
+        # thread counts and batch sizes of this host, measured once per model and host
+        if self._autotune:
+            start = time.perf_counter()
+            self._apply_tuning()
+            timings['autotune'] = time.perf_counter() - start
+
+        self._backend = self._create_backend()
+        timings.update(self._backend.load())
+        self._prompt_builder.attach(self._backend)
+
+        # with batching, `n_ctx` is shared by all parallel sequences
+        self.context_window = ContextWindow(
+            self._n_ctx // self._n_parallel,
+            # counted like a request, summary requests get the system message of the model as well
+            count_tokens=lambda messages: len(self._prompt_builder.tokens(self._prompt_builder.messages(messages))),
+            context_config=self._context_config,
+            summarize=self._summarize_messages
         )
+
+        # a loaded model file is never evicted from `model_root`
+        if self._backend.uses_model_file:
+            ModelRegistry.get().acquire(self._model_path)
+
+        # first-token warmup: a short generation faults in the weights and builds the compute graphs
+        if self._warmup:
+            ServerReadiness.get().report(self.model_name, ServerReadiness.WARMING_UP)
+            start = time.perf_counter()
+            self.warm_up(max_tokens=self._warmup_tokens)
+            timings['warmup'] = time.perf_counter() - start
+
+        self.load_timings = timings
+        for phase, seconds in timings.items():
+            self._metrics.model_load.labels(self.model_name, phase).observe(seconds)
+        print(f"model {self.model_name} loaded in {sum(timings.values()):.2f}s (" + ", ".join(f"{phase}: {seconds:.2f}s" for phase, seconds in timings.items()) + ")")
+
+        # keep the KV state of recent prompts so follow-up turns only evaluate the new suffix
+        # these work on the llama.cpp context, they are only imported for backends which support them
+        if self._prefix_cache_enabled:
+            from communicator.PrefixCache import PrefixCache
+            self.prefix_cache = PrefixCache(capacity_bytes=self._prefix_cache_capacity, min_match_tokens=self._prefix_cache_min_match)
+            self._backend.set_cache(self.prefix_cache)
+
+        # evaluated system prompts survive restarts and model switches on disk
+        if self._kv_snapshots_enabled:
+            from communicator.StateSnapshotStore import StateSnapshotStore
+            self.snapshot_store = StateSnapshotStore(
+                self._kv_snapshots_root,
+                self._model_path,
+                self._n_ctx,
+                max_size_bytes=self._kv_snapshots_max_size,
+                min_prefix_tokens=self._kv_snapshots_min_tokens
+            )
+
+        # with batching enabled the engine becomes the only user of the context,
+        # `n_ctx` is then shared by up to `n_parallel` sequences
+        if self._batching:
+            from communicator.BatchEngine import BatchEngine
+            self._engine = BatchEngine(
+                self._backend.llm,
+                n_parallel=self._n_parallel,
+                n_batch=self._n_batch,
+                model=self._model_path
+            )
+
+        ServerReadiness.get().report(self.model_name, ServerReadiness.READY)
         
+    def _create_backend(self, **settings):
+        params = {
+            'n_ctx': self._n_ctx,
+            'n_threads': self._n_threads,
+            'n_threads_batch': self._n_threads_batch,
+            'n_batch': self._n_batch,
+            'n_ubatch': self._n_ubatch,
+            'n_gpu_layers': self._n_gpu_layers,
+            'use_mmap': self._use_mmap,
+            'use_mlock': self._use_mlock,
+            'prefetch': self._prefetch,
+        }
+        params.update(settings)
+        return self._backend_class(self._model_path, **params, **self._backend_options)
+
+    def _apply_tuning(self):
+        # a failed tuning leaves the configured settings, the model is served anyway
+        try:
+            tuner = AutoTuner(
+                self._autotune_root,
+                self._model_path,
+                autotune_config=self._autotune_config,
+                share=self._autotune_share,
+                n_gpu_layers=self._n_gpu_layers,
+                n_ctx=self._n_ctx
+            )
+            profile = tuner.load()
+            if profile is None:
+                print(f"tuning {self.model_name} for this host, this runs once ...")
+                profile = tuner.tune(self._create_backend, n_batch=self._n_batch, n_ubatch=self._n_ubatch)
+                tuner.save(profile)
+        except Exception as e:
+            print(f"failed to tune {self.model_name}: {e}")
+            return
+
+        settings = profile['settings']
+        self._n_threads = settings['n_threads']
+        self._n_threads_batch = settings['n_threads_batch']
+        self._n_batch = settings['n_batch']
+        self._n_ubatch = settings['n_ubatch']
+        self.tuning_profile = profile
+        print(f"tuned {self.model_name}: " + ", ".join(f"{key}: {value}" for key, value in settings.items()) +
+              f" ({profile['prompt_tokens_per_second']:.1f} prompt tokens/s, {profile['decode_tokens_per_second']:.1f} tokens/s, {tuner.profile_path})")
+
+    def warm_up(self, max_tokens=4):
+        # evaluating a prompt and decoding a few tokens runs both the batched and the single-token graph
+        prompt = self._prompt_builder.tokens([{'role': 'user', 'content': 'Hello'}])
+        for _ in self._backend.complete(prompt, max_tokens=max_tokens, temperature=0.0, stream=True):
+            pass
+        self._backend.reset()
+
     def offload_model(self):
-        del self._llm
-        self._llm = None
+        if self._engine is not None:
+            self._engine.stop()
+            self._engine = None
+        self._backend.unload()
+        if self._backend.uses_model_file:
+            ModelRegistry.get().release(self._model_path)
+        self._backend = None
+        self.prefix_cache = None
+        self.snapshot_store = None
 
-    def _full_complete(self, prompt, max_tokens=8196, temperature=0.0, repeat_penalty=1.1, echo=True):
-        stop = self.end_tokens
-        
-        if self._verbose and self._debug_mode: 
-            print(f"prompt\t\t= {prompt}")
-            print(f"stop\t\t= '{stop}'")
+    def _restore_prefix_snapshot(self, messages):
+        # only the system message is shared between conversations, so only it is snapshotted
+        if self.snapshot_store is None or len(messages) < 1 or messages[0].get('role') != 'system':
+            return
+
+        tokens = self._prompt_builder.tokens(messages[:1])
+        if len(tokens) < self.snapshot_store.min_prefix_tokens:
+            return
+
+        # the context already starts with this prefix, the backend will reuse it on its own
+        if self._backend.context_tokens()[:len(tokens)] == tokens:
+            return
+
+        state = self.snapshot_store.load(tokens)
+        if state is not None:
+            self._backend.load_state(state)
+            return
+
+        # evaluate the prefix once, the completion continues from it and the state goes to disk
+        self._backend.reset()
+        self._backend.evaluate(tokens)
+        self.snapshot_store.save(tokens, self._backend.save_state())
+
+    @staticmethod
+    def _sampling_kwargs(sampling):
+        return {key: value for key, value in (sampling or {}).items() if key in LLMCommunicator.SAMPLING_PARAMS and value is not None}
+
+    def _stop(self, stop):
+        # the end tokens of the model always stop a completion, `stop` adds the ones of the request
+        if isinstance(stop, str):
+            stop = [stop]
+        return list(self.end_tokens) + [s for s in (stop or []) if s]
+
+    def _trace_request(self, trace, prompt, stop, sampling):
+        # the prompt is only turned back into text for traces which are kept
+        trace.set('llm.stop', stop)
+        trace.set('llm.sampling', sampling)
+        if self._verbose and trace.sampled:
+            trace.set('llm.prompt', self._prompt_text(prompt))
+
+    def _full_complete(self, prompt, max_tokens=8196, temperature=0.0, repeat_penalty=1.1, echo=True, sampling=None, stop=None, trace=UNTRACED):
+        stop = self._stop(stop)
+        sampling = self._sampling_kwargs(sampling)
+        self._trace_request(trace, prompt, stop, sampling)
         
-        response = self._llm(
-            prompt=prompt,
-            max_tokens=self._n_ctx,
-            temperature=temperature,
-            repeat_penalty=repeat_penalty,
-            stop=stop,
-            echo=echo
-        )
+        if self._engine is not None:
+            sequence = self._engine.submit(prompt, max_tokens=max_tokens, temperature=temperature, repeat_penalty=repeat_penalty, stop=stop, echo=echo, **sampling)
+            text = "".join(chunk['choices'][0]['text'] for chunk in sequence)
+            finish_reason = sequence.finish_reason
+            completion_tokens = len(sequence.completion_tokens)
+        else:
+            response = self._backend.complete(
+                prompt,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                repeat_penalty=repeat_penalty,
+                stop=stop,
+                **sampling
+            )
+            text = response['choices'][0]['text']
+            finish_reason = response['choices'][0].get('finish_reason')
+            completion_tokens = response.get('usage', {}).get('completion_tokens', 0)
+            # the prompt is given as token ids, its text is added here
+            if echo:
+                text = self._prompt_text(prompt) + text
         
-        response_text = response.get("choices", [{}])[0].get("text", "").strip()
+        response_text = text.strip()
         
-        if self._verbose and self._debug_mode: 
-            print(f"response\t= {response_text}")
+        if self._verbose and trace.sampled:
+            trace.set('llm.response', response_text)
         
-        return response_text
+        return response_text, finish_reason, completion_tokens
 
-    def _stream_complete(self, prompt, max_tokens=8196, temperature=0.0, repeat_penalty=1.1, echo=True):
-        stop = self.end_tokens
+    def _stream_complete(self, prompt, max_tokens=8196, temperature=0.0, repeat_penalty=1.1, echo=True, sampling=None, stop=None, trace=UNTRACED):
+        stop = self._stop(stop)
+        sampling = self._sampling_kwargs(sampling)
+        self._trace_request(trace, prompt, stop, sampling)
         
-        if self._verbose and self._debug_mode: 
-            print(f"streaming mode")
-            print(f"prompt\t\t= {prompt}")
-            print(f"stop\t\t= '{stop}'")
+        if self._engine is not None:
+            return self._engine.submit(prompt, max_tokens=max_tokens, temperature=temperature, repeat_penalty=repeat_penalty, stop=stop, echo=echo, **sampling)
         
-        response_stream = self._llm.create_completion(
-            prompt=prompt,
-            max_tokens=self._n_ctx,
+        response_stream = self._backend.complete(
+            prompt,
+            max_tokens=max_tokens,
             temperature=temperature,
             repeat_penalty=repeat_penalty,
             stop=stop,
-            echo=echo,
-            stream=True
+            stream=True,
+            **sampling
         )
         
+        if echo:
+            return self._echo_stream(prompt, response_stream)
         return response_stream
 
-    def complete_messages(self, messages, max_tokens=8196, temperature=0.0, repeat_penalty=1.1, echo=True, stream=False):
-        with LLMCommunicator._lock:
-            prompt = self.get_prompt(messages)
+    def _prompt_text(self, prompt):
+        if isinstance(prompt, str):
+            return prompt
+        return self._backend.detokenize(prompt).decode('utf-8', errors='ignore')
+
+    def _echo_stream(self, prompt, response_stream):
+        try:
+            first = True
+            for chunk in response_stream:
+                if first:
+                    chunk['choices'][0]['text'] = self._prompt_text(prompt) + chunk['choices'][0]['text']
+                    first = False
+                yield chunk
+        finally:
+            response_stream.close()
+
+    def _usage_stream(self, response_stream, usage, echo_text=''):
+        # the last chunk carries the usage of the whole completion, like the OpenAI `stream_options.include_usage`
+        text = ""
+        finish_reason = None
+        backend_usage = None
+        try:
+            for chunk in response_stream:
+                text += chunk['choices'][0]['text']
+                finish_reason = chunk['choices'][0].get('finish_reason') or finish_reason
+                backend_usage = chunk.get('usage') or backend_usage
+                yield chunk
+        finally:
+            response_stream.close()
+
+        if self._engine is not None:
+            # a `BatchSequence` knows its tokens
+            completion_tokens = len(response_stream.completion_tokens)
+        elif backend_usage is not None:
+            completion_tokens = backend_usage['completion_tokens']
+        else:
+            # a `Llama` stream has no usage and holds text back around stop sequences and multi-byte
+            # characters, so its chunks are not its tokens; the completion text is counted instead
+            text = text[len(echo_text):]
+            completion_tokens = len(self._backend.tokenize(text.encode('utf-8'), add_bos=False, special=True)) if text else 0
+        usage['completion_tokens'] = completion_tokens
+        usage['total_tokens'] = usage['prompt_tokens'] + completion_tokens
+        yield {
+            'choices': [{
+                'text': '',
+                'index': 0,
+                'logprobs': None,
+                'finish_reason': finish_reason
+            }],
+            'usage': usage
+        }
+
+    def _prompt_eval_ms(self):
+        # the backend adds up its prompt evaluation time; the batch engine shares the
+        # context between sequences, so the time of one completion is not known there
+        if self._engine is not None:
+            return None
+        return self._backend.prompt_eval_ms()
 
-            if stream:
-                response = self._stream_complete(prompt, max_tokens=max_tokens, temperature=temperature, repeat_penalty=repeat_penalty, echo=echo)
-                return response
+    def _observe_prompt_eval(self, labels, prompt_eval_ms):
+        """
+        Record the prompt evaluation time since `_prompt_eval_ms` returned `prompt_eval_ms`.
+
+        :return: the seconds spent, or None when they are not known
+        """
+        if prompt_eval_ms is None:
+            return None
+        now_ms = self._prompt_eval_ms()
+        if now_ms is None:
+            return None
+        seconds = max(0.0, now_ms - prompt_eval_ms) / 1000
+        self._metrics.prompt_eval.labels(*labels).observe(seconds)
+        return seconds
+
+    def _metered_stream(self, response_stream, labels, prompt_eval_ms=None, trace=UNTRACED):
+        # one clock read and one histogram update per token
+        metrics = self._metrics
+        inter_token = metrics.inter_token.labels(*labels)
+        start = time.perf_counter()
+        first = last = None
+        tokens = 0
+        usage = None
+        finish_reason = None
+        try:
+            for chunk in response_stream:
+                if chunk['choices'][0]['text']:
+                    now = time.perf_counter()
+                    if first is None:
+                        first = now
+                        metrics.time_to_first_token.labels(*labels).observe(now - start)
+                    else:
+                        inter_token.observe(now - last)
+                    last = now
+                    tokens += 1
+                finish_reason = chunk['choices'][0].get('finish_reason') or finish_reason
+                usage = chunk.get('usage') or usage
+                yield chunk
+        finally:
+            response_stream.close()
+
+            end = time.perf_counter()
+            if usage is not None:
+                tokens = usage['completion_tokens']
+            prompt_eval = self._observe_prompt_eval(labels, prompt_eval_ms)
+            metrics.completion_duration.labels(*labels).observe(end - start)
+            metrics.completion_tokens.labels(*labels).observe(tokens)
+            metrics.completions.labels(*labels, finish_reason or 'cancelled').inc()
+            if first is not None and tokens > 1 and last > first:
+                metrics.tokens_per_second.labels(*labels).observe((tokens - 1) / (last - first))
+
+            # the first token comes right after the prompt is evaluated
+            if first is not None:
+                trace.add_span('prompt_eval', start, first, llama_prompt_eval_seconds=prompt_eval)
+                trace.add_span('decode', first, end, tokens=tokens, finish_reason=finish_reason)
             else:
-                response = self._full_complete(prompt, max_tokens=max_tokens, temperature=temperature, repeat_penalty=repeat_penalty, echo=echo)
-                return response
+                trace.add_span('prompt_eval', start, end, llama_prompt_eval_seconds=prompt_eval, finish_reason=finish_reason)
+
+    def _summarize_messages(self, messages):
+        # `messages` is a summary request of the context window, which fits into the context
+        return self.complete_messages(
+            messages,
+            max_tokens=self.context_window.summary_max_tokens,
+            temperature=0.0,
+            echo=False,
+            priority=-1,
+            frontend='summarizer'
+        )
+
+    def _prepare(self, messages, max_tokens, trace=UNTRACED):
+        with trace.span('prompt_build') as span:
+            messages = self._prompt_builder.messages(messages)
+            messages, max_tokens, context = self.context_window.fit(messages, max_tokens)
+            span.set('messages', len(messages))
+        with trace.span('tokenize') as span:
+            prompt = self._prompt_builder.tokens(messages)
+            span.set('tokens', len(prompt))
+        if self.snapshot_store is not None:
+            with trace.span('snapshot_restore'):
+                self._restore_prefix_snapshot(messages)
+
+        usage = {
+            'prompt_tokens': len(prompt),
+            'completion_tokens': 0,
+            'total_tokens': len(prompt),
+            'context': context,
+        }
+        return prompt, max_tokens, usage
+
+    def complete_messages(self, messages, max_tokens=8196, temperature=0.0, repeat_penalty=1.1, echo=True, stream=False, ticket=None, priority=0, frontend='http', details=False, sampling=None, stop=None, n=1, trace=None):
+        """
+        Complete a conversation.
+
+        :param details: return the choices and the usage (including the decisions of the context window) instead of the text only;
+            a stream then ends with a chunk carrying the usage
+        :param sampling: further sampling parameters (`SAMPLING_PARAMS`), None values keep the llama.cpp defaults
+        :param stop: stop sequences in addition to the end tokens of the model
+        :param n: number of choices to generate, only for completions which are not streamed
+        :param trace: the `Trace` of the request, its caller finishes it
+        """
+        if trace is None:
+            trace = UNTRACED
+
+        # callers may pass a ticket they already waited for (e.g. to watch for client disconnects)
+        if ticket is None:
+            ticket = self.scheduler.acquire(priority=priority, frontend=frontend)
+
+        # the slot is given back if anything fails before the completion owns the ticket
+        try:
+            labels = (self.model_name, ticket.frontend)
+            now = time.perf_counter()
+            trace.add_span('queue', now - ticket.queue_wait, now, model=self.model_name)
+        except BaseException:
+            ticket.release()
+            raise
+
+        if not stream:
+            with ticket:
+                prompt, max_tokens, usage = self._prepare(messages, max_tokens, trace=trace)
+                self._metrics.prompt_tokens.labels(*labels).observe(usage['prompt_tokens'])
+                prompt_eval_ms = self._prompt_eval_ms()
+                start = time.perf_counter()
+
+                choices = []
+                for index in range(n if details else 1):
+                    choice_sampling = dict(sampling or {})
+                    # every choice gets its own seed, otherwise all of them would be the same
+                    if choice_sampling.get('seed') is not None:
+                        choice_sampling['seed'] += index
+                    response, finish_reason, completion_tokens = self._full_complete(prompt, max_tokens=max_tokens, temperature=temperature, repeat_penalty=repeat_penalty, echo=echo, sampling=choice_sampling, stop=stop, trace=trace)
+                    choices.append({'text': response, 'index': index, 'finish_reason': finish_reason})
+                    usage['completion_tokens'] += completion_tokens
+                    self._metrics.completions.labels(*labels, finish_reason or 'unknown').inc()
+
+                end = time.perf_counter()
+                duration = end - start
+                prompt_eval = self._observe_prompt_eval(labels, prompt_eval_ms)
+                decode_time = duration - (prompt_eval or 0.0)
+                self._metrics.completion_duration.labels(*labels).observe(duration)
+                self._metrics.completion_tokens.labels(*labels).observe(usage['completion_tokens'])
+                if usage['completion_tokens'] and decode_time > 0:
+                    self._metrics.tokens_per_second.labels(*labels).observe(usage['completion_tokens'] / decode_time)
+
+                # llama.cpp evaluates the prompt before it decodes, the batch engine does not tell the two apart
+                if prompt_eval is not None:
+                    trace.add_span('prompt_eval', start, start + prompt_eval, tokens=usage['prompt_tokens'])
+                    trace.add_span('decode', start + prompt_eval, end, tokens=usage['completion_tokens'], choices=len(choices))
+                else:
+                    trace.add_span('generate', start, end, prompt_tokens=usage['prompt_tokens'], completion_tokens=usage['completion_tokens'], choices=len(choices))
+
+                if not details:
+                    return choices[0]['text']
+
+                usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+                return {
+                    'choices': choices,
+                    'usage': usage
+                }
+
+        # a stream keeps the model until it is exhausted, closed or abandoned
+        try:
+            if n != 1:
+                raise InvalidRequestError("only one choice can be streamed")
+            prompt, max_tokens, usage = self._prepare(messages, max_tokens, trace=trace)
+            self._metrics.prompt_tokens.labels(*labels).observe(usage['prompt_tokens'])
+            prompt_eval_ms = self._prompt_eval_ms()
+            response_stream = self._stream_complete(prompt, max_tokens=max_tokens, temperature=temperature, repeat_penalty=repeat_penalty, echo=echo, sampling=sampling, stop=stop, trace=trace)
+            if details:
+                response_stream = self._usage_stream(response_stream, usage, echo_text=(self._prompt_text(prompt) if echo else ''))
+            response_stream = self._metered_stream(response_stream, labels, prompt_eval_ms, trace=trace)
+        except BaseException:
+            ticket.release()
+            raise
+
+        return self.scheduler.lease(response_stream, ticket)
     
+    async def acomplete_messages(self, messages, max_tokens=8196, temperature=0.0, repeat_penalty=1.1, echo=True, stream=False, ticket=None, priority=0, frontend='http', details=False, sampling=None, stop=None, n=1, trace=None):
+        """
+        Async version of `complete_messages`, inference runs on the dedicated worker thread.
+
+        :return: the completion text, or an `AsyncTokenStream` of completion chunks when `stream` is True
+        """
+        if ticket is None:
+            ticket = self.scheduler.submit(priority=priority, frontend=frontend)
+            await ticket.wait_async()
+
+        complete = functools.partial(
+            self.complete_messages,
+            messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            repeat_penalty=repeat_penalty,
+            echo=echo,
+            stream=stream,
+            ticket=ticket,
+            details=details,
+            sampling=sampling,
+            stop=stop,
+            n=n,
+            trace=trace
+        )
+
+        if stream:
+            return AsyncTokenStream(complete, self._executor)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, complete)
+
     def get_prompt(self, messages):
-        prompt = ''
-        
-        if len(messages) < 1:
-            raise "messages list is empty"
-            
-        current_message = messages[0]
-        current_role = current_message.get('role', 'user')
-        current_content = current_message.get('content', '').strip()
-        
-        if self.system_prompt and current_role != "system":
-            if self._sys_template is None:
-                messages.insert(0, {
-                    "role": "system", 
-                    "content": ""
-                })
-            else:
-                messages.insert(0, {
-                    "role": "system", 
-                    "content": self._sys_template
-                })
-            
-        # print(messages)
-        
-        is_first_user_prompt = True
-        is_first_assistant_prompt = True
-        
-        for i in range(len(messages)):
-            current_message = messages[i]
-            # print(current_message)
-            current_role = current_message.get('role', 'user')
-            current_content = current_message.get('content', '').strip()
-            
-            if current_role == 'system':
-                if i == 0:
-                    prompt += f"{self.system_prompt_start_token}{current_content}{self.system_prompt_end_token}"
-                else:
-                    raise "system prompt can only be set at the beginning"
-                    
-                # print(f"(seen: system) prompt = {prompt}")
-            elif current_role == 'user':
-                if is_first_user_prompt:
-                    if self._user_template is None:
-                        prompt += f"{self.user_prompt_start_token}{current_content}{self.user_prompt_end_token}"
-                    else:
-                        prompt += f"{self.user_prompt_start_token}{self._user_template.replace('{prompt}', current_content)}{self.user_prompt_end_token}"
-                    is_first_user_prompt = False
-                else:
-                    prompt += f"{self.user_followup_prompt_start_token}{current_content}{self.user_followup_prompt_end_token}"
-                    
-                # print(f"(seen: user) prompt = {prompt}")
-            elif current_role == 'assistant':
-                if is_first_assistant_prompt:
-                    prompt += f"{self.assistant_prompt_start_token}{current_content}{self.assistant_prompt_end_token}"
-                    is_first_assistant_prompt = False
-                else:
-                    prompt += f"{self.assistant_followup_prompt_start_token}{current_content}{self.assistant_followup_prompt_end_token}"
-                    
-                # print(f"(seen: assistant) prompt = {prompt}")
-            else:
-                raise f"unknow role: {current_role}"
-                    
-        return prompt
+        """
+        The prompt text of `messages`, `messages` is not modified.
+        """
+        return self._prompt_builder.text(messages)
 
     def is_system_prompt_supported(self):
         return self.system_prompt
     
     @staticmethod
-    def get():
-        with LLMCommunicator._lock:
-            if LLMCommunicator._instance is None:
-                LLMCommunicator._instance = LLMCommunicator()
-                LLMCommunicator._instance.load_model()
+    def pool():
+        # every request looks its model up here, waiting for the lock shows up in the metrics
+        with Metrics.get().timed_lock(LLMCommunicator._lock, 'LLMCommunicator._lock'):
+            if LLMCommunicator._pool is None:
+                LLMCommunicator._pool = ModelPool(LLMCommunicator._create)
                 
-            return LLMCommunicator._instance
+            return LLMCommunicator._pool
+        
+    @staticmethod
+    def set_pool(pool):
+        """
+        Serve models from another pool, e.g. one backed by worker processes.
+        """
+        with Metrics.get().timed_lock(LLMCommunicator._lock, 'LLMCommunicator._lock'):
+            LLMCommunicator._pool = pool
+        
+    @staticmethod
+    def _create(model_name):
+        instance = LLMCommunicator(model_name)
+        instance.load_model()
+        return instance
+    
+    @staticmethod
+    def get(model_name=None):
+        return LLMCommunicator.pool().get_model(model_name)
         
     @staticmethod
-    def pop():
-        with LLMCommunicator._lock:
-            if LLMCommunicator._instance is not None:
-                LLMCommunicator._instance.offload_model()
-                del LLMCommunicator._instance
-                LLMCommunicator._instance = None
+    def pop(model_name=None):
+        LLMCommunicator.pool().unload(model_name)
@@ -0,0 +1,137 @@
+import time
+
+import llama_cpp
+from llama_cpp import Llama
+
+from loader.ModelPrefetcher import prefetch_model_file
+from communicator.InferenceBackend import InferenceBackend
+
+
+class LlamaCppBackend(InferenceBackend):
+    """
+    llama.cpp in this process, through llama-cpp-python.
+
+    Completions use the generation loop of `Llama` itself; `options` are passed on to `Llama`
+    as they are, e.g. `flash_attn: true`.
+    """
+    name = 'llama_cpp'
+    supports_batching = True
+    supports_prefix_cache = True
+    supports_snapshots = True
+    supports_tuning = True
+
+    def __init__(self, model_path, **kwargs):
+        super().__init__(model_path, **kwargs)
+        self.llm = None
+
+    def load(self):
+        timings = {}
+
+        # file open: start reading the weights into the page cache, llama.cpp maps them right after
+        start = time.perf_counter()
+        prefetch_model_file(self.model_path, mode=self.prefetch)
+        timings['file_open'] = time.perf_counter() - start
+
+        # unset batch settings keep the defaults of llama-cpp-python
+        params = {}
+        if self.n_threads_batch is not None:
+            params['n_threads_batch'] = self.n_threads_batch
+        if self.n_ubatch is not None:
+            params['n_ubatch'] = self.n_ubatch
+        params.update(self.options)
+
+        # tensor mapping: with mmap only the pages touched by the first evaluations are read,
+        # without it the whole file is read into memory here
+        start = time.perf_counter()
+        self.llm = Llama(
+            model_path=self.model_path,
+            n_threads=self.n_threads,
+            n_batch=self.n_batch,
+            n_gpu_layers=self.n_gpu_layers,
+            n_ctx=self.n_ctx,
+            use_mmap=self.use_mmap,
+            use_mlock=self.use_mlock,
+            **params
+        )
+        timings['tensor_mapping'] = time.perf_counter() - start
+        return timings
+
+    def unload(self):
+        del self.llm
+        self.llm = None
+
+    def tokenize(self, text, add_bos=True, special=False):
+        return self.llm.tokenize(text, add_bos=add_bos, special=special)
+
+    def detokenize(self, tokens):
+        return self.llm.detokenize(tokens)
+
+    def token_bos(self):
+        return self.llm.token_bos()
+
+    def token_eos(self):
+        return self.llm.token_eos()
+
+    def token_text(self, token):
+        return llama_cpp.llama_token_get_text(self.llm.model, token).decode('utf-8', errors='replace')
+
+    def context_tokens(self):
+        return self.llm.input_ids[:self.llm.n_tokens].tolist()
+
+    def reset(self):
+        self.llm.reset()
+
+    def rewind(self, n_tokens):
+        # `Llama.eval` drops the KV cells behind `n_tokens` before it evaluates
+        self.llm.n_tokens = min(n_tokens, self.llm.n_tokens)
+
+    def evaluate(self, tokens):
+        self.llm.eval(tokens)
+
+    def sample(self, temperature=0.8, repeat_penalty=1.1, top_p=0.95, top_k=40, min_p=0.05, presence_penalty=0.0, frequency_penalty=0.0, **sampling):
+        return self.llm.sample(
+            temp=temperature,
+            repeat_penalty=repeat_penalty,
+            top_p=top_p,
+            top_k=top_k,
+            min_p=min_p,
+            presence_penalty=presence_penalty,
+            frequency_penalty=frequency_penalty
+        )
+
+    def set_seed(self, seed):
+        self.llm.set_seed(seed)
+
+    def set_threads(self, n_threads, n_threads_batch):
+        # the thread counts of a context can change without creating a new one
+        llama_cpp.llama_set_n_threads(self.llm.ctx, n_threads, n_threads_batch)
+        self.llm.n_threads = self.n_threads = n_threads
+        self.llm.n_threads_batch = self.n_threads_batch = n_threads_batch
+
+    def save_state(self):
+        return self.llm.save_state()
+
+    def load_state(self, state):
+        self.llm.load_state(state)
+
+    def set_cache(self, cache):
+        self.llm.set_cache(cache)
+
+    def prompt_eval_ms(self):
+        # llama.cpp adds up the prompt evaluation time of its context
+        try:
+            return llama_cpp.llama_get_timings(self.llm.ctx).t_p_eval_ms
+        except Exception:
+            return None
+
+    def complete(self, prompt, max_tokens=16, temperature=0.8, repeat_penalty=1.1, stop=None, stream=False, **sampling):
+        return self.llm.create_completion(
+            prompt=prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            repeat_penalty=repeat_penalty,
+            stop=stop,
+            echo=False,
+            stream=stream,
+            **sampling
+        )
@@ -0,0 +1,98 @@
+import os
+import threading
+
+from util.ConfigLoader import ConfigLoader
+from util.Utilities import convert_path
+from loader.ModelRegistry import ModelRegistry
+
+
+class ModelCatalog:
+    """
+    The models which can be served: one per `llm_config/*.yaml`, joined with what the
+    registry knows about its file.
+
+    The view is built once and reused until a configuration file or the registry index
+    changes, checking that costs a few `stat` calls instead of parsing every yaml file.
+    """
+    _lock = threading.Lock()
+    _instance = None
+
+    def __init__(self, path='./llm_config/'):
+        self.path = path
+        self._view_lock = threading.Lock()
+        self._signature = None
+        self._models = {}
+
+    def _current_signature(self):
+        try:
+            files = sorted((entry.name, entry.stat().st_mtime) for entry in os.scandir(self.path) if entry.name.endswith('.yaml'))
+        except OSError:
+            files = []
+        return (tuple(files), ModelRegistry.get().version())
+
+    def _build(self):
+        config = ConfigLoader().get()
+        model_root = convert_path(config['model_root'])
+        models = {}
+
+        for file_name in sorted(os.listdir(self.path)) if os.path.isdir(self.path) else []:
+            if not file_name.endswith('.yaml'):
+                continue
+
+            name = file_name[:-len('.yaml')]
+            llm_config = ConfigLoader.read_config(file_name, path=self.path)
+            model_config = (llm_config or {}).get('model_config') or {}
+            hf_id = model_config.get('hf_id', '')
+            hf_file = model_config.get('hf_file', '')
+            model_path = f"{model_root}/{hf_id}/{hf_file}"
+            entry = ModelRegistry.get().entry(model_path) or {}
+            gguf = entry.get('gguf') or {}
+
+            models[name] = {
+                'id': name,
+                'object': 'model',
+                'created': int(os.path.getmtime(os.path.join(self.path, file_name))),
+                'owned_by': hf_id.split('/')[0] if hf_id else 'local',
+                'hf_id': hf_id,
+                'hf_file': hf_file,
+                'downloaded': bool(entry) or os.path.exists(model_path),
+                'size': entry.get('size'),
+                'quantization': gguf.get('quantization'),
+                'context_length': gguf.get('context_length'),
+                'n_ctx': model_config.get('n_ctx'),
+                'last_used': entry.get('last_used'),
+            }
+
+        return models
+
+    def _refresh(self):
+        signature = self._current_signature()
+        with self._view_lock:
+            if signature != self._signature:
+                self._models = self._build()
+                self._signature = signature
+            return self._models
+
+    def exists(self, model_name):
+        return model_name in self._refresh()
+
+    def models(self, resident=()):
+        """
+        All models in the format of the OpenAI `/v1/models` endpoint, `resident` models are flagged as loaded.
+        """
+        resident = set(resident)
+        return [dict(model, loaded=(name in resident)) for name, model in self._refresh().items()]
+
+    def model(self, model_name, resident=()):
+        model = self._refresh().get(model_name)
+        if model is None:
+            return None
+        return dict(model, loaded=(model_name in set(resident)))
+
+    @staticmethod
+    def get():
+        with ModelCatalog._lock:
+            if ModelCatalog._instance is None:
+                ModelCatalog._instance = ModelCatalog()
+
+            return ModelCatalog._instance
@@ -0,0 +1,214 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from util.ConfigLoader import ConfigLoader
+from util.Utilities import convert_path
+
+
+class ModelPool:
+    """
+    Set of loaded models keyed by their `llm_config` name.
+
+    Models are loaded on first use (or preloaded in the background) and stay resident
+    until the pool exceeds `max_models` or `memory_budget_mb`, then the least recently
+    used idle models are unloaded. Loading one model never blocks requests to the others.
+    A model which is pinned (between `get_model(pin=True)` and `unpin`) is never unloaded to
+    make room, so a request can look its model up before it waits for a ticket.
+
+    :param loader: callable creating a loaded model instance from a model name
+    """
+    def __init__(self, loader, pool_config=None, default_model=None):
+        config = ConfigLoader().get()
+        if pool_config is None:
+            pool_config = config.get('model_pool', {})
+
+        self.max_models = pool_config.get('max_models', 1)
+        self.memory_budget = int(pool_config.get('memory_budget_mb', 0)) * 1024 * 1024
+        self.preload_models = list(pool_config.get('preload', []) or [])
+        self.default_model = default_model if default_model is not None else config['model']
+
+        self._loader = loader
+        self._cond = threading.Condition()
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._last_used = {}
+        self._loading = set()
+        # pin counts by the id of the instance
+        self._pins = {}
+
+    def resolve(self, model_name=None):
+        if not model_name:
+            return self.default_model
+        return model_name
+
+    def get_model(self, model_name=None, pin=False):
+        """
+        Return the loaded model `model_name` (the default model when empty), loading it if needed.
+
+        :param pin: keep the model resident until `unpin` is called with it
+        """
+        model_name = self.resolve(model_name)
+
+        with self._cond:
+            while True:
+                if model_name in self._entries:
+                    self._entries.move_to_end(model_name)
+                    self._last_used[model_name] = time.time()
+                    instance = self._entries[model_name]
+                    if pin:
+                        self._pin(instance)
+                    return instance
+
+                if model_name not in self._loading:
+                    self._loading.add(model_name)
+                    break
+
+                # somebody else is loading this model already
+                self._cond.wait()
+
+        try:
+            self._make_room(self._estimate_size(model_name), 1, keep=model_name)
+            instance = self._loader(model_name)
+        except BaseException:
+            with self._cond:
+                self._loading.discard(model_name)
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            self._entries[model_name] = instance
+            self._sizes[model_name] = self._estimate_size(model_name)
+            self._last_used[model_name] = time.time()
+            self._loading.discard(model_name)
+            if pin:
+                self._pin(instance)
+            self._cond.notify_all()
+
+        self._make_room(0, 0, keep=model_name)
+        return instance
+
+    def _pin(self, instance):
+        self._pins[id(instance)] = self._pins.get(id(instance), 0) + 1
+
+    def unpin(self, instance):
+        with self._cond:
+            count = self._pins.get(id(instance), 0) - 1
+            if count > 0:
+                self._pins[id(instance)] = count
+            else:
+                self._pins.pop(id(instance), None)
+
+    def is_resident(self, model_name=None):
+        with self._cond:
+            return self.resolve(model_name) in self._entries
+
+    def resident(self):
+        with self._cond:
+            return list(self._entries.keys())
+
+    def instances(self):
+        """
+        The resident models, keyed by their name.
+        """
+        with self._cond:
+            return dict(self._entries)
+
+    def set_default(self, model_name):
+        """
+        Make `model_name` the default model, loading it if it is not resident.
+        """
+        instance = self.get_model(model_name)
+        self.default_model = model_name
+        return instance
+
+    def preload(self, model_names=None):
+        """
+        Load models in a background thread so that a later switch costs nothing.
+        """
+        if model_names is None:
+            model_names = self.preload_models
+
+        def run():
+            for model_name in model_names:
+                try:
+                    self.get_model(model_name)
+                except Exception as e:
+                    print(f"failed to preload model {model_name}: {e}")
+
+        thread = threading.Thread(target=run, daemon=True, name='model-preload')
+        thread.start()
+        return thread
+
+    def unload(self, model_name=None):
+        model_name = self.resolve(model_name)
+        with self._cond:
+            instance = self._pop(model_name)
+
+        if instance is not None:
+            ModelPool._offload(model_name, instance)
+
+    def _pop(self, model_name):
+        # called with `_cond` held
+        self._sizes.pop(model_name, None)
+        self._last_used.pop(model_name, None)
+        return self._entries.pop(model_name, None)
+
+    @staticmethod
+    def _offload(model_name, instance):
+        print(f"unloading model {model_name}...")
+        instance.offload_model()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'default_model': self.default_model,
+                'resident': list(self._entries.keys()),
+                'last_used': dict(self._last_used),
+                'loading': list(self._loading),
+                'memory_bytes': sum(self._sizes.values()),
+                'memory_budget_bytes': self.memory_budget,
+                'max_models': self.max_models,
+            }
+
+    def _estimate_size(self, model_name):
+        # the weights dominate memory use, the GGUF file size is a good enough estimate
+        try:
+            config = ConfigLoader().get_model_config(model_name)
+        except FileNotFoundError:
+            config = ConfigLoader().get()
+        model_config = config['model_config']
+        model_path = f"{convert_path(config['model_root'])}/{model_config['hf_id']}/{model_config['hf_file']}"
+        return os.path.getsize(model_path) if os.path.exists(model_path) else 0
+
+    def _over_budget(self, incoming_size, incoming_count):
+        if self.max_models and len(self._entries) + incoming_count > self.max_models:
+            return True
+        if self.memory_budget and sum(self._sizes.values()) + incoming_size > self.memory_budget:
+            return True
+        return False
+
+    def _make_room(self, incoming_size, incoming_count, keep=None):
+        while True:
+            with self._cond:
+                if not self._over_budget(incoming_size, incoming_count):
+                    return
+
+                # least recently used idle model first, never one which is serving or about to serve requests;
+                # it leaves the pool under the same lock, so `get_model` can not hand it out any more
+                victim = None
+                for model_name, instance in self._entries.items():
+                    if model_name == keep or id(instance) in self._pins:
+                        continue
+                    scheduler_stats = instance.scheduler.stats()
+                    if scheduler_stats['running'] == 0 and scheduler_stats['queued'] == 0:
+                        victim = model_name
+                        break
+
+                if victim is None:
+                    print(f"model pool is over budget but all resident models are busy")
+                    return
+                instance = self._pop(victim)
+
+            ModelPool._offload(victim, instance)
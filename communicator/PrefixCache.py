@@ -0,0 +1,77 @@
+import threading
+
+from llama_cpp import Llama, LlamaRAMCache
+
+
+class PrefixCache(LlamaRAMCache):
+    """
+    LRU cache of evaluated KV states, keyed by their token sequence.
+
+    `Llama` looks up every prompt in its cache and restores the state sharing the longest
+    token prefix with it, so only the remaining suffix of the prompt is evaluated; after
+    the completion the state of prompt + completion is stored back. Matches shorter than
+    `min_match_tokens` (e.g. only the BOS token) are reported as misses.
+
+    :param capacity_bytes: memory budget of all cached states, least recently used states are evicted first
+    """
+    def __init__(self, capacity_bytes=(2 << 30), min_match_tokens=16):
+        super().__init__(capacity_bytes=capacity_bytes)
+        self.min_match_tokens = min_match_tokens
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'reused_tokens': 0,
+            'evictions': 0,
+        }
+
+    def _find_longest_prefix(self, key):
+        best_key = None
+        best_len = 0
+        for cached_key in self.cache_state.keys():
+            prefix_len = Llama.longest_token_prefix(cached_key, key)
+            if prefix_len > best_len:
+                best_key = cached_key
+                best_len = prefix_len
+        return best_key, best_len
+
+    def __getitem__(self, key):
+        key = tuple(key)
+        cached_key, prefix_len = self._find_longest_prefix(key)
+
+        with self._stats_lock:
+            if cached_key is None or prefix_len < self.min_match_tokens:
+                self._stats['misses'] += 1
+                raise KeyError("Key not found")
+
+            self._stats['hits'] += 1
+            self._stats['reused_tokens'] += prefix_len
+
+        self.cache_state.move_to_end(cached_key)
+        return self.cache_state[cached_key]
+
+    def __contains__(self, key):
+        _, prefix_len = self._find_longest_prefix(tuple(key))
+        return prefix_len >= self.min_match_tokens
+
+    def __setitem__(self, key, value):
+        key = tuple(key)
+        if key in self.cache_state:
+            del self.cache_state[key]
+        self.cache_state[key] = value
+
+        while self.cache_size > self.capacity_bytes and len(self.cache_state) > 0:
+            self.cache_state.popitem(last=False)
+            with self._stats_lock:
+                self._stats['evictions'] += 1
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] / lookups) if lookups > 0 else 0.0
+        stats['entries'] = len(self.cache_state)
+        stats['size_bytes'] = self.cache_size
+        stats['capacity_bytes'] = self.capacity_bytes
+        return stats
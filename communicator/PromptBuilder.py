@@ -0,0 +1,188 @@
+import threading
+from collections import OrderedDict
+
+from communicator.ContextWindow import InvalidRequestError
+
+
+class PromptBuilder:
+    """
+    Builds the prompt of a conversation from the template tokens of a model (the
+    `*_start_token`/`*_end_token` fields of `model_config`).
+
+    Every message is rendered into its own piece of the prompt and the token ids of each
+    piece are cached, so the next turn of a conversation only tokenizes its new messages.
+    A piece which is not at the start of the prompt is tokenized behind a special token,
+    exactly as llama.cpp tokenizes it inside the whole prompt. When that does not reproduce
+    the tokenization of the whole prompt for a model (checked once when the model is
+    attached), the whole prompt is tokenized instead.
+
+    The list of messages passed in is never modified.
+    """
+    def __init__(self, model_config, sys_template=None, user_template=None, max_entries=4096):
+        self.system_prompt = model_config['system_prompt']
+        self.system_prompt_start_token = model_config['system_prompt_start_token']
+        self.system_prompt_end_token = model_config['system_prompt_end_token']
+        self.user_prompt_start_token = model_config['user_prompt_start_token']
+        self.user_prompt_end_token = model_config['user_prompt_end_token']
+        self.user_followup_prompt_start_token = model_config['user_followup_prompt_start_token']
+        self.user_followup_prompt_end_token = model_config['user_followup_prompt_end_token']
+        self.assistant_prompt_start_token = model_config['assistant_prompt_start_token']
+        self.assistant_prompt_end_token = model_config['assistant_prompt_end_token']
+        self.assistant_followup_prompt_start_token = model_config['assistant_followup_prompt_start_token']
+        self.assistant_followup_prompt_end_token = model_config['assistant_followup_prompt_end_token']
+
+        self._sys_template = sys_template
+        self._user_template = user_template
+        self._max_entries = max_entries
+
+        self._backend = None
+        self._marker = None
+        self._piecewise = False
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+        }
+
+    def messages(self, messages):
+        """
+        The messages the prompt is built from: a copy of `messages`, starting with the system message of the model if it has one.
+        """
+        if len(messages) < 1:
+            raise InvalidRequestError("messages list is empty")
+
+        messages = list(messages)
+        if self.system_prompt and messages[0].get('role', 'user') != 'system':
+            messages.insert(0, {
+                "role": "system",
+                "content": self._sys_template if self._sys_template is not None else ""
+            })
+        return messages
+
+    def pieces(self, messages):
+        """
+        The text of the prompt, one piece per message.
+        """
+        pieces = []
+        is_first_user_prompt = True
+        is_first_assistant_prompt = True
+
+        for i, current_message in enumerate(self.messages(messages)):
+            current_role = current_message.get('role', 'user')
+            current_content = current_message.get('content', '').strip()
+
+            if current_role == 'system':
+                if i != 0:
+                    raise InvalidRequestError("system prompt can only be set at the beginning")
+                pieces.append(f"{self.system_prompt_start_token}{current_content}{self.system_prompt_end_token}")
+            elif current_role == 'user':
+                if is_first_user_prompt:
+                    if self._user_template is None:
+                        pieces.append(f"{self.user_prompt_start_token}{current_content}{self.user_prompt_end_token}")
+                    else:
+                        pieces.append(f"{self.user_prompt_start_token}{self._user_template.replace('{prompt}', current_content)}{self.user_prompt_end_token}")
+                    is_first_user_prompt = False
+                else:
+                    pieces.append(f"{self.user_followup_prompt_start_token}{current_content}{self.user_followup_prompt_end_token}")
+            elif current_role == 'assistant':
+                if is_first_assistant_prompt:
+                    pieces.append(f"{self.assistant_prompt_start_token}{current_content}{self.assistant_prompt_end_token}")
+                    is_first_assistant_prompt = False
+                else:
+                    pieces.append(f"{self.assistant_followup_prompt_start_token}{current_content}{self.assistant_followup_prompt_end_token}")
+            else:
+                raise InvalidRequestError(f"unknown role: {current_role}")
+
+        return pieces
+
+    def text(self, messages):
+        return ''.join(self.pieces(messages))
+
+    def attach(self, backend):
+        """
+        Tokenize with the vocabulary of the `InferenceBackend` `backend` from now on.
+        """
+        with self._lock:
+            self._backend = backend
+            self._cache.clear()
+            self._marker = None
+            self._piecewise = False
+
+            # any special token works as separator, BOS is the one every model has
+            try:
+                marker = backend.token_text(backend.token_bos())
+                if backend.tokenize(marker.encode('utf-8'), add_bos=False, special=True) == [backend.token_bos()]:
+                    self._marker = marker
+            except Exception:
+                self._marker = None
+
+        if self._marker is None:
+            return
+
+        probe = [
+            {'role': 'system', 'content': 'You are a helpful assistant.'},
+            {'role': 'user', 'content': 'Hello, who are you?'},
+            {'role': 'assistant', 'content': 'I am an assistant.'},
+            {'role': 'user', 'content': 'Tell me a joke.'},
+        ]
+        self._piecewise = True
+        self._piecewise = self._tokens_piecewise(self.pieces(probe)) == self._tokenize(self.text(probe), add_bos=True)
+        with self._lock:
+            self._cache.clear()
+
+        if not self._piecewise:
+            print(f"the prompt template can not be tokenized message by message, whole prompts are tokenized")
+
+    def _tokenize(self, text, add_bos=False):
+        return self._backend.tokenize(text.encode('utf-8'), add_bos=add_bos, special=True)
+
+    def _piece_tokens(self, piece, is_first):
+        key = (is_first, piece)
+        with self._lock:
+            tokens = self._cache.get(key)
+            if tokens is not None:
+                self._cache.move_to_end(key)
+                self._stats['hits'] += 1
+                return tokens
+            self._stats['misses'] += 1
+
+        if is_first:
+            tokens = tuple(self._tokenize(piece))
+        else:
+            # inside a prompt a piece is tokenized like text following a special token (no leading space is added)
+            tokens = self._tokenize(self._marker + piece)
+            if not tokens or tokens[0] != self._backend.token_bos():
+                raise ValueError(f"can not tokenize {piece!r} as a part of a prompt")
+            tokens = tuple(tokens[1:])
+
+        with self._lock:
+            self._cache[key] = tokens
+            while len(self._cache) > self._max_entries:
+                self._cache.popitem(last=False)
+        return tokens
+
+    def _tokens_piecewise(self, pieces):
+        tokens = [self._backend.token_bos()]
+        for i, piece in enumerate(pieces):
+            tokens.extend(self._piece_tokens(piece, i == 0))
+        return tokens
+
+    def tokens(self, messages):
+        """
+        The prompt token ids of `messages`, starting with BOS.
+        """
+        if self._backend is None:
+            raise RuntimeError("no model is attached to the prompt builder")
+
+        pieces = self.pieces(messages)
+        if self._piecewise:
+            return self._tokens_piecewise(pieces)
+        return self._tokenize(''.join(pieces), add_bos=True)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._cache)
+            stats['piecewise'] = self._piecewise
+            return stats
@@ -0,0 +1,392 @@
+import math
+import time
+import heapq
+import weakref
+import asyncio
+import itertools
+import threading
+
+from util.Metrics import Metrics
+
+
+class SchedulerError(Exception):
+    """
+    Base error raised when a request can not be admitted to the LLM.
+
+    :param status_code: the HTTP status code the error should be reported with
+    :param retry_after: suggested number of seconds before the client retries, or None
+    """
+    def __init__(self, message, status_code=503, retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class QueueFullError(SchedulerError):
+    def __init__(self, message="too many pending requests", retry_after=None):
+        super().__init__(message, status_code=429, retry_after=retry_after)
+
+
+class QueueTimeoutError(SchedulerError):
+    def __init__(self, message="request timed out while waiting in the queue", retry_after=None):
+        super().__init__(message, status_code=503, retry_after=retry_after)
+
+
+class RequestCancelledError(SchedulerError):
+    def __init__(self, message="request has been cancelled"):
+        super().__init__(message, status_code=499)
+
+
+class Ticket:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    CANCELLED = 'cancelled'
+    EXPIRED = 'expired'
+
+    def __init__(self, scheduler, priority=0, deadline=None, frontend='http'):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.deadline = deadline
+        self.frontend = frontend
+        self.state = Ticket.QUEUED
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self._event = threading.Event()
+
+    @property
+    def queue_wait(self):
+        if self.started_at is None:
+            return time.monotonic() - self.submitted_at
+        return self.started_at - self.submitted_at
+
+    def wait(self, timeout=None):
+        """
+        Block until the ticket is admitted.
+
+        :param timeout: maximum seconds to wait for this call, None waits until the ticket's deadline
+        :return: True when admitted, False when only `timeout` elapsed
+        :raises QueueTimeoutError: the ticket's deadline passed before admission
+        :raises RequestCancelledError: the ticket was cancelled while waiting
+        """
+        remaining = None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+        if timeout is None or (remaining is not None and remaining < timeout):
+            wait_for = remaining
+        else:
+            wait_for = timeout
+
+        self._event.wait(wait_for)
+        return self.scheduler._check_admission(self)
+
+    async def wait_async(self, is_disconnected=None, poll_interval=0.25):
+        """
+        Wait for admission without blocking the event loop.
+
+        :param is_disconnected: optional coroutine function, the ticket is cancelled once it returns True
+        :param poll_interval: seconds between two disconnect checks
+        """
+        loop = asyncio.get_running_loop()
+        while not await loop.run_in_executor(None, self.wait, poll_interval):
+            if is_disconnected is not None and await is_disconnected():
+                self.cancel()
+                raise RequestCancelledError("client disconnected while waiting in the queue")
+
+    def cancel(self):
+        self.scheduler._cancel(self)
+
+    def release(self):
+        self.scheduler._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+        return False
+
+
+class LeasedStream:
+    """
+    Iterator which keeps its ticket admitted for as long as the wrapped stream is consumed.
+
+    The ticket is released as soon as the stream is exhausted, raises, is closed, is garbage
+    collected, or stays idle (not pulled by its consumer) for longer than `idle_timeout` seconds.
+    """
+    def __init__(self, stream, ticket, idle_timeout=None):
+        self._stream = stream
+        self._ticket = ticket
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._busy = False
+        self._closed = False
+        self._close_requested = False
+        self.last_active = time.monotonic()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def is_idle(self, now=None):
+        if self._idle_timeout is None or self._busy or self._closed:
+            return False
+        if now is None:
+            now = time.monotonic()
+        return now - self.last_active > self._idle_timeout
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            if self._closed:
+                raise StopIteration
+            self._busy = True
+
+        try:
+            item = next(self._stream)
+        except BaseException:
+            self._busy = False
+            self.close()
+            raise
+
+        with self._lock:
+            self._busy = False
+            self.last_active = time.monotonic()
+            close_requested = self._close_requested
+
+        # close() was called from another thread while a token was being generated
+        if close_requested:
+            self.close()
+            raise StopIteration
+
+        return item
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            if self._busy:
+                # the underlying generator is running, let the consuming thread close it
+                self._close_requested = True
+                return
+            self._closed = True
+
+        try:
+            close = getattr(self._stream, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._stream = None
+            self._ticket.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def __del__(self):
+        self.close()
+
+
+class RequestScheduler:
+    """
+    Bounded admission queue in front of a single LLM instance.
+
+    Every completion takes a `Ticket` before touching the model; tickets are admitted one
+    at a time (or `slots` at a time) in FIFO or priority order, expire after their deadline
+    and can be cancelled while they are still waiting.
+
+    :param name: the model served behind the queue, the label of its metrics
+    """
+    POLICIES = ('fifo', 'priority')
+
+    def __init__(self, scheduler_config=None, slots=1, name=''):
+        if scheduler_config is None:
+            scheduler_config = {}
+
+        self.policy = scheduler_config.get('policy', 'fifo')
+        self.max_queue_size = scheduler_config.get('max_queue_size', 16)
+        self.queue_timeout = scheduler_config.get('queue_timeout', 120)
+        self.retry_after = scheduler_config.get('retry_after', 5)
+        self.lease_idle_timeout = scheduler_config.get('lease_idle_timeout', 30)
+        self.slots = slots
+        self.name = name
+
+        if self.policy not in RequestScheduler.POLICIES:
+            raise ValueError(f"unknown scheduler policy: {self.policy}")
+
+        self._cond = threading.Condition()
+        self._heap = []
+        self._counter = itertools.count()
+        self._queued = 0
+        self._running = 0
+        self._service_time = None
+        self._leases = weakref.WeakSet()
+        self._reaper = None
+        self._queue_wait = Metrics.get().queue_wait
+
+        self._stats = {
+            'submitted': 0,
+            'admitted': 0,
+            'completed': 0,
+            'rejected': 0,
+            'expired': 0,
+            'cancelled': 0,
+        }
+
+    def submit(self, priority=0, timeout=None, frontend='http'):
+        """
+        Enqueue a new request and return its ticket without waiting for admission.
+
+        :param priority: higher values are served first under the 'priority' policy
+        :param timeout: seconds the request may wait in the queue, defaults to `queue_timeout`
+        :raises QueueFullError: the queue already holds `max_queue_size` pending requests
+        """
+        if timeout is None:
+            timeout = self.queue_timeout
+        deadline = (time.monotonic() + timeout) if timeout else None
+
+        with self._cond:
+            if self.max_queue_size and self._queued >= self.max_queue_size:
+                self._stats['rejected'] += 1
+                raise QueueFullError(retry_after=self._estimate_retry_after())
+
+            ticket = Ticket(self, priority=priority, deadline=deadline, frontend=frontend)
+            if self.policy == 'priority':
+                sort_key = (-priority, next(self._counter))
+            else:
+                sort_key = (0, next(self._counter))
+
+            heapq.heappush(self._heap, (sort_key, ticket))
+            self._queued += 1
+            self._stats['submitted'] += 1
+            self._dispatch()
+
+        return ticket
+
+    def acquire(self, priority=0, timeout=None, frontend='http'):
+        """
+        Enqueue a new request and block until it is admitted.
+        """
+        ticket = self.submit(priority=priority, timeout=timeout, frontend=frontend)
+        ticket.wait()
+        return ticket
+
+    def lease(self, stream, ticket):
+        """
+        Tie an admitted ticket to the lifetime of a token stream, see `LeasedStream`.
+        """
+        leased_stream = LeasedStream(stream, ticket, idle_timeout=self.lease_idle_timeout)
+
+        if self.lease_idle_timeout:
+            with self._cond:
+                self._leases.add(leased_stream)
+                if self._reaper is None:
+                    interval = max(0.5, min(5.0, self.lease_idle_timeout / 4))
+                    self._reaper = threading.Thread(target=RequestScheduler._reap_idle_leases, args=(weakref.ref(self), interval), daemon=True)
+                    self._reaper.start()
+
+        return leased_stream
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queued'] = self._queued
+            stats['running'] = self._running
+            stats['slots'] = self.slots
+            stats['policy'] = self.policy
+            stats['avg_service_time'] = self._service_time
+            return stats
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self._running < self.slots and self._heap:
+            _, ticket = heapq.heappop(self._heap)
+            if ticket.state != Ticket.QUEUED:
+                continue
+
+            self._queued -= 1
+            if ticket.deadline is not None and ticket.deadline <= now:
+                ticket.state = Ticket.EXPIRED
+                self._stats['expired'] += 1
+                ticket._event.set()
+                continue
+
+            ticket.state = Ticket.RUNNING
+            ticket.started_at = now
+            self._queue_wait.labels(self.name, ticket.frontend).observe(now - ticket.submitted_at)
+            self._running += 1
+            self._stats['admitted'] += 1
+            ticket._event.set()
+
+    def _check_admission(self, ticket):
+        with self._cond:
+            if ticket.state in (Ticket.RUNNING, Ticket.DONE):
+                return True
+            if ticket.state == Ticket.CANCELLED:
+                raise RequestCancelledError()
+            if ticket.state == Ticket.QUEUED and ticket.deadline is not None and ticket.deadline <= time.monotonic():
+                ticket.state = Ticket.EXPIRED
+                self._queued -= 1
+                self._stats['expired'] += 1
+            if ticket.state == Ticket.EXPIRED:
+                raise QueueTimeoutError(retry_after=self._estimate_retry_after())
+            return False
+
+    def _cancel(self, ticket):
+        with self._cond:
+            if ticket.state == Ticket.QUEUED:
+                ticket.state = Ticket.CANCELLED
+                self._queued -= 1
+                self._stats['cancelled'] += 1
+                ticket._event.set()
+            elif ticket.state == Ticket.RUNNING:
+                self._finish(ticket, Ticket.CANCELLED)
+                self._stats['cancelled'] += 1
+
+    def _release(self, ticket):
+        with self._cond:
+            if ticket.state == Ticket.RUNNING:
+                self._finish(ticket, Ticket.DONE)
+                self._stats['completed'] += 1
+
+    def _finish(self, ticket, state):
+        ticket.state = state
+        ticket.finished_at = time.monotonic()
+        self._running -= 1
+
+        # exponentially weighted service time, used to estimate `Retry-After`
+        duration = ticket.finished_at - ticket.started_at
+        if self._service_time is None:
+            self._service_time = duration
+        else:
+            self._service_time = 0.8 * self._service_time + 0.2 * duration
+
+        self._dispatch()
+
+    @staticmethod
+    def _reap_idle_leases(scheduler_ref, interval):
+        # streams abandoned by their consumer (e.g. a disconnected HTTP client whose response
+        # object is not collected yet) would otherwise hold the model until garbage collection
+        while True:
+            time.sleep(interval)
+            scheduler = scheduler_ref()
+            if scheduler is None:
+                return
+
+            now = time.monotonic()
+            with scheduler._cond:
+                idle_leases = [lease for lease in scheduler._leases if lease.is_idle(now)]
+            del scheduler
+
+            for lease in idle_leases:
+                lease.close()
+
+    def _estimate_retry_after(self):
+        if self._service_time is None:
+            return self.retry_after
+        return max(1, math.ceil(self._service_time * (self._queued + 1) / self.slots))
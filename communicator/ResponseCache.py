@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from util.ConfigLoader import ConfigLoader
+from util.Utilities import convert_path
+
+
+class ResponseCache:
+    """
+    Cache of completion results for deterministic requests.
+
+    With `temperature: 0` the same request always gets the same answer, so health probes, test
+    suites and retrying clients do not need to run the model again. Results are keyed by the
+    model (its name and `model_config`), the normalized messages and all parameters which
+    change the output. The memory tier is bounded by `max_entries` and `max_size_mb`, least
+    recently used results go first; with `disk` enabled, results are also written to
+    `<model_root>/.response_cache/` and survive restarts. Entries older than `ttl` seconds are
+    never returned.
+
+    :param cache_config: the `response_cache` section of the configuration
+    """
+    _lock = threading.Lock()
+    _instance = None
+
+    def __init__(self, cache_config=None, root=None):
+        config = ConfigLoader().get()
+        if cache_config is None:
+            cache_config = config.get('response_cache', {})
+        if root is None:
+            root = f"{convert_path(config['model_root'])}/.response_cache"
+
+        self.enabled = cache_config.get('enabled', False)
+        self.ttl = cache_config.get('ttl', 600)
+        self.max_entries = cache_config.get('max_entries', 1024)
+        self.max_size_bytes = int(cache_config.get('max_size_mb', 64)) * 1024 * 1024
+        self.disk = cache_config.get('disk', False)
+        self.disk_max_size_bytes = int(cache_config.get('disk_max_size_mb', 512)) * 1024 * 1024
+        self.root = root
+
+        self._cache_lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._stats = {
+            'hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expired': 0,
+        }
+
+        if self.enabled and self.disk:
+            os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def is_deterministic(temperature):
+        # a fixed `seed` with a higher temperature repeats an answer too, but clients sending one still expect a sample
+        return temperature is not None and temperature <= 0
+
+    @staticmethod
+    def key(model_config, messages, params):
+        """
+        The cache key of a request.
+
+        :param params: everything besides the messages which changes the output (sampling parameters, `max_tokens`, `stop`, `n`, `echo`...)
+        """
+        # the prompt builder strips the content and only looks at role and content
+        normalized = [[m.get('role', 'user'), m.get('content', '').strip()] for m in messages]
+        payload = json.dumps([model_config, normalized, params], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.root, f"{key}.json")
+
+    def lookup(self, key):
+        """
+        The cached result of `key`, or None.
+        """
+        if not self.enabled:
+            return None
+
+        now = time.time()
+        with self._cache_lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry['created'] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return entry['result']
+                self._remove(key)
+                self._stats['expired'] += 1
+
+        entry = self._read_disk(key, now) if self.disk else None
+        with self._cache_lock:
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['disk_hits'] += 1
+            self._insert(key, entry)
+            return entry['result']
+
+    def store(self, key, result):
+        """
+        Cache `result`, unless one of its choices was cut off before it ended (e.g. cancelled).
+        """
+        if not self.enabled:
+            return
+        if any(choice.get('finish_reason') in (None, 'cancelled') for choice in result.get('choices', [])):
+            return
+
+        entry = {'created': time.time(), 'result': result}
+        with self._cache_lock:
+            self._insert(key, entry)
+            self._stats['stores'] += 1
+
+        if self.disk:
+            self._write_disk(key, entry)
+
+    def clear(self):
+        with self._cache_lock:
+            self._entries.clear()
+            self._size = 0
+
+        if self.disk and os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                if name.endswith('.json'):
+                    self._unlink(os.path.join(self.root, name))
+
+    def _insert(self, key, entry):
+        # the caller holds `_cache_lock`
+        if key in self._entries:
+            self._remove(key)
+
+        entry['size'] = len(json.dumps(entry['result'], ensure_ascii=False).encode('utf-8'))
+        self._entries[key] = entry
+        self._size += entry['size']
+
+        while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_size_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._stats['evictions'] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry['size']
+
+    def _read_disk(self, key, now):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if now - entry.get('created', 0) > self.ttl:
+            self._unlink(path)
+            return None
+        return entry
+
+    def _write_disk(self, key, entry):
+        path = self._disk_path(key)
+        temp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump({'created': entry['created'], 'result': entry['result']}, file, ensure_ascii=False)
+            os.replace(temp_path, path)
+        except OSError as e:
+            self._unlink(temp_path)
+            print(f"failed to write the cached response {key}: {e}")
+            return
+
+        self._enforce_disk_budget()
+
+    def _enforce_disk_budget(self):
+        try:
+            files = [entry for entry in os.scandir(self.root) if entry.name.endswith('.json')]
+            files = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in files]
+        except OSError:
+            return
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_size_bytes:
+                break
+            self._unlink(path)
+            total -= size
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._cache_lock:
+            stats = dict(self._stats)
+            stats['enabled'] = self.enabled
+            stats['entries'] = len(self._entries)
+            stats['size'] = self._size
+            lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+            stats['hit_rate'] = (stats['hits'] + stats['disk_hits']) / lookups if lookups else None
+            return stats
+
+    @staticmethod
+    def get():
+        with ResponseCache._lock:
+            if ResponseCache._instance is None:
+                ResponseCache._instance = ResponseCache()
+
+            return ResponseCache._instance
@@ -0,0 +1,159 @@
+import time
+import asyncio
+import threading
+import traceback
+
+from util.ConfigLoader import ConfigLoader
+
+
+class ServerReadiness:
+    """
+    Startup state of the server.
+
+    The HTTP server accepts connections right away while the default model is downloaded,
+    loaded and warmed up in a background thread; models report their loading phases here
+    so that the readiness endpoint can tell "loading" from "dead".
+    """
+    STARTING = 'starting'
+    DOWNLOADING = 'downloading'
+    LOADING = 'loading'
+    WARMING_UP = 'warming_up'
+    READY = 'ready'
+    FAILED = 'failed'
+
+    # rough share of the startup time which is over once a phase begins
+    PROGRESS = {
+        STARTING: 0.0,
+        DOWNLOADING: 0.05,
+        LOADING: 0.5,
+        WARMING_UP: 0.9,
+        READY: 1.0,
+    }
+
+    _lock = threading.Lock()
+    _instance = None
+
+    def __init__(self, startup_config=None):
+        config = ConfigLoader().get()
+        if startup_config is None:
+            startup_config = config.get('startup', {})
+
+        self.wait_timeout = startup_config.get('wait_timeout', 30)
+        self.retry_after = startup_config.get('retry_after', 10)
+        self.model_name = config['model']
+
+        self._cond = threading.Condition()
+        self._phase = ServerReadiness.STARTING
+        self._progress = 0.0
+        self._error = None
+        self._started_at = time.time()
+        self._ready_at = None
+        self._load_timings = {}
+        self._models = {}
+
+    def report(self, model_name, phase, progress=None):
+        """
+        Record the loading phase of `model_name`, the server follows the phases of its default model.
+        """
+        with self._cond:
+            self._models[model_name] = phase
+            # the server itself only becomes ready once the startup loader has returned
+            if model_name != self.model_name or phase == ServerReadiness.READY or self._phase in (ServerReadiness.READY, ServerReadiness.FAILED):
+                return
+
+            self._phase = phase
+            self._progress = progress if progress is not None else ServerReadiness.PROGRESS.get(phase, self._progress)
+
+    def start(self, loader, on_done=None):
+        """
+        Run `loader` in a background thread, the server is ready once it returns.
+
+        :param loader: callable loading and warming up the default model, returns the model instance
+        :param on_done: optional callable invoked after the loader succeeded or failed
+        """
+        def run():
+            try:
+                instance = loader()
+                with self._cond:
+                    self._load_timings = dict(getattr(instance, 'load_timings', {}) or {})
+                    self._models[self.model_name] = ServerReadiness.READY
+                    self._phase = ServerReadiness.READY
+                    self._progress = 1.0
+                    self._ready_at = time.time()
+                    self._cond.notify_all()
+                print(f"server is ready after {self._ready_at - self._started_at:.2f}s")
+            except Exception as e:
+                traceback.print_exc()
+                with self._cond:
+                    self._phase = ServerReadiness.FAILED
+                    self._error = f"{type(e).__name__}: {e}"
+                    self._cond.notify_all()
+            finally:
+                if on_done is not None:
+                    on_done()
+
+        thread = threading.Thread(target=run, daemon=True, name='model-warmup')
+        thread.start()
+        return thread
+
+    def is_ready(self):
+        with self._cond:
+            return self._phase == ServerReadiness.READY
+
+    def is_failed(self):
+        with self._cond:
+            return self._phase == ServerReadiness.FAILED
+
+    def wait(self, timeout=None):
+        """
+        Block until the server is ready or has failed, return True when it is ready.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._phase in (ServerReadiness.READY, ServerReadiness.FAILED), timeout=timeout)
+            return self._phase == ServerReadiness.READY
+
+    async def wait_async(self, timeout=None, is_disconnected=None, poll_interval=0.25):
+        """
+        Wait for readiness without blocking the event loop, return True when the server is ready.
+
+        :param is_disconnected: optional coroutine function, waiting stops once it returns True
+        """
+        if timeout is None:
+            timeout = self.wait_timeout
+
+        deadline = time.monotonic() + timeout
+        loop = asyncio.get_running_loop()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return self.is_ready()
+            if await loop.run_in_executor(None, self.wait, min(poll_interval, remaining)):
+                return True
+            if self.is_failed():
+                return False
+            if is_disconnected is not None and await is_disconnected():
+                return False
+
+    def status(self):
+        with self._cond:
+            status = {
+                'status': self._phase,
+                'ready': self._phase == ServerReadiness.READY,
+                'model': self.model_name,
+                'progress': round(self._progress, 3),
+                'elapsed': round((self._ready_at or time.time()) - self._started_at, 3),
+                'models': dict(self._models),
+            }
+            if self._load_timings:
+                status['load_timings'] = {phase: round(seconds, 3) for phase, seconds in self._load_timings.items()}
+            if self._error is not None:
+                status['error'] = self._error
+            return status
+
+    @staticmethod
+    def get():
+        with ServerReadiness._lock:
+            if ServerReadiness._instance is None:
+                ServerReadiness._instance = ServerReadiness()
+
+            return ServerReadiness._instance
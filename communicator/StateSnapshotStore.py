@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import inspect
+import threading
+
+import numpy as np
+from llama_cpp import LlamaState
+
+from util.Utilities import file_fingerprint
+
+
+class StateSnapshotStore:
+    """
+    On-disk store of evaluated KV states for long, frequently used prompt prefixes
+    (typically the system prompt).
+
+    Snapshots live under `<root>/<model fingerprint>-ctx<n_ctx>/<prefix token hash>/`, so a
+    snapshot is never restored into a different model file or context size. Token ids and
+    scores are stored as `.npy` and memory-mapped when a snapshot is restored, the llama.cpp
+    state is a raw file which is read into the restored state.
+
+    :param root: the directory holding the snapshots of all models
+    :param model_path: the GGUF file the snapshots belong to
+    :param n_ctx: the context size the snapshots belong to
+    :param max_size_bytes: disk budget of all snapshots, least recently used ones are evicted first
+    """
+    META_FILE = 'meta.json'
+    INPUT_IDS_FILE = 'input_ids.npy'
+    SCORES_FILE = 'scores.npy'
+    STATE_FILE = 'llama_state.bin'
+
+    def __init__(self, root, model_path, n_ctx, max_size_bytes=(4 << 30), min_prefix_tokens=64):
+        self.root = root
+        self.model_path = os.path.realpath(model_path)
+        self.n_ctx = n_ctx
+        self.max_size_bytes = max_size_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        self.model_fingerprint = file_fingerprint(self.model_path)
+        self.directory = os.path.join(root, f"{self.model_fingerprint[:16]}-ctx{n_ctx}")
+
+        self._lock = threading.Lock()
+        self._writing = set()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'saved': 0,
+            'evictions': 0,
+        }
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._invalidate_stale()
+
+    @staticmethod
+    def prefix_key(tokens):
+        return hashlib.sha256(np.asarray(tokens, dtype=np.int32).tobytes()).hexdigest()
+
+    def _snapshot_dir(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, tokens):
+        """
+        Restore the snapshot of exactly `tokens`, or return None.
+        """
+        key = StateSnapshotStore.prefix_key(tokens)
+        snapshot_dir = self._snapshot_dir(key)
+        meta_path = os.path.join(snapshot_dir, StateSnapshotStore.META_FILE)
+
+        try:
+            with open(meta_path, 'r') as file:
+                meta = json.load(file)
+
+            if meta['model_fingerprint'] != self.model_fingerprint or meta['n_ctx'] != self.n_ctx:
+                raise ValueError("snapshot does not match the loaded model")
+
+            input_ids = np.load(os.path.join(snapshot_dir, StateSnapshotStore.INPUT_IDS_FILE), mmap_mode='r')
+            scores = np.load(os.path.join(snapshot_dir, StateSnapshotStore.SCORES_FILE), mmap_mode='r')
+            with open(os.path.join(snapshot_dir, StateSnapshotStore.STATE_FILE), 'rb') as file:
+                llama_state = file.read()
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+
+        # mark as recently used for the LRU eviction
+        os.utime(meta_path, None)
+        with self._lock:
+            self._stats['hits'] += 1
+
+        return StateSnapshotStore._build_state(
+            input_ids=input_ids,
+            scores=scores,
+            n_tokens=meta['n_tokens'],
+            llama_state=llama_state,
+            llama_state_size=meta['llama_state_size'],
+            seed=meta.get('seed')
+        )
+
+    def save(self, tokens, state):
+        """
+        Persist `state` as the snapshot of `tokens`, the write happens in a background thread.
+        """
+        key = StateSnapshotStore.prefix_key(tokens)
+        with self._lock:
+            if key in self._writing:
+                return
+            self._writing.add(key)
+
+        thread = threading.Thread(target=self._write, args=(key, state), daemon=True)
+        thread.start()
+
+    def _write(self, key, state):
+        snapshot_dir = self._snapshot_dir(key)
+        temp_dir = f"{snapshot_dir}.tmp-{os.getpid()}-{threading.get_ident()}"
+
+        try:
+            os.makedirs(temp_dir, exist_ok=True)
+            np.save(os.path.join(temp_dir, StateSnapshotStore.INPUT_IDS_FILE), np.asarray(state.input_ids))
+            np.save(os.path.join(temp_dir, StateSnapshotStore.SCORES_FILE), np.asarray(state.scores))
+            with open(os.path.join(temp_dir, StateSnapshotStore.STATE_FILE), 'wb') as file:
+                file.write(state.llama_state)
+
+            meta = {
+                'model_path': self.model_path,
+                'model_fingerprint': self.model_fingerprint,
+                'n_ctx': self.n_ctx,
+                'n_tokens': int(state.n_tokens),
+                'llama_state_size': int(state.llama_state_size),
+                'seed': getattr(state, 'seed', None),
+                'created': time.time(),
+            }
+            with open(os.path.join(temp_dir, StateSnapshotStore.META_FILE), 'w') as file:
+                json.dump(meta, file, indent=4)
+
+            # readers only ever see complete snapshots
+            if os.path.exists(snapshot_dir):
+                shutil.rmtree(snapshot_dir, ignore_errors=True)
+            os.replace(temp_dir, snapshot_dir)
+
+            with self._lock:
+                self._stats['saved'] += 1
+        except OSError as e:
+            print(f"failed to save KV snapshot {key}: {e}")
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        finally:
+            with self._lock:
+                self._writing.discard(key)
+
+        self._evict()
+
+    def _evict(self):
+        snapshots = []
+        total_size = 0
+        for model_dir in self._list_dirs(self.root):
+            for snapshot_dir in self._list_dirs(model_dir):
+                meta_path = os.path.join(snapshot_dir, StateSnapshotStore.META_FILE)
+                if not os.path.exists(meta_path):
+                    continue
+                size = sum(entry.stat().st_size for entry in os.scandir(snapshot_dir) if entry.is_file())
+                snapshots.append((os.path.getmtime(meta_path), size, snapshot_dir))
+                total_size += size
+
+        for _, size, snapshot_dir in sorted(snapshots):
+            if total_size <= self.max_size_bytes:
+                break
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+            total_size -= size
+            with self._lock:
+                self._stats['evictions'] += 1
+
+    def _invalidate_stale(self):
+        # snapshots of an older content of this model file are useless; the ones of the same
+        # content with another n_ctx are kept for the processes (or restarts) which use it
+        for model_dir in self._list_dirs(self.root):
+            if model_dir == self.directory:
+                continue
+
+            removed = False
+            for snapshot_dir in self._list_dirs(model_dir):
+                try:
+                    with open(os.path.join(snapshot_dir, StateSnapshotStore.META_FILE), 'r') as file:
+                        meta = json.load(file)
+                except (OSError, ValueError):
+                    # e.g. a snapshot which another process is writing right now
+                    continue
+                if meta.get('model_path') == self.model_path and meta.get('model_fingerprint') != self.model_fingerprint:
+                    shutil.rmtree(snapshot_dir, ignore_errors=True)
+                    removed = True
+
+            if removed and not os.listdir(model_dir):
+                try:
+                    os.rmdir(model_dir)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _list_dirs(path):
+        if not os.path.isdir(path):
+            return []
+        return [entry.path for entry in os.scandir(path) if entry.is_dir()]
+
+    @staticmethod
+    def _build_state(**kwargs):
+        # `LlamaState` gained fields over llama-cpp-python releases, only pass the ones it knows
+        parameters = inspect.signature(LlamaState.__init__).parameters
+        return LlamaState(**{name: value for name, value in kwargs.items() if name in parameters})
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
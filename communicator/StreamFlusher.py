@@ -0,0 +1,76 @@
+import time
+
+
+class StreamFlusher:
+    """
+    Coalesces the text chunks of a token stream before they are sent to a client.
+
+    Text is flushed on whichever comes first of `max_tokens` chunks, `max_delay_ms` since the
+    oldest text still held or `max_bytes` of held text, so fast models send a few large writes
+    and slow models are not held back. The first chunk is always flushed right away, it decides
+    the time to first token.
+
+    `add` can only check the delay when a chunk arrives; consumers which can wait with a timeout
+    use `due_in` to flush held text of a stalled stream in time.
+    """
+    def __init__(self, max_tokens=16, max_delay_ms=50, max_bytes=1024, clock=time.monotonic):
+        self.max_tokens = max(1, int(max_tokens))
+        self.max_delay = max(0, max_delay_ms) / 1000
+        self.max_bytes = max(1, int(max_bytes))
+
+        self._clock = clock
+        self._parts = []
+        self._tokens = 0
+        self._bytes = 0
+        self._held_since = None
+        self._first = True
+
+    @staticmethod
+    def from_config(config):
+        flush_config = config.get('stream_flush', {})
+        return StreamFlusher(
+            max_tokens=config.get('stream_batch_size', 16),
+            max_delay_ms=flush_config.get('max_delay_ms', 50),
+            max_bytes=flush_config.get('max_bytes', 1024)
+        )
+
+    def pending(self):
+        return self._tokens > 0
+
+    def due_in(self):
+        """
+        Seconds until the held text has to be flushed, None when nothing is held.
+        """
+        if self._held_since is None:
+            return None
+        return max(0.0, self._held_since + self.max_delay - self._clock())
+
+    def add(self, text):
+        """
+        Hold the text of one chunk.
+
+        :return: the text to send now, or None to keep holding it
+        """
+        now = self._clock()
+        if self._held_since is None:
+            self._held_since = now
+
+        self._parts.append(text)
+        self._tokens += 1
+        self._bytes += len(text.encode('utf-8'))
+
+        if self._first or self._tokens >= self.max_tokens or self._bytes >= self.max_bytes or now - self._held_since >= self.max_delay:
+            self._first = False
+            return self.flush()
+        return None
+
+    def flush(self):
+        """
+        The held text, '' when nothing is held.
+        """
+        text = ''.join(self._parts)
+        self._parts = []
+        self._tokens = 0
+        self._bytes = 0
+        self._held_since = None
+        return text
@@ -0,0 +1,321 @@
+import time
+import json
+import codecs
+import asyncio
+
+from util.Tracer import UNTRACED
+from communicator.StreamFlusher import StreamFlusher
+
+
+class Utf8Repair:
+    """
+    Decodes token bytes which may end in the middle of a UTF-8 character; the beginning of
+    the character is held until the piece with its rest arrives.
+    """
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def feed(self, piece):
+        if isinstance(piece, str):
+            return self.flush() + piece
+        return self._decoder.decode(piece)
+
+    def flush(self):
+        return self._decoder.decode(b'', final=True)
+
+
+class StopDetector:
+    """
+    Finds stop sequences in streamed text, also when they are split over several chunks:
+    text which may turn out to be the beginning of a stop sequence is held back.
+    """
+    def __init__(self, stop):
+        self.stop = [s for s in (stop or []) if s]
+        self._held = ""
+
+    def feed(self, text):
+        """
+        :return: the text which can be sent, and whether a stop sequence was found (the text before it is returned)
+        """
+        self._held += text
+        for stop in self.stop:
+            index = self._held.find(stop)
+            if index >= 0:
+                text = self._held[:index]
+                self._held = ""
+                return text, True
+
+        hold = 0
+        for stop in self.stop:
+            for length in range(min(len(stop) - 1, len(self._held)), hold, -1):
+                if self._held.endswith(stop[:length]):
+                    hold = length
+                    break
+
+        text = self._held[:len(self._held) - hold]
+        self._held = self._held[len(self._held) - hold:]
+        return text, False
+
+    def flush(self):
+        text = self._held
+        self._held = ""
+        return text
+
+
+class StreamMetrics:
+    """
+    Timings and sizes of one stream.
+    """
+    def __init__(self, frontend=''):
+        self.frontend = frontend
+        self.started = time.perf_counter()
+        self.first_flush = None
+        self.finished = None
+        self.tokens = 0
+        self.flushes = 0
+        self.bytes = 0
+
+    def token(self):
+        self.tokens += 1
+
+    def flushed(self, text):
+        if self.first_flush is None:
+            self.first_flush = time.perf_counter()
+        self.flushes += 1
+        self.bytes += len(text.encode('utf-8'))
+
+    def finish(self):
+        if self.finished is None:
+            self.finished = time.perf_counter()
+
+    def summary(self):
+        end = self.finished if self.finished is not None else time.perf_counter()
+        duration = end - self.started
+        return {
+            'frontend': self.frontend,
+            'tokens': self.tokens,
+            'flushes': self.flushes,
+            'bytes': self.bytes,
+            'time_to_first_flush': (self.first_flush - self.started) if self.first_flush is not None else None,
+            'duration': duration,
+            'tokens_per_second': self.tokens / duration if duration > 0 else None,
+        }
+
+
+class StreamPipeline:
+    """
+    Turns the completion chunks of a model into the texts a frontend sends.
+
+    Every chunk passes the same stages: its text is taken out of the chunk, token bytes are
+    decoded without splitting UTF-8 characters, `stop` sequences are detected across chunk
+    boundaries, and the text is coalesced by the `StreamFlusher`; `metrics` record the stream
+    and every flush is an event of the `stream` span of `trace`. `run` drives the pipeline over a blocking iterator, `arun` over an async one; frontend
+    adapters such as `SSEAdapter` format the texts.
+    """
+    def __init__(self, flusher=None, stop=None, metrics=None, on_finish=None, trace=None):
+        self.flusher = flusher if flusher is not None else StreamFlusher()
+        self.metrics = metrics if metrics is not None else StreamMetrics()
+        self.finish_reason = None
+        self.usage = None
+        self.stopped = False
+
+        self._texts = []
+        self._utf8 = Utf8Repair()
+        self._stop = StopDetector(stop) if stop else None
+        self._on_finish = on_finish
+        self._span = (trace if trace is not None else UNTRACED).span('stream')
+
+    @staticmethod
+    def from_config(config, frontend='', stop=None, trace=None):
+        flusher = StreamFlusher.from_config(config)
+        pipeline = StreamPipeline(flusher, stop=stop, metrics=StreamMetrics(frontend), trace=trace)
+        pipeline._span.set('flush.max_tokens', flusher.max_tokens)
+        pipeline._span.set('flush.max_delay_ms', flusher.max_delay * 1000)
+        pipeline._span.set('flush.max_bytes', flusher.max_bytes)
+        return pipeline
+
+    @property
+    def text(self):
+        """
+        All text sent so far.
+        """
+        return ''.join(self._texts)
+
+    def _emit(self, text):
+        if text:
+            self.metrics.flushed(text)
+            self._texts.append(text)
+            self._span.event('flush', chars=len(text))
+        return text
+
+    def feed(self, item):
+        """
+        Pass one completion chunk through the pipeline.
+
+        :return: the text to send now, or None
+        """
+        choice = item['choices'][0]
+        self.finish_reason = choice.get('finish_reason') or self.finish_reason
+        self.usage = item.get('usage') or self.usage
+        if choice['text']:
+            self.metrics.token()
+
+        text = self._utf8.feed(choice['text'])
+        if self._stop is not None:
+            text, self.stopped = self._stop.feed(text)
+            if self.stopped:
+                self.finish_reason = 'stop'
+
+        if not text:
+            return None
+        return self._emit(self.flusher.add(text))
+
+    def due_in(self):
+        return self.flusher.due_in()
+
+    def flush(self):
+        return self._emit(self.flusher.flush())
+
+    def finish(self):
+        """
+        The text still held at the end of the stream.
+        """
+        text = self._utf8.flush()
+        if self._stop is not None and not self.stopped:
+            text, self.stopped = self._stop.feed(text)
+            if not self.stopped:
+                text += self._stop.flush()
+        text = self.flusher.flush() + text
+
+        if self.usage is not None:
+            self.metrics.tokens = self.usage['completion_tokens']
+        self.metrics.finish()
+        if self._on_finish is not None:
+            self._on_finish(self.metrics)
+
+        text = self._emit(text)
+        summary = self.metrics.summary()
+        for key in ('tokens', 'flushes', 'bytes', 'time_to_first_flush'):
+            self._span.set(f"stream.{key}", summary[key])
+        self._span.set('stream.finish_reason', self.finish_reason)
+        self._span.close()
+        return text
+
+    def run(self, items):
+        """
+        Drive the pipeline over a blocking iterator of completion chunks, yielding the texts to send.
+        Held text is only flushed when the next chunk arrives.
+        """
+        try:
+            for item in items:
+                text = self.feed(item)
+                if text:
+                    yield text
+                if self.stopped:
+                    break
+        finally:
+            # a stream which is not consumed to its end gives its model back right away
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+
+        text = self.finish()
+        if text:
+            yield text
+
+    async def arun(self, stream, first=None):
+        """
+        Drive the pipeline over an async iterator of completion chunks, yielding the texts to send.
+        Held text is flushed when the next chunk takes longer than the flush delay.
+
+        :param first: a chunk already taken from `stream`
+        """
+        async def next_item():
+            try:
+                return await stream.__anext__()
+            except StopAsyncIteration:
+                return None
+
+        item = first if first is not None else await next_item()
+        while item is not None:
+            text = self.feed(item)
+            if text:
+                yield text
+            if self.stopped:
+                break
+
+            if not self.flusher.pending():
+                item = await next_item()
+                continue
+
+            pending = asyncio.ensure_future(next_item())
+            try:
+                while not (await asyncio.wait({pending}, timeout=self.due_in()))[0]:
+                    yield self.flush()
+            finally:
+                pending.cancel()
+            item = pending.result()
+
+        text = self.finish()
+        if text:
+            yield text
+
+
+class SSEAdapter:
+    """
+    Formats the texts of a stream as OpenAI `chat.completion.chunk` server-sent events.
+
+    The chunks in the middle of a stream only differ in their text, so the JSON around it is
+    encoded once per stream.
+    """
+    DONE = "data: [DONE]\n\n"
+
+    def __init__(self, model_name, completion_id='0', created=None):
+        self.model_name = model_name
+        self.completion_id = completion_id
+        self.created = created if created is not None else int(time.time())
+        self._first = True
+        self._head, self._tail = self.chunk('\0').split(json.dumps('\0'))
+
+    def chunk(self, text, role=None, finish_reason=None, usage=None):
+        chunk = {
+            'id': self.completion_id,
+            'object': 'chat.completion.chunk',
+            'created': self.created,
+            'model': self.model_name,
+            'choices': [{
+                "delta": {
+                    "content": text
+                },
+                'index': 0,
+                'logprobs': None,
+                'finish_reason': finish_reason
+            }]
+        }
+
+        if role is not None:
+            chunk['choices'][0]['delta']['role'] = role
+
+        if usage is not None:
+            chunk['usage'] = usage
+
+        return f"data: {json.dumps(chunk)}\n\n"
+
+    def content(self, text):
+        if self._first:
+            self._first = False
+            return self.chunk(text, role='assistant')
+        return f"{self._head}{json.dumps(text)}{self._tail}"
+
+    def last(self, finish_reason, usage=None):
+        role = 'assistant' if self._first else None
+        self._first = False
+        return self.chunk('', role=role, finish_reason=finish_reason, usage=usage)
+
+    async def events(self, pipeline, stream, first=None):
+        async for text in pipeline.arun(stream, first=first):
+            yield self.content(text)
+
+        # the last chunk carries the finish reason and the usage of the completion
+        yield self.last(pipeline.finish_reason, pipeline.usage)
+        yield SSEAdapter.DONE
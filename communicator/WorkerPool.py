@@ -0,0 +1,464 @@
+import os
+import time
+import zlib
+import queue
+import itertools
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+from util.ConfigLoader import ConfigLoader
+from communicator.LLMCommunicator import LLMCommunicator
+from communicator.RequestScheduler import RequestScheduler, SchedulerError
+from communicator.ContextWindow import ContextLengthError, InvalidRequestError
+
+
+def _worker_main(worker_id, conn, config):
+    """
+    Entry point of an inference worker process.
+
+    The worker loads its models through its own `LLMCommunicator` pool; llama.cpp maps the
+    GGUF weights with mmap, so all workers share one copy of them in the page cache.
+    """
+    ConfigLoader().set(config)
+
+    send_lock = threading.Lock()
+    streams = {}
+    # set when the front process cancels a request, which may happen before its stream exists
+    cancelled = {}
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def handle(request_id, model_name, kwargs):
+        trace = kwargs.get('trace')
+        llm = None
+        try:
+            # requests for other models of this worker must not unload this one meanwhile
+            llm = LLMCommunicator.pool().get_model(model_name, pin=True)
+            if kwargs.get('stream'):
+                stream = llm.complete_messages(**kwargs)
+                streams[request_id] = stream
+                if cancelled[request_id].is_set():
+                    stream.close()
+                for chunk in stream:
+                    send(('chunk', request_id, chunk))
+                send(('done', request_id, None))
+            else:
+                send(('done', request_id, llm.complete_messages(**kwargs)))
+        except SchedulerError as e:
+            send(('error', request_id, {'message': e.message, 'status_code': e.status_code, 'retry_after': e.retry_after}))
+        except InvalidRequestError as e:
+            # invalid requests, e.g. a prompt which does not fit into the context window; the
+            # front process raises the same exception again, see `RemoteStream`
+            error_type = 'context_length' if isinstance(e, ContextLengthError) else 'invalid_request'
+            send(('error', request_id, {'message': str(e), 'status_code': 400, 'retry_after': None, 'error_type': error_type}))
+        except Exception as e:
+            if config['debug_mode']:
+                traceback.print_exc()
+            send(('error', request_id, {'message': f"{type(e).__name__}: {e}", 'status_code': 500, 'retry_after': None}))
+        finally:
+            streams.pop(request_id, None)
+            cancelled.pop(request_id, None)
+            if llm is not None:
+                LLMCommunicator.pool().unpin(llm)
+            if trace is not None:
+                trace.finish()
+
+    # load the default model before accepting work
+    try:
+        LLMCommunicator.get()
+        send(('ready', worker_id, os.getpid()))
+    except Exception as e:
+        send(('failed', worker_id, f"{type(e).__name__}: {e}"))
+        return
+
+    while True:
+        try:
+            kind, request_id, payload = conn.recv()
+        except (EOFError, OSError):
+            # the front process is gone
+            os._exit(0)
+
+        if kind == 'complete':
+            cancelled[request_id] = threading.Event()
+            thread = threading.Thread(target=handle, args=(request_id, payload['model'], payload['kwargs']), daemon=True)
+            thread.start()
+        elif kind == 'cancel':
+            event = cancelled.get(request_id)
+            if event is not None:
+                event.set()
+            stream = streams.get(request_id)
+            if stream is not None:
+                stream.close()
+        elif kind == 'unload':
+            LLMCommunicator.pop(payload)
+        elif kind == 'shutdown':
+            os._exit(0)
+
+
+class RemoteStream:
+    """
+    Iterator over the chunks of a completion running in a worker process.
+    Closing it cancels the completion in the worker.
+    """
+    def __init__(self, pool, request_id):
+        self._pool = pool
+        self._request_id = request_id
+        self._queue = queue.Queue()
+        self._finished = False
+        self.result = None
+
+    def _put(self, kind, payload):
+        self._queue.put((kind, payload))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+
+        kind, payload = self._queue.get()
+        if kind == 'chunk':
+            return payload
+
+        self._finished = True
+        self._pool._forget(self._request_id)
+        if kind == 'done':
+            self.result = payload
+            raise StopIteration
+        if payload.get('error_type') == 'context_length':
+            raise ContextLengthError(payload['message'])
+        if payload.get('error_type') == 'invalid_request':
+            raise InvalidRequestError(payload['message'])
+        raise SchedulerError(payload['message'], status_code=payload['status_code'], retry_after=payload['retry_after'])
+
+    def wait(self):
+        for _ in self:
+            pass
+        return self.result
+
+    def close(self):
+        if not self._finished:
+            self._finished = True
+            self._pool._cancel(self._request_id)
+
+    def __del__(self):
+        self.close()
+
+
+class RemoteCommunicator:
+    """
+    Stand-in for `LLMCommunicator` in the front process, completions run in the worker pool.
+    """
+    def __init__(self, pool, model_name):
+        config = ConfigLoader().get()
+        if model_name != config['model']:
+            config = ConfigLoader().get_model_config(model_name)
+
+        self.config = config
+        self.model_name = model_name
+        self._pool = pool
+
+        # the front scheduler only provides back-pressure, the workers serialize access to their model
+        batching_config = config.get('batching', {})
+        worker_slots = batching_config.get('n_parallel', 4) if batching_config.get('enabled', False) else 1
+        self.scheduler = RequestScheduler(config.get('scheduler'), slots=pool.processes * worker_slots, name=model_name)
+        self._executor = ThreadPoolExecutor(max_workers=self.scheduler.slots, thread_name_prefix='llm-remote')
+
+    def complete_messages(self, messages, max_tokens=8196, temperature=0.0, repeat_penalty=1.1, echo=True, stream=False, ticket=None, priority=0, frontend='http', details=False, sampling=None, stop=None, n=1, trace=None):
+        if ticket is None:
+            ticket = self.scheduler.acquire(priority=priority, frontend=frontend)
+
+        # the slot is given back if anything fails before the completion owns the ticket
+        try:
+            if trace is not None:
+                now = time.perf_counter()
+                trace.add_span('queue', now - ticket.queue_wait, now, model=self.model_name)
+        except BaseException:
+            ticket.release()
+            raise
+
+        kwargs = {
+            'messages': messages,
+            'max_tokens': max_tokens,
+            'temperature': temperature,
+            'repeat_penalty': repeat_penalty,
+            'echo': echo,
+            'stream': stream,
+            'priority': priority,
+            'frontend': frontend,
+            'details': details,
+            'sampling': sampling,
+            'stop': stop,
+            'n': n,
+            # the worker records its spans under the same trace id
+            'trace': trace if trace is not None and trace.sampled else None,
+        }
+
+        if not stream:
+            with ticket:
+                return self._pool.submit(self.model_name, kwargs, affinity_key=WorkerPool.affinity_key(messages)).wait()
+
+        try:
+            response_stream = self._pool.submit(self.model_name, kwargs, affinity_key=WorkerPool.affinity_key(messages))
+        except BaseException:
+            ticket.release()
+            raise
+
+        return self.scheduler.lease(response_stream, ticket)
+
+    acomplete_messages = LLMCommunicator.acomplete_messages
+
+    def offload_model(self):
+        self._pool.broadcast('unload', self.model_name)
+
+
+class _Worker:
+    def __init__(self, index, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.ready = False
+        self.started_at = time.monotonic()
+        # the error of a worker which could not load its model
+        self.error = None
+        self.restart_at = None
+        self.gave_up = False
+
+
+class WorkerPool:
+    """
+    Supervised pool of inference worker processes.
+
+    Requests are dispatched over pipes; all turns of one conversation go to the same worker
+    (session affinity) so its prefix cache keeps paying off. Dead workers are restarted and
+    their in-flight requests fail instead of hanging; a worker which dies before it is ready
+    is restarted after a growing delay, and not any more after `max_start_failures` in a row.
+    """
+    _lock = threading.Lock()
+    _instance = None
+
+    def __init__(self, processes, config=None):
+        if config is None:
+            config = ConfigLoader().get()
+
+        workers_config = config.get('workers', {})
+        self.processes = processes
+        self.max_start_failures = workers_config.get('max_start_failures', 3)
+        self._config = config
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = [None] * processes
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self._start_failures = [0] * processes
+        self._stopped = False
+
+        for index in range(processes):
+            self._start_worker(index)
+
+        self._supervisor = threading.Thread(target=self._supervise, daemon=True, name='worker-supervisor')
+        self._supervisor.start()
+
+    @staticmethod
+    def affinity_key(messages):
+        # the opening of a conversation stays the same for all of its turns
+        head = [f"{m.get('role', 'user')}:{m.get('content', '')}" for m in messages[:2]]
+        return "\n".join(head)
+
+    def communicator(self, model_name):
+        return RemoteCommunicator(self, model_name)
+
+    def submit(self, model_name, kwargs, affinity_key=''):
+        worker = self._pick_worker(affinity_key)
+        request_id = next(self._request_ids)
+        stream = RemoteStream(self, request_id)
+
+        with self._pending_lock:
+            self._pending[request_id] = (worker.index, stream)
+
+        try:
+            with worker.send_lock:
+                worker.conn.send(('complete', request_id, {'model': model_name, 'kwargs': kwargs}))
+        except (OSError, ValueError) as e:
+            self._forget(request_id)
+            raise SchedulerError(f"worker {worker.index} is not available: {e}", status_code=503, retry_after=1)
+
+        return stream
+
+    def ready_count(self):
+        return sum(1 for worker in self._workers if worker is not None and worker.ready and worker.process.is_alive())
+
+    def failed(self):
+        """
+        True when no worker is restarted any more because none of them could load its model.
+        """
+        return bool(self._workers) and all(worker is not None and worker.gave_up for worker in self._workers)
+
+    def start_error(self):
+        """
+        The last error of a worker which could not load its model, or None.
+        """
+        errors = [worker.error for worker in self._workers if worker is not None and worker.error]
+        return errors[-1] if errors else None
+
+    def wait_ready(self, timeout=None):
+        """
+        Block until at least one worker has loaded its model, return True when one has.
+        Returns False after `timeout` seconds, or once all workers gave up starting.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.ready_count() == 0:
+            if self.failed() or (deadline is not None and time.monotonic() >= deadline):
+                return False
+            time.sleep(0.1)
+        return True
+
+    def broadcast(self, kind, payload=None):
+        for worker in self._workers:
+            if worker is None or not worker.process.is_alive():
+                continue
+            try:
+                with worker.send_lock:
+                    worker.conn.send((kind, None, payload))
+            except (OSError, ValueError):
+                pass
+
+    def stats(self):
+        with self._pending_lock:
+            in_flight = [0] * self.processes
+            for index, _ in self._pending.values():
+                in_flight[index] += 1
+
+        return [{
+            'index': worker.index,
+            'pid': worker.process.pid,
+            'alive': worker.process.is_alive(),
+            'ready': worker.ready,
+            'in_flight': in_flight[worker.index],
+            'start_failures': self._start_failures[worker.index],
+        } for worker in self._workers if worker is not None]
+
+    def shutdown(self):
+        self._stopped = True
+        self.broadcast('shutdown')
+        for worker in self._workers:
+            if worker is not None:
+                worker.process.join(timeout=5)
+
+    def _start_worker(self, index):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, child_conn, self._config),
+            daemon=True,
+            name=f"llm-worker-{index}"
+        )
+        process.start()
+        child_conn.close()
+
+        worker = _Worker(index, process, parent_conn)
+        self._workers[index] = worker
+
+        reader = threading.Thread(target=self._read, args=(worker,), daemon=True, name=f"worker-reader-{index}")
+        reader.start()
+
+    def _pick_worker(self, affinity_key):
+        start = zlib.crc32(affinity_key.encode('utf-8')) % self.processes
+        for offset in range(self.processes):
+            worker = self._workers[(start + offset) % self.processes]
+            if worker is not None and worker.process.is_alive():
+                return worker
+        raise SchedulerError("no inference worker is available", status_code=503, retry_after=5)
+
+    def _read(self, worker):
+        while True:
+            try:
+                kind, request_id, payload = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if kind == 'ready':
+                worker.ready = True
+                self._start_failures[worker.index] = 0
+                print(f"inference worker {worker.index} (pid {payload}) is ready")
+                continue
+            if kind == 'failed':
+                worker.error = payload
+                print(f"inference worker {worker.index} failed to start: {payload}")
+                continue
+
+            with self._pending_lock:
+                entry = self._pending.get(request_id)
+            if entry is not None:
+                entry[1]._put(kind, payload)
+
+        self._fail_pending(worker.index)
+
+    def _supervise(self):
+        while not self._stopped:
+            time.sleep(1)
+            for index, worker in enumerate(self._workers):
+                if self._stopped or worker is None or worker.gave_up or worker.process.is_alive():
+                    continue
+
+                if worker.restart_at is None:
+                    self._fail_pending(index)
+
+                    # do not spin when a worker dies right away (e.g. the model can not be loaded)
+                    if not worker.ready or time.monotonic() - worker.started_at < 10:
+                        self._start_failures[index] += 1
+                        if worker.error is None:
+                            worker.error = f"exited with code {worker.process.exitcode}"
+                    failures = self._start_failures[index]
+                    if self.max_start_failures and failures >= self.max_start_failures:
+                        worker.gave_up = True
+                        print(f"inference worker {index} failed to start {failures} times in a row, it is not restarted: {worker.error}")
+                        continue
+
+                    delay = min(60, 5 * 2 ** (failures - 1)) if failures else 0
+                    worker.restart_at = time.monotonic() + delay
+                    print(f"inference worker {index} exited with code {worker.process.exitcode}, restarting in {delay}s...")
+
+                if time.monotonic() >= worker.restart_at:
+                    self._start_worker(index)
+
+    def _fail_pending(self, index):
+        with self._pending_lock:
+            failed = [(request_id, stream) for request_id, (worker_index, stream) in self._pending.items() if worker_index == index]
+            for request_id, _ in failed:
+                del self._pending[request_id]
+
+        for _, stream in failed:
+            stream._put('error', {'message': f"inference worker {index} exited", 'status_code': 503, 'retry_after': 1})
+
+    def _forget(self, request_id):
+        with self._pending_lock:
+            self._pending.pop(request_id, None)
+
+    def _cancel(self, request_id):
+        with self._pending_lock:
+            entry = self._pending.pop(request_id, None)
+        if entry is None:
+            return
+
+        worker = self._workers[entry[0]]
+        try:
+            with worker.send_lock:
+                worker.conn.send(('cancel', request_id, None))
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def get():
+        with WorkerPool._lock:
+            if WorkerPool._instance is None:
+                workers_config = ConfigLoader().get().get('workers', {})
+                WorkerPool._instance = WorkerPool(workers_config.get('processes', 0))
+
+            return WorkerPool._instance
@@ -3,8 +3,11 @@ import pandas as pd
 import webbrowser
 
 from util.ConfigLoader import ConfigLoader
+from util.Tracer import Tracer
 from util.Utilities import detect_os
 from communicator.LLMCommunicator import LLMCommunicator
+from communicator.RequestScheduler import SchedulerError
+from communicator.StreamPipeline import StreamPipeline
 
 const_values = None
 theme = gr.themes.Default(
@@ -144,9 +147,9 @@ def handle_bot_msg(history):
     global openai_client
     
     config = ConfigLoader().get()
-    model_config = config['model_config']
+    llm = LLMCommunicator.get()
+    model_config = llm.config['model_config']
     default_completion_config = model_config['default_completion_config']
-    stream_batch_size = config['stream_batch_size']
     
     messages = build_messages(history)
     if config["gui_log"]: print(f"messages = {messages}")
@@ -157,7 +160,6 @@ def handle_bot_msg(history):
     #     stream=True, 
     #     temperature=0.0
     # )
-    llm = LLMCommunicator.get()
     
     # stream mode
     # response_stream = res
@@ -172,50 +174,27 @@ def handle_bot_msg(history):
     # print(f"default_repeat_penalty = {default_repeat_penalty}")
     # print(f"default_echo = {default_echo}")
     
-    response_stream = llm.complete_messages(
-        messages, 
-        max_tokens=default_max_tokens,
-        temperature=default_temperature,
-        repeat_penalty=default_repeat_penalty,
-        echo=default_echo,
-        stream=True
-    )
+    trace = Tracer.get().start('gradio')
+    try:
+        response_stream = llm.complete_messages(
+            messages, 
+            max_tokens=default_max_tokens,
+            temperature=default_temperature,
+            repeat_penalty=default_repeat_penalty,
+            echo=default_echo,
+            stream=True,
+            frontend='gradio',
+            trace=trace
+        )
+    except SchedulerError as e:
+        raise gr.Error(e.message)
     
-    def generate(batch_size=stream_batch_size):
-        prev_item = next(response_stream, None)  # Get the first item
-        bulk_text = ""
-        current_batch_size = 0
-        first_item = True
-
-        for item in response_stream:
-            # option 1: directly yeild the current value
-            # yield get_response_json(prev_item.choices[0].delta.content)
-
-            # option 2: yield values in bulk
-            # bulk_text += prev_item.choices[0].delta.content
-            bulk_text += prev_item['choices'][0]['text']
-            current_batch_size += 1
-
-            if current_batch_size == batch_size:
-                if first_item:
-                    yield bulk_text
-                    first_item = False
-                else:
-                    yield bulk_text
-
-                bulk_text = ""
-                current_batch_size = 0
-
-            prev_item = item
-
-        # Handle the last item
-        if prev_item is not None:
-            # option 1: directly yeild the current value
-            if config["gui_log"]: print(f"token[END] = {item['choices'][0]['delta']['content']}")
-
-            # option 2: yield values in bulk
-            bulk_text += prev_item['choices'][0]['text']
-            yield bulk_text
+    pipeline = StreamPipeline.from_config(config, frontend='gradio', trace=trace)
+    def generate():
+        try:
+            yield from pipeline.run(response_stream)
+        finally:
+            trace.finish()
     
     completion = generate()
     history[-1][1] = ""
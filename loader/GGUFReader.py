@@ -0,0 +1,141 @@
+# ./loader/GGUFReader.py
+
+import struct
+
+
+GGUF_MAGIC = b'GGUF'
+
+# value types of the GGUF key/value section
+_SCALARS = {
+    0: '<B',    # uint8
+    1: '<b',    # int8
+    2: '<H',    # uint16
+    3: '<h',    # int16
+    4: '<I',    # uint32
+    5: '<i',    # int32
+    6: '<f',    # float32
+    7: '<?',    # bool
+    10: '<Q',   # uint64
+    11: '<q',   # int64
+    12: '<d',   # float64
+}
+_STRING = 8
+_ARRAY = 9
+
+# `general.file_type` values of llama.cpp
+FILE_TYPES = {
+    0: 'F32', 1: 'F16', 2: 'Q4_0', 3: 'Q4_1', 7: 'Q8_0', 8: 'Q5_0', 9: 'Q5_1',
+    10: 'Q2_K', 11: 'Q3_K_S', 12: 'Q3_K_M', 13: 'Q3_K_L', 14: 'Q4_K_S', 15: 'Q4_K_M',
+    16: 'Q5_K_S', 17: 'Q5_K_M', 18: 'Q6_K', 19: 'IQ2_XXS', 20: 'IQ2_XS', 21: 'Q2_K_S',
+    22: 'IQ3_XS', 23: 'IQ3_XXS', 24: 'IQ1_S', 25: 'IQ4_NL', 26: 'IQ3_S', 27: 'IQ3_M',
+    28: 'IQ2_S', 29: 'IQ2_M', 30: 'IQ4_XS', 31: 'IQ1_M', 32: 'BF16',
+}
+
+
+class GGUFError(Exception):
+    pass
+
+
+class _Reader:
+    def __init__(self, file, version):
+        self.file = file
+        self.version = version
+
+    def read(self, fmt):
+        size = struct.calcsize(fmt)
+        data = self.file.read(size)
+        if len(data) != size:
+            raise GGUFError("unexpected end of file")
+        return struct.unpack(fmt, data)[0]
+
+    def read_count(self):
+        # GGUF v1 used 32 bit counts and lengths
+        return self.read('<I' if self.version == 1 else '<Q')
+
+    def read_string(self):
+        length = self.read_count()
+        data = self.file.read(length)
+        if len(data) != length:
+            raise GGUFError("unexpected end of file")
+        return data.decode('utf-8', errors='replace')
+
+    def skip_string(self):
+        self.file.seek(self.read_count(), 1)
+
+    def read_value(self, value_type, keep_arrays):
+        if value_type in _SCALARS:
+            return self.read(_SCALARS[value_type])
+        if value_type == _STRING:
+            return self.read_string()
+        if value_type == _ARRAY:
+            item_type = self.read('<I')
+            count = self.read_count()
+            if keep_arrays:
+                return [self.read_value(item_type, keep_arrays) for _ in range(count)]
+            self.skip_array(item_type, count)
+            return count
+        raise GGUFError(f"unknown value type {value_type}")
+
+    def skip_array(self, item_type, count):
+        if item_type in _SCALARS:
+            self.file.seek(struct.calcsize(_SCALARS[item_type]) * count, 1)
+        elif item_type == _STRING:
+            for _ in range(count):
+                self.skip_string()
+        elif item_type == _ARRAY:
+            for _ in range(count):
+                self.skip_array(self.read('<I'), self.read_count())
+        else:
+            raise GGUFError(f"unknown value type {item_type}")
+
+
+def read_gguf_metadata(file_path, keep_arrays=False):
+    """
+    Read the key/value header of a GGUF file without touching its tensor data.
+
+    :param file_path: The path to the GGUF file
+    :param keep_arrays: Whether array values (e.g. the tokenizer vocabulary) are returned, otherwise only their length is
+    :return: A dict with `version`, `tensor_count` and `metadata`
+    """
+    with open(file_path, 'rb') as file:
+        if file.read(4) != GGUF_MAGIC:
+            raise GGUFError(f"{file_path} is not a GGUF file")
+
+        version = struct.unpack('<I', file.read(4))[0]
+        reader = _Reader(file, version)
+        tensor_count = reader.read_count()
+        kv_count = reader.read_count()
+
+        metadata = {}
+        for _ in range(kv_count):
+            key = reader.read_string()
+            value_type = reader.read('<I')
+            metadata[key] = reader.read_value(value_type, keep_arrays)
+
+    return {
+        'version': version,
+        'tensor_count': tensor_count,
+        'metadata': metadata,
+    }
+
+
+def summarize_gguf(file_path):
+    """
+    The facts about a GGUF model file which are useful to pick a model, e.g. its quantization and context length.
+    """
+    header = read_gguf_metadata(file_path)
+    metadata = header['metadata']
+    architecture = metadata.get('general.architecture')
+    file_type = metadata.get('general.file_type')
+
+    return {
+        'architecture': architecture,
+        'name': metadata.get('general.name'),
+        'quantization': FILE_TYPES.get(file_type, file_type),
+        'context_length': metadata.get(f"{architecture}.context_length"),
+        'embedding_length': metadata.get(f"{architecture}.embedding_length"),
+        'block_count': metadata.get(f"{architecture}.block_count"),
+        'vocab_size': metadata.get('tokenizer.ggml.tokens'),
+        'tensor_count': header['tensor_count'],
+        'gguf_version': header['version'],
+    }
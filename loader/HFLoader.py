@@ -1,11 +1,10 @@
 # ./loader/HFLoader.py
 
 import os
-import shutil
-from huggingface_hub import hf_hub_download
 
 from util.ConfigLoader import ConfigLoader
 from util.Utilities import convert_path
+from loader.ModelDownloader import ModelDownloader
 
 
 def load_model(model_config=None):
@@ -45,10 +44,30 @@ def load_model(model_config=None):
                 os.makedirs(current_path)
                 print(f"Created folder: {current_path}")
 
-        # download model file and move to the destination
-        model_path = hf_hub_download(repo_id=model_config['hf_id'], filename=model_config['hf_file'])
+        # download model file straight into the destination, `.part` files of an interrupted download are resumed
+        task = ModelDownloader.get().download(model_config['hf_id'], model_config['hf_file'], target_model_path)
+        task.wait()
+        print(f"downloaded {target_model_path} (sha256 {task.sha256})")
 
-        actual_file = os.path.realpath(model_path)
 
-        print('actual_file =', actual_file)
-        shutil.move(actual_file, target_model_path)
+def pull_model(hf_id, hf_file, config_name, base_config_name, on_done=None):
+    """
+    Create the model configuration `config_name` from `base_config_name` for `hf_file` of `hf_id`
+    and download the model file in the background.
+
+    :return: the `DownloadTask`, or None when the file is already there
+    """
+    config = ConfigLoader().get()
+    
+    new_llm_config = ConfigLoader.read_config(f"{base_config_name}.yaml", path="./llm_config/")
+    if not new_llm_config:
+        raise FileNotFoundError(f"model configuration ./llm_config/{base_config_name}.yaml does not exist")
+    new_llm_config['model_config']['hf_id'] = hf_id
+    new_llm_config['model_config']['hf_file'] = hf_file
+    ConfigLoader.save_config(f"{config_name}.yaml", path="./llm_config/", config=new_llm_config)
+    
+    target_model_path = f"{convert_path(config['model_root'])}/{hf_id}/{hf_file}"
+    if os.path.exists(target_model_path):
+        return None
+    
+    return ModelDownloader.get().start(hf_id, hf_file, target_model_path, on_done=on_done)
@@ -0,0 +1,378 @@
+# ./loader/ModelDownloader.py
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from util.ConfigLoader import ConfigLoader
+from loader.ModelRegistry import ModelRegistry
+
+
+class DownloadError(Exception):
+    pass
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # the hub answers with the file metadata on the redirect itself, so it must not be followed blindly
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class DownloadTask:
+    """
+    Progress of one model file download.
+    """
+    QUEUED = 'queued'
+    DOWNLOADING = 'downloading'
+    VERIFYING = 'verifying'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, task_id, url, target_path):
+        self.task_id = task_id
+        self.url = url
+        self.target_path = target_path
+        self.state = DownloadTask.QUEUED
+        self.total_bytes = None
+        self.downloaded_bytes = 0
+        self.resumed_bytes = 0
+        self.sha256 = None
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def _add(self, size):
+        with self._lock:
+            self.downloaded_bytes += size
+
+    def _finish(self, state, error=None):
+        self.state = state
+        self.error = error
+        self.finished_at = time.time()
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        Block until the download is finished, raise `DownloadError` if it failed.
+        """
+        if not self._done.wait(timeout):
+            return False
+        if self.state == DownloadTask.FAILED:
+            raise DownloadError(self.error)
+        return True
+
+    def is_finished(self):
+        return self._done.is_set()
+
+    def progress(self):
+        with self._lock:
+            downloaded = self.downloaded_bytes
+
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        speed = (downloaded - self.resumed_bytes) / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total_bytes and speed > 0 and self.state == DownloadTask.DOWNLOADING:
+            eta = round((self.total_bytes - downloaded) / speed, 1)
+
+        return {
+            'id': self.task_id,
+            'url': self.url,
+            'target_path': self.target_path,
+            'state': self.state,
+            'downloaded_bytes': downloaded,
+            'total_bytes': self.total_bytes,
+            'progress': round(downloaded / self.total_bytes, 4) if self.total_bytes else None,
+            'speed_bytes_per_second': round(speed),
+            'eta_seconds': eta,
+            'sha256': self.sha256,
+            'error': self.error,
+        }
+
+
+class ModelDownloader:
+    """
+    Downloads model files with parallel ranged requests.
+
+    Data is written into `<target>.part` next to the target file and the finished chunks are
+    recorded in `<target>.part.json`, so an interrupted download resumes where it stopped.
+    The file is hashed in order while the chunks arrive, checked against the SHA-256 the hub
+    reports for it and only then renamed into place; the rename never crosses a filesystem.
+
+    :param download_config: the `download` section of the configuration
+    """
+    _lock = threading.Lock()
+    _instance = None
+
+    def __init__(self, download_config=None):
+        if download_config is None:
+            download_config = ConfigLoader().get().get('download', {})
+
+        self.mirror_url = download_config.get('mirror_url', 'https://huggingface.co').rstrip('/')
+        self.revision = download_config.get('revision', 'main')
+        self.connections = max(1, download_config.get('connections', 4))
+        self.chunk_size = max(1, int(download_config.get('chunk_mb', 64))) * 1024 * 1024
+        self.timeout = download_config.get('timeout', 30)
+        self.retries = download_config.get('retries', 3)
+        self.token = os.getenv('HF_TOKEN') or download_config.get('token') or None
+
+        self._tasks_lock = threading.Lock()
+        self._tasks = {}
+        self._task_ids = 0
+
+    def file_url(self, hf_id, hf_file):
+        return f"{self.mirror_url}/{hf_id}/resolve/{urllib.parse.quote(self.revision)}/{urllib.parse.quote(hf_file)}"
+
+    def start(self, hf_id, hf_file, target_path, on_done=None):
+        """
+        Download `hf_file` of `hf_id` to `target_path` in a background thread.
+
+        A download of the same target which is still running is returned instead of starting another one.
+        """
+        url = self.file_url(hf_id, hf_file)
+
+        with self._tasks_lock:
+            for task in self._tasks.values():
+                if task.target_path == target_path and not task.is_finished():
+                    return task
+
+            self._task_ids += 1
+            task = DownloadTask(str(self._task_ids), url, target_path)
+            self._tasks[task.task_id] = task
+
+        def run():
+            try:
+                self._download(task)
+                task._finish(DownloadTask.DONE)
+            except Exception as e:
+                task._finish(DownloadTask.FAILED, error=f"{type(e).__name__}: {e}")
+            if on_done is not None:
+                on_done(task)
+
+        thread = threading.Thread(target=run, daemon=True, name=f"model-download-{task.task_id}")
+        thread.start()
+        return task
+
+    def download(self, hf_id, hf_file, target_path, report_interval=5):
+        """
+        Download `hf_file` of `hf_id` to `target_path` and wait for it, printing the progress.
+        """
+        task = self.start(hf_id, hf_file, target_path)
+        while not task.wait(timeout=report_interval):
+            progress = task.progress()
+            if progress['total_bytes']:
+                print(f"downloading {os.path.basename(target_path)}: {progress['downloaded_bytes'] / (1 << 20):.0f}/{progress['total_bytes'] / (1 << 20):.0f} MB ({progress['speed_bytes_per_second'] / (1 << 20):.1f} MB/s)")
+        return task
+
+    def tasks(self):
+        with self._tasks_lock:
+            return [task.progress() for task in self._tasks.values()]
+
+    def task(self, task_id):
+        with self._tasks_lock:
+            return self._tasks.get(task_id)
+
+    def _request(self, url, method='GET', headers=None):
+        request = urllib.request.Request(url, method=method, headers=dict(headers or {}))
+        if self.token and url.startswith(self.mirror_url):
+            request.add_header('Authorization', f"Bearer {self.token}")
+        return request
+
+    def _metadata(self, url):
+        # returns the url serving the content, its size, its sha256 and whether ranges are supported
+        opener = urllib.request.build_opener(_NoRedirect)
+        headers = {}
+        for _ in range(5):
+            try:
+                response = opener.open(self._request(url, method='HEAD', headers={'Accept-Encoding': 'identity'}), timeout=self.timeout)
+            except urllib.error.HTTPError as e:
+                if e.code not in (301, 302, 303, 307, 308):
+                    raise DownloadError(f"HEAD {url} failed with HTTP {e.code}")
+                headers.update({key.lower(): value for key, value in e.headers.items() if key.lower().startswith('x-linked-')})
+                url = urllib.parse.urljoin(url, e.headers['Location'])
+                continue
+
+            with response:
+                headers.update({key.lower(): value for key, value in response.headers.items() if key.lower() not in headers})
+
+            size = headers.get('x-linked-size') or headers.get('content-length')
+            # LFS files carry their sha256 as (linked) ETag
+            etag = (headers.get('x-linked-etag') or headers.get('etag') or '').strip()
+            etag = re.sub(r'^W/', '', etag).strip('"')
+            sha256 = etag.lower() if re.fullmatch(r'[0-9a-fA-F]{64}', etag) else None
+            ranges = headers.get('accept-ranges', '').lower() == 'bytes'
+            return url, (int(size) if size is not None else None), sha256, ranges
+
+        raise DownloadError(f"too many redirects for {url}")
+
+    def _download(self, task):
+        url, size, sha256, ranges = self._metadata(task.url)
+        task.total_bytes = size
+
+        # the same content was pulled under another name before, link it instead of downloading it again
+        if sha256 is not None and ModelRegistry.get().link(sha256, task.target_path):
+            task.sha256 = sha256
+            task._add(size or 0)
+            return
+
+        task.state = DownloadTask.DOWNLOADING
+
+        target_dir = os.path.dirname(task.target_path)
+        os.makedirs(target_dir, exist_ok=True)
+        part_path = f"{task.target_path}.part"
+        journal_path = f"{task.target_path}.part.json"
+
+        if size is None or not ranges:
+            digest = self._download_stream(task, url, part_path)
+        else:
+            digest = self._download_chunks(task, url, size, sha256, part_path, journal_path)
+
+        task.state = DownloadTask.VERIFYING
+        task.sha256 = digest
+        if sha256 is not None and digest != sha256:
+            for path in (part_path, journal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise DownloadError(f"checksum mismatch for {os.path.basename(task.target_path)}: expected {sha256}, got {digest}")
+
+        # the part file lives next to the target, so this is an atomic rename and never a copy
+        os.replace(part_path, task.target_path)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+
+        ModelRegistry.get().register(task.target_path, sha256=digest)
+
+    def _download_stream(self, task, url, part_path):
+        hasher = hashlib.sha256()
+        with self._open(url) as response, open(part_path, 'wb') as file:
+            while True:
+                data = response.read(1 << 20)
+                if not data:
+                    break
+                file.write(data)
+                hasher.update(data)
+                task._add(len(data))
+            file.flush()
+            os.fsync(file.fileno())
+        return hasher.hexdigest()
+
+    def _download_chunks(self, task, url, size, sha256, part_path, journal_path):
+        chunks = [(start, min(start + self.chunk_size, size)) for start in range(0, size, self.chunk_size)]
+        done = self._read_journal(journal_path, part_path, size, sha256)
+
+        if not os.path.exists(part_path):
+            done = set()
+        with open(part_path, 'ab') as file:
+            file.truncate(size)
+
+        task.resumed_bytes = sum(chunks[index][1] - chunks[index][0] for index in done)
+        task._add(task.resumed_bytes)
+
+        hasher = hashlib.sha256()
+        hashed = 0
+        journal_lock = threading.Lock()
+
+        def fetch(index):
+            start, end = chunks[index]
+            self._fetch_range(task, url, part_path, start, end)
+            with journal_lock:
+                done.add(index)
+                self._write_journal(journal_path, size, sha256, done)
+            return index
+
+        with open(part_path, 'rb') as reader, ThreadPoolExecutor(max_workers=self.connections, thread_name_prefix='model-download') as executor:
+            pending = {executor.submit(fetch, index) for index in range(len(chunks)) if index not in done}
+
+            while True:
+                # hash the finished chunks in order while the later ones are still being fetched
+                while hashed < len(chunks) and hashed in done:
+                    start, end = chunks[hashed]
+                    reader.seek(start)
+                    remaining = end - start
+                    while remaining > 0:
+                        data = reader.read(min(remaining, 1 << 20))
+                        if not data:
+                            raise DownloadError(f"{part_path} is shorter than expected")
+                        hasher.update(data)
+                        remaining -= len(data)
+                    hashed += 1
+
+                if not pending:
+                    break
+
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    if future.exception() is not None:
+                        for other in pending:
+                            other.cancel()
+                        raise future.exception()
+
+        return hasher.hexdigest()
+
+    def _fetch_range(self, task, url, part_path, start, end):
+        for attempt in range(self.retries + 1):
+            received = 0
+            try:
+                with self._open(url, headers={'Range': f"bytes={start}-{end - 1}"}) as response, open(part_path, 'r+b') as file:
+                    if response.status != 206:
+                        raise DownloadError(f"server ignored the range request (HTTP {response.status})")
+                    file.seek(start)
+                    while received < end - start:
+                        data = response.read(min(1 << 20, end - start - received))
+                        if not data:
+                            break
+                        file.write(data)
+                        received += len(data)
+                        task._add(len(data))
+                    file.flush()
+                    os.fsync(file.fileno())
+
+                if received == end - start:
+                    return
+                raise DownloadError(f"connection closed after {received} of {end - start} bytes")
+            except (OSError, http.client.HTTPException, DownloadError) as e:
+                # the bytes of a failed attempt are fetched again
+                task._add(-received)
+                if attempt >= self.retries:
+                    raise DownloadError(f"failed to fetch bytes {start}-{end - 1}: {e}")
+                time.sleep(min(2 ** attempt, 30))
+
+    def _open(self, url, headers=None):
+        return urllib.request.urlopen(self._request(url, headers=headers), timeout=self.timeout)
+
+    @staticmethod
+    def _read_journal(journal_path, part_path, size, sha256):
+        # only resume a download of exactly the same file
+        try:
+            with open(journal_path, 'r') as file:
+                journal = json.load(file)
+        except (OSError, ValueError):
+            return set()
+
+        if journal.get('size') != size or journal.get('sha256') != sha256 or not os.path.exists(part_path):
+            return set()
+        return set(journal.get('done', []))
+
+    @staticmethod
+    def _write_journal(journal_path, size, sha256, done):
+        temp_path = f"{journal_path}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump({'size': size, 'sha256': sha256, 'done': sorted(done)}, file)
+        os.replace(temp_path, journal_path)
+
+    @staticmethod
+    def get():
+        with ModelDownloader._lock:
+            if ModelDownloader._instance is None:
+                ModelDownloader._instance = ModelDownloader()
+
+            return ModelDownloader._instance
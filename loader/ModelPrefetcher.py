@@ -0,0 +1,48 @@
+# ./loader/ModelPrefetcher.py
+
+import os
+import threading
+
+
+PREFETCH_MODES = ('none', 'async', 'sync')
+
+
+def _read_through(file_path, chunk_size):
+    # reading the file once is the portable way to pull it into the page cache
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(file_path, 'rb', buffering=0) as file:
+        while file.readinto(view) > 0:
+            pass
+
+
+def prefetch_model_file(file_path, mode='async', chunk_size=8 * 1024 * 1024):
+    """
+    Warm up the page cache with a model file before llama.cpp maps it.
+
+    :param file_path: The path to the model file
+    :param mode: 'none' does nothing, 'sync' reads the whole file before returning, 'async' reads it in a background thread
+    :param chunk_size: The number of bytes read at once
+    :return: The background thread in 'async' mode, otherwise None
+    """
+    if mode not in PREFETCH_MODES:
+        raise ValueError(f"unknown prefetch mode: {mode}")
+
+    if mode == 'none' or not os.path.exists(file_path):
+        return None
+
+    # on Linux, let the kernel start its read-ahead right away
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    if mode == 'sync':
+        _read_through(file_path, chunk_size)
+        return None
+
+    thread = threading.Thread(target=_read_through, args=(file_path, chunk_size), daemon=True, name='model-prefetch')
+    thread.start()
+    return thread
@@ -0,0 +1,322 @@
+# ./loader/ModelRegistry.py
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+from util.ConfigLoader import ConfigLoader
+from util.Utilities import convert_path
+from loader.GGUFReader import summarize_gguf, GGUFError
+
+
+class ModelRegistry:
+    """
+    Index of the model files under `model_root`.
+
+    Every `.gguf` file is recorded with its size, SHA-256, GGUF header facts and last-used time
+    in `<model_root>/.registry.json`, so listing models never scans the disk. File contents are
+    kept once in `<model_root>/.blobs/<sha256>.gguf`; the files under `<hf_id>/<hf_file>` are
+    hardlinks to them, so a file pulled under several names takes its space only once. When
+    `quota_gb` is set, the least recently used models which are not loaded are deleted once
+    the files exceed it.
+
+    :param registry_config: the `registry` section of the configuration
+    """
+    INDEX_FILE = '.registry.json'
+    BLOB_DIR = '.blobs'
+    SKIPPED_DIRS = ('.blobs', '.kv_snapshots')
+
+    _lock = threading.Lock()
+    _instance = None
+
+    def __init__(self, model_root=None, registry_config=None):
+        config = ConfigLoader().get()
+        if model_root is None:
+            model_root = convert_path(config['model_root'])
+        if registry_config is None:
+            registry_config = config.get('registry', {})
+
+        self.model_root = model_root
+        self.quota_bytes = int(float(registry_config.get('quota_gb', 0)) * (1 << 30))
+        self.hash_existing = registry_config.get('hash_existing', True)
+        self.index_path = os.path.join(model_root, ModelRegistry.INDEX_FILE)
+        self.blob_dir = os.path.join(model_root, ModelRegistry.BLOB_DIR)
+
+        self._cond = threading.Condition()
+        self._entries = {}
+        self._in_use = {}
+        self._version = 0
+        self._scan_thread = None
+        self._load_index()
+
+    def _relative(self, file_path):
+        return os.path.relpath(os.path.abspath(file_path), os.path.abspath(self.model_root)).replace(os.sep, '/')
+
+    def _absolute(self, relative_path):
+        return os.path.join(self.model_root, *relative_path.split('/'))
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r') as file:
+                index = json.load(file)
+            self._entries = {entry['path']: entry for entry in index.get('models', [])}
+        except (OSError, ValueError, KeyError):
+            self._entries = {}
+
+    def _save_index(self):
+        # the caller holds `_cond`
+        os.makedirs(self.model_root, exist_ok=True)
+        temp_path = f"{self.index_path}.tmp-{os.getpid()}"
+        with open(temp_path, 'w') as file:
+            json.dump({'models': list(self._entries.values())}, file, indent=4)
+        os.replace(temp_path, self.index_path)
+        self._version += 1
+
+    def entries(self):
+        """
+        All indexed model files, answered from memory.
+        """
+        with self._cond:
+            return [dict(entry) for entry in self._entries.values()]
+
+    def entry(self, file_path):
+        with self._cond:
+            entry = self._entries.get(self._relative(file_path))
+            return dict(entry) if entry is not None else None
+
+    def version(self):
+        # changes whenever the index changes, callers use it to invalidate views built from `entries`
+        with self._cond:
+            return self._version
+
+    def find(self, sha256):
+        """
+        The path of an indexed file with the content `sha256`, or None.
+        """
+        if not sha256:
+            return None
+        with self._cond:
+            for entry in self._entries.values():
+                if entry.get('sha256') == sha256 and os.path.exists(self._absolute(entry['path'])):
+                    return self._absolute(entry['path'])
+        return None
+
+    def register(self, file_path, sha256=None, hash_content=True):
+        """
+        Index `file_path`, hashing it if `sha256` is not known, and share its content with identical files.
+        """
+        try:
+            gguf = summarize_gguf(file_path)
+        except (OSError, GGUFError) as e:
+            gguf = {'error': str(e)}
+
+        if sha256 is None and hash_content:
+            sha256 = ModelRegistry.hash_file(file_path)
+
+        relative_path = self._relative(file_path)
+        if sha256 is not None:
+            self._dedupe(file_path, sha256)
+        stat = os.stat(file_path)
+
+        with self._cond:
+            previous = self._entries.get(relative_path, {})
+            self._entries[relative_path] = {
+                'path': relative_path,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'sha256': sha256,
+                'gguf': gguf,
+                'added': previous.get('added', time.time()),
+                'last_used': previous.get('last_used'),
+            }
+            self._save_index()
+
+        self.enforce_quota()
+        return self.entry(file_path)
+
+    def _dedupe(self, file_path, sha256):
+        blob_path = os.path.join(self.blob_dir, f"{sha256}.gguf")
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+        try:
+            if not os.path.exists(blob_path):
+                os.link(file_path, blob_path)
+                return
+            if os.path.samefile(blob_path, file_path):
+                return
+
+            # replace the copy by a link to the blob, the rename makes it atomic for readers
+            temp_path = f"{file_path}.link-{os.getpid()}"
+            os.link(blob_path, temp_path)
+            os.replace(temp_path, file_path)
+            print(f"deduplicated {file_path} (same content as {blob_path})")
+        except OSError as e:
+            # e.g. filesystems without hardlinks, the file is kept as it is
+            print(f"can not deduplicate {file_path}: {e}")
+
+    def link(self, sha256, target_path):
+        """
+        Create `target_path` as a link to an indexed file with the content `sha256`, return True on success.
+        """
+        source_path = self.find(sha256)
+        if source_path is None:
+            return False
+
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        temp_path = f"{target_path}.link-{os.getpid()}"
+        try:
+            os.link(source_path, temp_path)
+            os.replace(temp_path, target_path)
+        except OSError:
+            return False
+
+        self.register(target_path, sha256=sha256)
+        return True
+
+    def touch(self, file_path):
+        relative_path = self._relative(file_path)
+        with self._cond:
+            entry = self._entries.get(relative_path)
+            if entry is None:
+                return
+            entry['last_used'] = time.time()
+            self._save_index()
+
+    def acquire(self, file_path):
+        """
+        Mark `file_path` as loaded, loaded files are never evicted.
+        """
+        relative_path = self._relative(file_path)
+        with self._cond:
+            self._in_use[relative_path] = self._in_use.get(relative_path, 0) + 1
+        self.touch(file_path)
+
+    def release(self, file_path):
+        relative_path = self._relative(file_path)
+        with self._cond:
+            count = self._in_use.get(relative_path, 0) - 1
+            if count > 0:
+                self._in_use[relative_path] = count
+            else:
+                self._in_use.pop(relative_path, None)
+
+    def disk_usage(self):
+        # hardlinked files take their space once
+        with self._cond:
+            return sum({entry.get('sha256') or entry['path']: entry['size'] for entry in self._entries.values()}.values())
+
+    def enforce_quota(self):
+        """
+        Delete the least recently used models which are not loaded until the files fit into `quota_gb`.
+        """
+        if not self.quota_bytes:
+            return []
+
+        evicted = []
+        while self.disk_usage() > self.quota_bytes:
+            with self._cond:
+                in_use = {self._entries[path].get('sha256') for path in self._in_use if path in self._entries}
+                candidates = [entry for entry in self._entries.values() if entry['path'] not in self._in_use and (entry.get('sha256') is None or entry['sha256'] not in in_use)]
+                if not candidates:
+                    print(f"model files exceed the quota of {self.quota_bytes / (1 << 30):.1f} GB but all of them are in use")
+                    break
+
+                victim = min(candidates, key=lambda entry: entry.get('last_used') or entry.get('added') or 0)
+                sha256 = victim.get('sha256')
+                # all names of the same content go together, otherwise no space is freed
+                paths = [path for path, entry in self._entries.items() if path == victim['path'] or (sha256 and entry.get('sha256') == sha256)]
+                for path in paths:
+                    del self._entries[path]
+                self._save_index()
+
+            for path in paths:
+                self._remove(self._absolute(path))
+            if sha256:
+                self._remove(os.path.join(self.blob_dir, f"{sha256}.gguf"))
+            print(f"evicted model files {', '.join(paths)} to stay within the disk quota")
+            evicted.extend(paths)
+
+        return evicted
+
+    @staticmethod
+    def _remove(file_path):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+    def scan(self):
+        """
+        Bring the index in line with the files under `model_root`.
+        """
+        found = set()
+        for directory, subdirectories, files in os.walk(self.model_root):
+            if os.path.abspath(directory) == os.path.abspath(self.model_root):
+                subdirectories[:] = [name for name in subdirectories if name not in ModelRegistry.SKIPPED_DIRS]
+
+            for name in files:
+                if not name.endswith('.gguf'):
+                    continue
+                file_path = os.path.join(directory, name)
+                relative_path = self._relative(file_path)
+                found.add(relative_path)
+
+                with self._cond:
+                    entry = self._entries.get(relative_path)
+                stat = os.stat(file_path)
+                if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime and (entry.get('sha256') or not self.hash_existing):
+                    continue
+
+                try:
+                    self.register(file_path, hash_content=self.hash_existing)
+                except OSError as e:
+                    print(f"failed to index {file_path}: {e}")
+
+        with self._cond:
+            missing = [path for path in self._entries if path not in found]
+            for path in missing:
+                del self._entries[path]
+            if missing:
+                self._save_index()
+
+        # blobs without any name left are leftovers of deleted models
+        with self._cond:
+            referenced = {entry.get('sha256') for entry in self._entries.values()}
+        if os.path.isdir(self.blob_dir):
+            for name in os.listdir(self.blob_dir):
+                if name.endswith('.gguf') and name[:-len('.gguf')] not in referenced:
+                    self._remove(os.path.join(self.blob_dir, name))
+
+        self.enforce_quota()
+
+    def scan_async(self):
+        # hashing multi-GB files takes a while, it runs in the background
+        with self._cond:
+            if self._scan_thread is not None and self._scan_thread.is_alive():
+                return self._scan_thread
+            self._scan_thread = threading.Thread(target=self.scan, daemon=True, name='model-registry-scan')
+            self._scan_thread.start()
+            return self._scan_thread
+
+    @staticmethod
+    def hash_file(file_path, block_size=8 * 1024 * 1024):
+        hasher = hashlib.sha256()
+        buffer = bytearray(block_size)
+        view = memoryview(buffer)
+        with open(file_path, 'rb', buffering=0) as file:
+            while True:
+                size = file.readinto(view)
+                if not size:
+                    break
+                hasher.update(view[:size])
+        return hasher.hexdigest()
+
+    @staticmethod
+    def get():
+        with ModelRegistry._lock:
+            if ModelRegistry._instance is None:
+                ModelRegistry._instance = ModelRegistry()
+
+            return ModelRegistry._instance
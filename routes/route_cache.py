@@ -0,0 +1,15 @@
+from fastapi import APIRouter
+
+from communicator.ResponseCache import ResponseCache
+
+router = APIRouter()
+
+@router.get("/cache")
+def cache_stats():
+    return ResponseCache.get().stats()
+
+@router.delete("/cache")
+def cache_clear():
+    cache = ResponseCache.get()
+    cache.clear()
+    return cache.stats()
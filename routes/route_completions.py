@@ -1,154 +1,267 @@
-import requests
 import time
-import json
-from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Request
+from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
 
 from util.ConfigLoader import ConfigLoader
+from util.Tracer import Tracer
 from communicator.LLMCommunicator import LLMCommunicator
+from communicator.RequestScheduler import SchedulerError
+from communicator.ContextWindow import ContextLengthError, InvalidRequestError
+from communicator.ServerReadiness import ServerReadiness
+from communicator.ModelCatalog import ModelCatalog
+from communicator.ResponseCache import ResponseCache
+from communicator.StreamPipeline import StreamPipeline, SSEAdapter
+from routes.route_models import model_not_found_response
 
 router = APIRouter()
 
 
-def complete_completions(messages, max_tokens, temperature, repeat_penalty, echo):
-    config = ConfigLoader().get()
-    model_config = config['model_config']
-    default_completion_config = model_config['default_completion_config']
-    debug_mode = config['debug_mode']
-    
-    llm = LLMCommunicator.get()
-    
-    text = llm.complete_messages(
-        messages, 
-        max_tokens=max_tokens,
-        temperature=temperature,
-        repeat_penalty=repeat_penalty,
-        echo=echo,
-        stream=False
+def scheduler_error_response(error):
+    headers = {}
+    if error.retry_after is not None:
+        headers['Retry-After'] = str(error.retry_after)
+
+    return JSONResponse(
+        status_code=error.status_code,
+        headers=headers,
+        content={
+            'error': {
+                'message': error.message,
+                'type': type(error).__name__,
+                'code': error.status_code
+            }
+        }
     )
-    
+
+
+def not_ready_response(readiness):
+    status = readiness.status()
+    headers = {} if readiness.is_failed() else {'Retry-After': str(readiness.retry_after)}
+
+    return JSONResponse(
+        status_code=503,
+        headers=headers,
+        content={
+            'error': {
+                'message': f"model {status['model']} failed to load" if readiness.is_failed() else f"model {status['model']} is still loading ({status['status']})",
+                'type': 'ServerNotReady',
+                'code': 503
+            },
+            'readiness': status
+        }
+    )
+
+
+def invalid_request_response(message, param=None, code=None):
+    return JSONResponse(
+        status_code=400,
+        content={
+            'error': {
+                'message': message,
+                'type': 'invalid_request_error',
+                'param': param,
+                'code': code
+            }
+        }
+    )
+
+
+def context_length_error_response(error):
+    return invalid_request_response(str(error), param='messages', code='context_length_exceeded')
+
+
+def completion_response(model_name, result):
     # Format the response in the same way as OpenAI's API
-    response = {
+    return {
         'id': '0',
         'object': 'chat.completion',
         'created': int(time.time()),
-        'model': f"{model_config['hf_id']} - {model_config['hf_file']}",
+        'model': model_name,
         'choices': [{
             # 'text': text,
             "message": {
-                "content": text,
+                "content": choice['text'].strip(),
                 "role": "assistant"
             },
-            'index': 0, 
+            'index': choice['index'], 
             'logprobs': None, 
-            'finish_reason': 'stop'
-        }]
+            'finish_reason': choice['finish_reason']
+        } for choice in result['choices']],
+        'usage': result['usage']
     }
-    return response
 
 
-def stream_completions(messages, max_tokens, temperature, repeat_penalty, echo):
-    config = ConfigLoader().get()
-    model_config = config['model_config']
-    default_completion_config = model_config['default_completion_config']
-    debug_mode = config['debug_mode']
+async def finish_trace(events, trace):
+    # a streamed response is only done once its last event is sent
+    try:
+        async for event in events:
+            yield event
+    finally:
+        trace.finish()
+
+
+def cached_response(model_name, result, stream, config, trace):
+    headers = {'X-Cache': 'HIT'}
+    trace.set('cache', 'hit')
+    if not stream:
+        return JSONResponse(content=completion_response(model_name, result), headers=headers)
     
-    stream_batch_size = config['stream_batch_size']
+    # a cached stream is replayed through the same pipeline as a live one
+    choice = result['choices'][0]
     
-    if debug_mode:
-        print(f"stream_batch_size \t = {stream_batch_size}")
+    async def replay():
+        yield {'choices': [{'text': choice['text'], 'index': 0, 'finish_reason': None}]}
+        yield {'choices': [{'text': '', 'index': 0, 'finish_reason': choice['finish_reason']}], 'usage': result['usage']}
     
-    llm = LLMCommunicator.get()
+    pipeline = StreamPipeline.from_config(config, frontend='http', trace=trace)
+    adapter = SSEAdapter(model_name)
+    return StreamingResponse(finish_trace(adapter.events(pipeline, replay()), trace), media_type="text/event-stream", headers=headers)
+
+
+async def complete_completions(messages, max_tokens, temperature, repeat_penalty, echo, sampling=None, stop=None, n=1, ticket=None, llm=None, cache_key=None, trace=None):
+    if llm is None:
+        llm = LLMCommunicator.get()
     
-    response_stream = llm.complete_messages(
+    result = await llm.acomplete_messages(
         messages, 
         max_tokens=max_tokens,
         temperature=temperature,
         repeat_penalty=repeat_penalty,
         echo=echo,
-        stream=True
+        stream=False,
+        ticket=ticket,
+        details=True,
+        sampling=sampling,
+        stop=stop,
+        n=n,
+        trace=trace
     )
     
-    def get_response_json(chunk_text, is_first=False, is_last=False):
-        chunk = {
-            'id': '0',
-            'object': 'chat.completion.chunk',
-            'created': int(time.time()),
-            'model': f"{model_config['hf_id']} - {model_config['hf_file']}",
-            'choices': [{
-                "delta": {
-                    "content": chunk_text
-                },
-                'index': 0, 
-                'logprobs': None
-            }],
-            'finish_reason': None
-        }
-        
-        if is_first:
-            chunk['choices'][0]['delta']['role'] = "assistant"
-            
-        if is_last:
-            chunk['finish_reason'] = "stop"
-        
-        chunk_json = json.dumps(chunk)
-        # print(f"!!! chunk_json = {chunk_json}")
-        
-        return f"data: {chunk_json}\n\n"
-
+    if cache_key is not None:
+        ResponseCache.get().store(cache_key, result)
     
-    def generate(batch_size=stream_batch_size):
-        # yield 'Hello '
-        # time.sleep(1)
-        # yield 'World '
-        # time.sleep(1)
-        # yield '!'
-        
-        prev_item = next(response_stream, None)  # Get the first item
-        bulk_text = ""
-        current_batch_size = 0
-        first_item = True
-        
-        for item in response_stream:
-            # option 1: directly yeild the current value
-            # yield get_response_json(prev_item['choices'][0]['text'])
-            
-            # option 2: yield values in bulk
-            bulk_text += prev_item['choices'][0]['text']
-            current_batch_size += 1
-            
-            if current_batch_size == batch_size:
-                if first_item:
-                    yield get_response_json(bulk_text, is_first=True)
-                    first_item = False
-                else:
-                    yield get_response_json(bulk_text)
-                    
-                bulk_text = ""
-                current_batch_size = 0
-            
-            prev_item = item
+    return JSONResponse(content=completion_response(llm.model_name, result))
+
 
-        # Handle the last item
-        if prev_item is not None:
-            # option 1: directly yeild the current value
-            # print(f"token[END] = {item['choices'][0]['text']}")
+async def stream_completions(messages, max_tokens, temperature, repeat_penalty, echo, sampling=None, stop=None, ticket=None, llm=None, cache_key=None, trace=None):
+    if llm is None:
+        llm = LLMCommunicator.get()
+    
+    # the ticket is only owned by the stream once `acomplete_messages` returned
+    try:
+        pipeline = StreamPipeline.from_config(llm.config, frontend='http', trace=trace)
+    except BaseException:
+        if ticket is not None:
+            ticket.release()
+        raise
+    
+    response_stream = await llm.acomplete_messages(
+        messages, 
+        max_tokens=max_tokens,
+        temperature=temperature,
+        repeat_penalty=repeat_penalty,
+        echo=echo,
+        stream=True,
+        ticket=ticket,
+        details=True,
+        sampling=sampling,
+        stop=stop,
+        trace=trace
+    )
+    
+    # fetch the first chunk before responding, so that errors (e.g. a too long prompt) still get their status code
+    try:
+        first_item = await response_stream.__anext__()
+    except StopAsyncIteration:
+        first_item = None
+    except BaseException:
+        await response_stream.aclose()
+        raise
+    
+    adapter = SSEAdapter(llm.model_name)
+    
+    async def generate():
+        try:
+            async for event in adapter.events(pipeline, response_stream, first=first_item):
+                yield event
             
-            # option 2: yield values in bulk
-            bulk_text += prev_item['choices'][0]['text']
-            yield get_response_json(bulk_text, is_last=True)
-        
-        yield f"data: [DONE]\n\n"
+            # only completions which ran to their end are cached
+            if cache_key is not None and pipeline.finish_reason is not None:
+                ResponseCache.get().store(cache_key, {
+                    'choices': [{'text': pipeline.text, 'index': 0, 'finish_reason': pipeline.finish_reason}],
+                    'usage': pipeline.usage
+                })
+        finally:
+            # release the model right away if the client went away in the middle of the stream
+            await response_stream.aclose()
+            if trace is not None:
+                trace.finish()
         
     return StreamingResponse(generate(), media_type="text/event-stream")
     
 
 @router.post("/chat/completions")
 async def completions(request: Request):
-    config = ConfigLoader().get()
+    trace = Tracer.get().start('http', traceparent=request.headers.get('traceparent'), request_id=request.headers.get('x-request-id'))
+    try:
+        response = await handle_completions(request, trace)
+    except BaseException as e:
+        trace.finish(error=f"{type(e).__name__}: {e}")
+        raise
+    
+    trace.set('http.status_code', response.status_code)
+    # a streamed response finishes its trace once the stream ends
+    if not isinstance(response, StreamingResponse):
+        trace.finish()
+    response.headers['X-Request-ID'] = trace.request_id
+    return response
+
+
+async def handle_completions(request, trace):
+    with trace.span('parse'):
+        data = await request.json()
+    
+    # requests arriving while the model warms up wait for it for a while, then get a 503
+    readiness = ServerReadiness.get()
+    if not readiness.is_ready() and not await readiness.wait_async(is_disconnected=request.is_disconnected):
+        return not_ready_response(readiness)
+    
+    # the OpenAI `model` field selects a model of the pool by the name of its `llm_config`
+    model_name = data.get('model')
+    routing_config = ConfigLoader().get().get('model_routing', {})
+    if model_name and not ModelCatalog.get().exists(model_name):
+        if routing_config.get('unknown_model', 'default') != 'default':
+            return model_not_found_response(model_name)
+        model_name = None
+    
+    pool = LLMCommunicator.pool()
+    if not pool.is_resident(model_name) and not routing_config.get('lazy_load', True):
+        return JSONResponse(
+            status_code=409,
+            content={
+                'error': {
+                    'message': f"The model `{pool.resolve(model_name)}` is not loaded, load it with \"/load {pool.resolve(model_name)}\" first",
+                    'type': 'invalid_request_error',
+                    'param': 'model',
+                    'code': 'model_not_loaded'
+                }
+            }
+        )
+    with trace.span('model_lookup'):
+        llm = await run_in_threadpool(pool.get_model, model_name, True)
+    
+    # the model stays resident until the request holds a ticket of its scheduler (or gives up)
+    try:
+        return await complete_with_model(request, data, llm, trace)
+    finally:
+        pool.unpin(llm)
+
+
+async def complete_with_model(request, data, llm, trace):
+    config = llm.config
     model_config = config['model_config']
     default_completion_config = model_config['default_completion_config']
-    debug_mode = config['debug_mode']
     
     default_max_tokens = default_completion_config['max_tokens']
     default_temperature = default_completion_config['temperature']
@@ -156,44 +269,107 @@ async def completions(request: Request):
     default_echo = default_completion_config['echo']
     default_top_p = default_completion_config['top_p']
     
-    data = await request.json()
     messages = data.get('messages', [])
     max_tokens = data.get('max_tokens', default_max_tokens)
     temperature = data.get('temperature', default_temperature)
-    top_p = data.get('top_p', default_top_p)
+    repeat_penalty = data.get('repeat_penalty', default_repeat_penalty)
+    echo = data.get('echo', default_echo)
+    stop = data.get('stop')
+    n = data.get('n', 1)
     stream_mode = data.get('stream', False)
+    try:
+        priority = int(request.headers.get('x-request-priority', 0))
+    except ValueError:
+        return invalid_request_response('x-request-priority must be an integer', param='x-request-priority')
     
-    if debug_mode:
-        print(f"=== ===  === ===  === ===\t\tCOMPLETE\t\t=== ===  === ===  === ===")
-        print(f"max_tokens \t\t = {max_tokens}")
-        print(f"temperature \t\t = {temperature}")
-        print(f"top_p \t\t\t = {top_p}")
-        print(f"default_repeat_penalty \t = {default_repeat_penalty}")
-        print(f"default_echo \t\t = {default_echo}")
-        print(f"stream_mode \t\t = {stream_mode}")
+    # the values of the request, then the ones of the model, then the llama.cpp defaults
+    sampling = {
+        'top_p': data.get('top_p', default_top_p),
+        'top_k': data.get('top_k', default_completion_config.get('top_k', 40)),
+        'min_p': data.get('min_p', default_completion_config.get('min_p', 0.05)),
+        'presence_penalty': data.get('presence_penalty', default_completion_config.get('presence_penalty', 0.0)),
+        'frequency_penalty': data.get('frequency_penalty', default_completion_config.get('frequency_penalty', 0.0)),
+        'seed': data.get('seed', default_completion_config.get('seed')),
+    }
+    
+    if trace.sampled:
+        trace.set('llm.model', llm.model_name)
+        trace.set('llm.max_tokens', max_tokens)
+        trace.set('llm.temperature', temperature)
+        trace.set('llm.repeat_penalty', repeat_penalty)
+        trace.set('llm.echo', echo)
+        trace.set('llm.n', n)
+        trace.set('llm.stream', stream_mode)
+        trace.set('llm.priority', priority)
     
     if not messages:
-        return jsonify({'error': 'No messages provided'}), 400
+        return invalid_request_response('No messages provided', param='messages')
+    if not isinstance(n, int) or n < 1:
+        return invalid_request_response('n must be a positive integer', param='n')
+    if stream_mode and n != 1:
+        return invalid_request_response('n must be 1 for streamed completions', param='n')
+    if stop is not None and not isinstance(stop, (str, list)):
+        return invalid_request_response('stop must be a string or a list of strings', param='stop')
+    if sampling['seed'] is not None and not isinstance(sampling['seed'], int):
+        return invalid_request_response('seed must be an integer', param='seed')
     
-    llm = LLMCommunicator.get()
+    # deterministic requests seen before are answered without the model
+    cache = ResponseCache.get()
+    cache_key = None
+    if cache.enabled and ResponseCache.is_deterministic(temperature):
+        cache_key = ResponseCache.key(model_config, messages, {
+            'max_tokens': max_tokens,
+            'temperature': temperature,
+            'repeat_penalty': repeat_penalty,
+            'echo': echo,
+            'sampling': sampling,
+            'stop': stop,
+            'n': n,
+        })
+        cached = cache.lookup(cache_key) if 'no-cache' not in request.headers.get('cache-control', '') else None
+        if cached is not None:
+            return cached_response(llm.model_name, cached, stream_mode, config, trace)
     
-    if stream_mode:
-        res = stream_completions(
-            messages, 
-            max_tokens=max_tokens,
-            temperature=temperature,
-            repeat_penalty=default_repeat_penalty,
-            echo=default_echo
-        )
-
-        return res
-    else:
-        res = complete_completions(
-            messages, 
-            max_tokens=max_tokens,
-            temperature=temperature,
-            repeat_penalty=default_repeat_penalty,
-            echo=default_echo
-        )
-
-        return res
+    # wait for a free slot in the queue, give up if the client goes away meanwhile
+    try:
+        ticket = llm.scheduler.submit(priority=priority, frontend='http')
+        await ticket.wait_async(is_disconnected=request.is_disconnected)
+    except SchedulerError as e:
+        return scheduler_error_response(e)
+    
+    try:
+        if stream_mode:
+            return await stream_completions(
+                messages, 
+                max_tokens=max_tokens,
+                temperature=temperature,
+                repeat_penalty=repeat_penalty,
+                echo=echo,
+                sampling=sampling,
+                stop=stop,
+                ticket=ticket,
+                llm=llm,
+                cache_key=cache_key,
+                trace=trace
+            )
+        else:
+            return await complete_completions(
+                messages, 
+                max_tokens=max_tokens,
+                temperature=temperature,
+                repeat_penalty=repeat_penalty,
+                echo=echo,
+                sampling=sampling,
+                stop=stop,
+                n=n,
+                ticket=ticket,
+                llm=llm,
+                cache_key=cache_key,
+                trace=trace
+            )
+    except ContextLengthError as e:
+        return context_length_error_response(e)
+    except InvalidRequestError as e:
+        return invalid_request_response(str(e))
+    except SchedulerError as e:
+        return scheduler_error_response(e)
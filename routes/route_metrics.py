@@ -0,0 +1,56 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from util.Metrics import Metrics
+from communicator.LLMCommunicator import LLMCommunicator
+from communicator.ResponseCache import ResponseCache
+
+router = APIRouter()
+
+
+def collect_server_metrics():
+    # the queues and caches keep their own counters, they are only read when scraped
+    queue = []
+    running = []
+    requests = []
+    prefix_hits = []
+    prefix_misses = []
+    prefix_size = []
+    for model_name, instance in LLMCommunicator.pool().instances().items():
+        labels = {'model': model_name}
+        scheduler_stats = instance.scheduler.stats()
+        queue.append((labels, scheduler_stats['queued']))
+        running.append((labels, scheduler_stats['running']))
+        for outcome in ('admitted', 'completed', 'rejected', 'expired', 'cancelled'):
+            requests.append(({'model': model_name, 'outcome': outcome}, scheduler_stats[outcome]))
+
+        prefix_cache = getattr(instance, 'prefix_cache', None)
+        if prefix_cache is not None:
+            prefix_stats = prefix_cache.stats()
+            prefix_hits.append((labels, prefix_stats['hits']))
+            prefix_misses.append((labels, prefix_stats['misses']))
+            prefix_size.append((labels, prefix_stats['size_bytes']))
+
+    cache_stats = ResponseCache.get().stats()
+    return [
+        ('llm_queued_requests', 'gauge', 'Requests waiting for admission to their model.', queue),
+        ('llm_running_requests', 'gauge', 'Requests admitted to their model.', running),
+        ('llm_requests_total', 'counter', 'Requests by outcome of the admission queue.', requests),
+        ('llm_prefix_cache_hits_total', 'counter', 'Prompts which continued from a cached prefix.', prefix_hits),
+        ('llm_prefix_cache_misses_total', 'counter', 'Prompts evaluated from the start.', prefix_misses),
+        ('llm_prefix_cache_bytes', 'gauge', 'Size of the cached prefix states.', prefix_size),
+        ('llm_response_cache_lookups_total', 'counter', 'Response cache lookups by result.', [
+            ({'result': 'hit'}, cache_stats['hits']),
+            ({'result': 'disk_hit'}, cache_stats['disk_hits']),
+            ({'result': 'miss'}, cache_stats['misses']),
+        ]),
+        ('llm_response_cache_entries', 'gauge', 'Responses held in memory by the response cache.', [({}, cache_stats['entries'])]),
+    ]
+
+
+Metrics.get().add_collector(collect_server_metrics)
+
+
+@router.get("/metrics")
+def metrics():
+    return PlainTextResponse(Metrics.get().render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,37 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from communicator.LLMCommunicator import LLMCommunicator
+from communicator.ModelCatalog import ModelCatalog
+
+router = APIRouter()
+
+
+def model_not_found_response(model_name):
+    return JSONResponse(
+        status_code=404,
+        content={
+            'error': {
+                'message': f"The model `{model_name}` does not exist, available models are listed at /models",
+                'type': 'invalid_request_error',
+                'param': 'model',
+                'code': 'model_not_found'
+            }
+        }
+    )
+
+
+@router.get("/models")
+def models():
+    resident = LLMCommunicator.pool().resident()
+    return {
+        'object': 'list',
+        'data': ModelCatalog.get().models(resident=resident)
+    }
+
+@router.get("/models/{model_name}")
+def model(model_name: str):
+    model = ModelCatalog.get().model(model_name, resident=LLMCommunicator.pool().resident())
+    if model is None:
+        return model_not_found_response(model_name)
+    return model
@@ -0,0 +1,42 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+
+from loader.HFLoader import pull_model
+from loader.ModelDownloader import ModelDownloader
+
+router = APIRouter()
+
+@router.post("/pull")
+async def pull(request: Request):
+    # same as the Chatbot command "/pull {hf_id}/{hf_file} as {model} from {base_model}"
+    data = await request.json()
+    hf_id = data.get('hf_id')
+    hf_file = data.get('hf_file')
+    model_name = data.get('model')
+    base_model_name = data.get('base_model')
+    
+    if not hf_id or not hf_file or not model_name or not base_model_name:
+        return JSONResponse(status_code=400, content={'error': 'hf_id, hf_file, model and base_model are required'})
+    
+    try:
+        task = await run_in_threadpool(pull_model, hf_id, hf_file, model_name, base_model_name)
+    except FileNotFoundError as e:
+        return JSONResponse(status_code=404, content={'error': str(e)})
+    
+    if task is None:
+        return {'model': model_name, 'state': 'done'}
+    
+    # the download runs in the background, its progress is available at `/pull/{id}`
+    return JSONResponse(status_code=202, content={'model': model_name, **task.progress()})
+
+@router.get("/pull")
+def pull_tasks():
+    return {'data': ModelDownloader.get().tasks()}
+
+@router.get("/pull/{task_id}")
+def pull_task(task_id: str):
+    task = ModelDownloader.get().task(task_id)
+    if task is None:
+        return JSONResponse(status_code=404, content={'error': f"unknown download {task_id}"})
+    return task.progress()
@@ -0,0 +1,17 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from communicator.ServerReadiness import ServerReadiness
+
+router = APIRouter()
+
+@router.get("/ready")
+def ready():
+    # `/hi` answers as soon as the server runs, `/ready` only once the default model can serve requests
+    readiness = ServerReadiness.get()
+    status = readiness.status()
+    if status['ready']:
+        return status
+
+    headers = {} if readiness.is_failed() else {'Retry-After': str(readiness.retry_after)}
+    return JSONResponse(status_code=503, headers=headers, content=status)
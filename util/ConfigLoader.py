@@ -1,6 +1,7 @@
 # /util/ConfigLoader.py
 
 import os
+import copy
 import json
 import yaml
 from collections import OrderedDict
@@ -51,6 +52,31 @@ class _ConfigLoader:
     def get(self):
         return self._config
 
+    def set(self, config):
+        """
+        Replace the loaded configuration, e.g. with the one of a parent process.
+        """
+        self._config = config
+        return self
+
+    def get_model_config(self, name, path='./llm_config/'):
+        """
+        Build the configuration of another model without touching the loaded one.
+
+        The current configuration (including runtime overrides) is copied, its `model_config`
+        is reset to the defaults and the model configuration `name` is merged on top of it.
+        """
+        config = copy.deepcopy(self._config)
+        config['model_config'] = copy.deepcopy(_ConfigLoader().get()['model_config'])
+        
+        model_config = ConfigLoader.read_config(f"{name}.yaml", path=path)
+        if not model_config:
+            raise FileNotFoundError(f"model configuration {os.path.join(path, name)}.yaml does not exist")
+        
+        config = _ConfigLoader.deep_merge_dicts(config, json.loads(json.dumps(model_config)))
+        config['model'] = name
+        return config
+
 class ConfigLoader:
     _instance = None
     
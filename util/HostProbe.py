@@ -0,0 +1,156 @@
+import os
+import glob
+import time
+import hashlib
+import platform
+import subprocess
+
+from util.Utilities import detect_os
+
+
+def _read(path):
+    with open(path, 'r') as file:
+        return file.read().strip()
+
+
+def _parse_cpulist(cpulist):
+    # e.g. "0-3,8-11"
+    cpus = set()
+    for part in cpulist.split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def allowed_cpus():
+    """
+    The logical CPUs this process may run on (e.g. restricted by `taskset` or a container).
+    """
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def _core_id(cpu):
+    # SMT siblings share the core id within a package
+    topology = f"/sys/devices/system/cpu/cpu{cpu}/topology"
+    try:
+        return _read(f"{topology}/physical_package_id"), _read(f"{topology}/core_id")
+    except OSError:
+        return None
+
+
+def physical_cores(cpus=None):
+    """
+    The number of physical cores among `cpus` (all allowed CPUs by default), SMT siblings count once.
+    """
+    cpus = allowed_cpus() if cpus is None else cpus
+
+    if detect_os() == 'linux':
+        cores = {_core_id(cpu) for cpu in cpus}
+        if None not in cores:
+            return len(cores)
+    elif detect_os() == 'darwin' and len(cpus) == (os.cpu_count() or 0):
+        try:
+            return int(subprocess.check_output(['sysctl', '-n', 'hw.physicalcpu'], timeout=5).strip())
+        except (OSError, ValueError, subprocess.SubprocessError):
+            pass
+
+    # the topology is not known here, every logical CPU is taken as a core
+    return max(1, len(cpus))
+
+
+def numa_nodes():
+    """
+    The allowed logical CPUs of every NUMA node; a single node holding all of them when the layout is not known.
+    """
+    cpus = set(allowed_cpus())
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node*/cpulist')):
+        try:
+            node_cpus = _parse_cpulist(_read(path)) & cpus
+        except (OSError, ValueError):
+            continue
+        if node_cpus:
+            nodes.append(sorted(node_cpus))
+    return nodes or [sorted(cpus)]
+
+
+def total_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def memory_bandwidth(size_bytes=128 * 1024 * 1024, repeat=3):
+    """
+    Single-threaded copy bandwidth of the main memory in bytes per second (read + write).
+
+    The buffer is much larger than the CPU caches; the best of `repeat` copies is taken.
+    """
+    memory = total_memory()
+    if memory:
+        size_bytes = min(size_bytes, memory // 16)
+
+    source = bytearray(size_bytes)
+    target = bytearray(size_bytes)
+    # touch the pages once, page faults are not part of the bandwidth
+    target[:] = source
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        target[:] = source
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return 2 * size_bytes / best if best else None
+
+
+def cpu_model():
+    if detect_os() == 'linux':
+        try:
+            with open('/proc/cpuinfo', 'r') as file:
+                for line in file:
+                    if line.startswith('model name') or line.startswith('Model') or line.startswith('cpu model'):
+                        return line.split(':', 1)[1].strip()
+        except OSError:
+            pass
+    elif detect_os() == 'darwin':
+        try:
+            return subprocess.check_output(['sysctl', '-n', 'machdep.cpu.brand_string'], timeout=5).decode('utf-8').strip()
+        except (OSError, subprocess.SubprocessError):
+            pass
+    return platform.processor() or platform.machine()
+
+
+def probe_host():
+    """
+    The CPU and memory layout of this host, as far as the operating system tells it.
+    """
+    nodes = numa_nodes()
+    return {
+        'os': detect_os(),
+        'machine': platform.machine(),
+        'cpu_model': cpu_model(),
+        'logical_cpus': len(allowed_cpus()),
+        'physical_cores': physical_cores(),
+        'numa_nodes': len(nodes),
+        'cores_per_numa_node': [physical_cores(node) for node in nodes],
+        'total_memory': total_memory(),
+    }
+
+
+def host_fingerprint(host=None):
+    """
+    A stable hash of the parts of `probe_host()` which decide the best inference settings.
+    """
+    host = probe_host() if host is None else host
+    key = '|'.join(str(host.get(name)) for name in ('os', 'machine', 'cpu_model', 'logical_cpus', 'physical_cores', 'cores_per_numa_node', 'total_memory'))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
@@ -0,0 +1,238 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+INTER_TOKEN_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1, 2.5)
+TOKEN_BUCKETS = (1, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+RATE_BUCKETS = (0.5, 1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200, 500)
+LOCK_BUCKETS = (0.00001, 0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _CounterChild:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramChild:
+    def __init__(self, bounds):
+        self._lock = threading.Lock()
+        self._bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # one bisect and three additions, cheap enough for the token loop
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def _child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """
+        The time series of the label values, in the order of `labelnames`.
+        """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def _series(self):
+        with self._lock:
+            return [(tuple(zip(self.labelnames, values)), child) for values, child in self._children.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        for labels, child in self._series():
+            lines.extend(self._render_child(labels, child))
+        return lines
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def _child(self):
+        return _CounterChild()
+
+    def _render_child(self, labels, child):
+        return [f"{self.name}{_format_labels(labels)} {_format_value(child.value)}"]
+
+
+class Gauge(_Metric):
+    TYPE = 'gauge'
+
+    def _child(self):
+        return _GaugeChild()
+
+    def _render_child(self, labels, child):
+        return [f"{self.name}{_format_labels(labels)} {_format_value(child.value)}"]
+
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render_child(self, labels, child):
+        with child._lock:
+            counts = list(child.counts)
+            total = child.sum
+            count = child.count
+
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', _format_value(float(bound))),))} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Metrics:
+    """
+    The metrics of the server, rendered in the Prometheus text format by `/metrics`.
+
+    Recording a value is a dictionary lookup plus a short critical section, so it stays
+    enabled on the token loop. Values which already exist elsewhere (queue lengths, cache
+    statistics...) are read by collectors when the metrics are rendered instead.
+    """
+    _lock = threading.Lock()
+    _instance = None
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+        self.queue_wait = self.histogram('llm_queue_wait_seconds', 'Time a request waited for admission to its model.', ('model', 'frontend'))
+        self.prompt_eval = self.histogram('llm_prompt_eval_seconds', 'Time spent evaluating prompt tokens.', ('model', 'frontend'))
+        self.time_to_first_token = self.histogram('llm_time_to_first_token_seconds', 'Time from the start of a streamed completion to its first token.', ('model', 'frontend'))
+        self.inter_token = self.histogram('llm_inter_token_seconds', 'Time between two tokens of a streamed completion.', ('model', 'frontend'), buckets=INTER_TOKEN_BUCKETS)
+        self.tokens_per_second = self.histogram('llm_completion_tokens_per_second', 'Completion tokens generated per second.', ('model', 'frontend'), buckets=RATE_BUCKETS)
+        self.completion_duration = self.histogram('llm_completion_seconds', 'Duration of a completion, from admission to its last token.', ('model', 'frontend'))
+        self.prompt_tokens = self.histogram('llm_prompt_tokens', 'Prompt tokens per completion.', ('model', 'frontend'), buckets=TOKEN_BUCKETS)
+        self.completion_tokens = self.histogram('llm_completion_tokens', 'Completion tokens per completion.', ('model', 'frontend'), buckets=TOKEN_BUCKETS)
+        self.completions = self.counter('llm_completions_total', 'Completions by finish reason.', ('model', 'frontend', 'finish_reason'))
+        self.model_load = self.histogram('llm_model_load_seconds', 'Duration of the phases of loading a model.', ('model', 'phase'))
+        self.lock_wait = self.histogram('llm_lock_wait_seconds', 'Time spent waiting for a contended lock.', ('lock',), buckets=LOCK_BUCKETS)
+        self.lock_acquisitions = self.counter('llm_lock_acquisitions_total', 'Acquisitions of an instrumented lock.', ('lock',))
+        self.lock_contentions = self.counter('llm_lock_contentions_total', 'Acquisitions of an instrumented lock which had to wait.', ('lock',))
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, labelnames=()):
+        metric = Gauge(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets=buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        Add a callable invoked on every rendering, it returns a list of (name, type, documentation, [(labels, value)]).
+        """
+        self._collectors.append(collector)
+
+    @contextmanager
+    def timed_lock(self, lock, name):
+        """
+        Hold `lock`, recording how long acquiring it had to wait; the uncontended case is not timed.
+        """
+        self.lock_acquisitions.labels(name).inc()
+        if not lock.acquire(blocking=False):
+            start = time.perf_counter()
+            lock.acquire()
+            self.lock_wait.labels(name).observe(time.perf_counter() - start)
+            self.lock_contentions.labels(name).inc()
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                print(f"metrics collector failed: {e}")
+                continue
+            for name, metric_type, documentation, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(tuple(labels.items()))} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def get():
+        with Metrics._lock:
+            if Metrics._instance is None:
+                Metrics._instance = Metrics()
+
+            return Metrics._instance
@@ -0,0 +1,404 @@
+import os
+import json
+import time
+import queue
+import random
+import threading
+
+from util.ConfigLoader import ConfigLoader
+from util.Utilities import convert_path
+
+
+class Span:
+    """
+    A timed phase of a request. Times are `time.perf_counter()` seconds, `Trace` converts
+    them to wall-clock time when the trace is exported.
+    """
+    __slots__ = ('name', 'span_id', 'parent_id', 'start', 'end', 'attributes', 'events', 'error')
+
+    def __init__(self, name, parent_id=None, start=None, attributes=None):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start = start if start is not None else time.perf_counter()
+        self.end = None
+        self.attributes = attributes or {}
+        self.events = []
+        self.error = None
+
+    @property
+    def duration(self):
+        end = self.end if self.end is not None else time.perf_counter()
+        return end - self.start
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def event(self, name, **attributes):
+        self.events.append((name, time.perf_counter(), attributes))
+
+    def close(self, end=None):
+        if self.end is None:
+            self.end = end if end is not None else time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_value is not None:
+            self.error = f"{exc_type.__name__}: {exc_value}"
+        self.close()
+        return False
+
+
+class _NoopSpan:
+    """
+    The span of a trace which is not sampled, recording into it costs a method call.
+    """
+    __slots__ = ()
+
+    def set(self, key, value):
+        pass
+
+    def event(self, name, **attributes):
+        pass
+
+    def close(self, end=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """
+    The spans of one request, identified by its `request_id`.
+
+    A trace which is not `sampled` records nothing; it is still passed along so that the code
+    recording spans does not need to check. A trace sent to a worker process arrives without its
+    spans, the worker exports its own spans under the same trace id.
+    """
+    def __init__(self, tracer=None, frontend='', sampled=False, trace_id=None, parent_id=None, request_id=None):
+        self.frontend = frontend
+        self.sampled = sampled
+        self.trace_id = trace_id if trace_id is not None else os.urandom(16).hex()
+        self.request_id = request_id if request_id is not None else self.trace_id
+        self.spans = []
+        self.root = Span(frontend or 'request', parent_id=parent_id) if sampled else _NOOP_SPAN
+        self._tracer = tracer
+        self._finished = False
+        # perf_counter seconds to unix nanoseconds
+        self._offset_ns = time.time_ns() - int(time.perf_counter() * 1e9)
+
+    def span(self, name, **attributes):
+        """
+        Start a span, close it (or use it as a context manager) when the phase is over.
+        """
+        if not self.sampled or self._finished:
+            return _NOOP_SPAN
+        span = Span(name, parent_id=self.root.span_id, attributes=attributes)
+        self.spans.append(span)
+        return span
+
+    def add_span(self, name, start, end, **attributes):
+        """
+        Record a phase which has already been timed, `start` and `end` are `time.perf_counter()` seconds.
+        """
+        if not self.sampled or self._finished:
+            return _NOOP_SPAN
+        span = Span(name, parent_id=self.root.span_id, start=start, attributes=attributes)
+        span.close(end)
+        self.spans.append(span)
+        return span
+
+    def set(self, key, value):
+        self.root.set(key, value)
+
+    def unix_ns(self, seconds):
+        return self._offset_ns + int(seconds * 1e9)
+
+    def finish(self, error=None):
+        """
+        Close the trace and hand it to the sink, only the first call counts.
+        """
+        if self._finished:
+            return
+        self._finished = True
+        if not self.sampled:
+            return
+
+        if error is not None:
+            self.root.error = error
+        self.root.close()
+        tracer = self._tracer if self._tracer is not None else Tracer.get()
+        tracer.export(self)
+
+    def __getstate__(self):
+        # the spans recorded so far stay with the process which recorded them
+        state = dict(self.__dict__)
+        state['spans'] = []
+        state['_tracer'] = None
+        state['_finished'] = False
+        if self.sampled:
+            state['root'] = Span(f"{self.frontend or 'request'} worker", parent_id=self.root.span_id)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._offset_ns = time.time_ns() - int(time.perf_counter() * 1e9)
+        if self.sampled:
+            self.root.start = time.perf_counter()
+
+
+# the trace of work which is not traced, e.g. direct calls of `LLMCommunicator.complete_messages`
+UNTRACED = Trace()
+
+
+class ConsoleExporter:
+    """
+    One line per trace with the durations of its spans, followed by the attributes of the request.
+    """
+    def export(self, traces):
+        for trace in traces:
+            phases = " ".join(f"{span.name}={span.duration * 1000:.1f}ms" for span in trace.spans)
+            error = f" error={trace.root.error}" if trace.root.error else ""
+            print(f"[{trace.request_id}] {trace.frontend} {trace.root.duration * 1000:.1f}ms {phases}{error}")
+            for key, value in trace.root.attributes.items():
+                print(f"[{trace.request_id}]   {key} = {value}")
+
+    def close(self):
+        pass
+
+
+class JsonFileExporter:
+    """
+    One JSON object per trace and line.
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # line buffered, so that the lines of several worker processes do not interleave
+        self._file = open(path, 'a', encoding='utf-8', buffering=1)
+
+    @staticmethod
+    def _span(trace, span):
+        record = {
+            'name': span.name,
+            'start_ms': round((span.start - trace.root.start) * 1000, 3),
+            'duration_ms': round(span.duration * 1000, 3),
+            'attributes': span.attributes,
+        }
+        if span.events:
+            record['events'] = [{'name': name, 'at_ms': round((at - trace.root.start) * 1000, 3), 'attributes': attributes} for name, at, attributes in span.events]
+        if span.error:
+            record['error'] = span.error
+        return record
+
+    def export(self, traces):
+        for trace in traces:
+            record = {
+                'request_id': trace.request_id,
+                'trace_id': trace.trace_id,
+                'frontend': trace.frontend,
+                'timestamp': trace.unix_ns(trace.root.start) / 1e9,
+                'duration_ms': round(trace.root.duration * 1000, 3),
+                'attributes': trace.root.attributes,
+                'spans': [JsonFileExporter._span(trace, span) for span in trace.spans],
+            }
+            if trace.root.error:
+                record['error'] = trace.root.error
+            self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class OtlpFileExporter(JsonFileExporter):
+    """
+    OTLP/JSON trace requests, one per line, as read by the `otlpjsonfile` receiver of the
+    OpenTelemetry Collector.
+    """
+    SERVICE_NAME = 'local-llm-server'
+
+    @staticmethod
+    def _value(value):
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': value if isinstance(value, str) else json.dumps(value, default=str)}
+
+    @staticmethod
+    def _attributes(attributes):
+        return [{'key': key, 'value': OtlpFileExporter._value(value)} for key, value in attributes.items() if value is not None]
+
+    @staticmethod
+    def _span(trace, span):
+        record = {
+            'traceId': trace.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': 2 if span is trace.root else 1,
+            'startTimeUnixNano': str(trace.unix_ns(span.start)),
+            'endTimeUnixNano': str(trace.unix_ns(span.end if span.end is not None else span.start)),
+            'attributes': OtlpFileExporter._attributes(span.attributes),
+            'events': [{
+                'timeUnixNano': str(trace.unix_ns(at)),
+                'name': name,
+                'attributes': OtlpFileExporter._attributes(attributes)
+            } for name, at, attributes in span.events],
+            'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+        }
+        if span.parent_id:
+            record['parentSpanId'] = span.parent_id
+        return record
+
+    def export(self, traces):
+        spans = []
+        for trace in traces:
+            trace.root.set('request.id', trace.request_id)
+            trace.root.set('llm.frontend', trace.frontend)
+            spans.append(OtlpFileExporter._span(trace, trace.root))
+            spans.extend(OtlpFileExporter._span(trace, span) for span in trace.spans)
+
+        request = {
+            'resourceSpans': [{
+                'resource': {'attributes': OtlpFileExporter._attributes({'service.name': OtlpFileExporter.SERVICE_NAME, 'process.pid': os.getpid()})},
+                'scopeSpans': [{'scope': {'name': 'lls'}, 'spans': spans}]
+            }]
+        }
+        self._file.write(json.dumps(request, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+
+class TraceSink:
+    """
+    Exports finished traces on a background thread, so requests never wait for console or
+    file I/O. When the queue is full, traces are dropped and counted instead.
+    """
+    def __init__(self, exporter, queue_size=1024, batch_size=64):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True, name='trace-sink')
+        self._thread.start()
+
+    def emit(self, trace):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            traces = [self._queue.get()]
+            while len(traces) < self.batch_size:
+                try:
+                    traces.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self.exporter.export(traces)
+            except Exception as e:
+                print(f"failed to export {len(traces)} traces: {e}")
+
+
+class Tracer:
+    """
+    Starts the traces of requests and exports the sampled ones.
+
+    A share of `sample_rate` requests is traced; a W3C `traceparent` of the caller decides
+    instead when it is given, and its trace id is kept. `exporter` selects where traces go:
+    `console`, `json` (JSON lines at `path`) or `otlp` (OTLP/JSON lines at `path`), the
+    default path is `<model_root>/.traces/traces.jsonl`.
+
+    :param tracing_config: the `tracing` section of the configuration
+    """
+    EXPORTERS = ('console', 'json', 'otlp')
+
+    _lock = threading.Lock()
+    _instance = None
+
+    def __init__(self, tracing_config=None):
+        config = ConfigLoader().get()
+        if tracing_config is None:
+            tracing_config = config.get('tracing', {})
+
+        self.enabled = tracing_config.get('enabled', False)
+        self.sample_rate = float(tracing_config.get('sample_rate', 0.0))
+        self.exporter_name = tracing_config.get('exporter', 'console')
+        self.path = convert_path(tracing_config.get('path') or f"{config['model_root']}/.traces/traces.jsonl")
+        self._sink = None
+
+        if self.exporter_name not in Tracer.EXPORTERS:
+            raise ValueError(f"unknown trace exporter: {self.exporter_name}")
+
+        if self.enabled:
+            self._sink = TraceSink(self._create_exporter(), queue_size=tracing_config.get('queue_size', 1024))
+
+    def _create_exporter(self):
+        if self.exporter_name == 'json':
+            return JsonFileExporter(self.path)
+        if self.exporter_name == 'otlp':
+            return OtlpFileExporter(self.path)
+        return ConsoleExporter()
+
+    @staticmethod
+    def _parse_traceparent(traceparent):
+        # version-traceid-parentid-flags, e.g. 00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01
+        parts = (traceparent or '').strip().split('-')
+        if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+            return None
+        try:
+            flags = int(parts[3], 16)
+            int(parts[1], 16)
+            int(parts[2], 16)
+        except ValueError:
+            return None
+        return parts[1], parts[2], bool(flags & 1)
+
+    def start(self, frontend, traceparent=None, request_id=None):
+        """
+        The trace of a new request of `frontend` (`http`, `gradio`, `cli`).
+        """
+        trace_id = parent_id = None
+        if request_id is not None and (len(request_id) > 128 or not request_id.isprintable()):
+            request_id = None
+        sampled = self.enabled and self.sample_rate > 0 and random.random() < self.sample_rate
+
+        parent = Tracer._parse_traceparent(traceparent) if traceparent else None
+        if parent is not None:
+            trace_id, parent_id, parent_sampled = parent
+            sampled = self.enabled and parent_sampled
+
+        return Trace(self, frontend=frontend, sampled=sampled, trace_id=trace_id, parent_id=parent_id, request_id=request_id)
+
+    def export(self, trace):
+        if self._sink is not None:
+            self._sink.emit(trace)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'sample_rate': self.sample_rate,
+            'exporter': self.exporter_name,
+            'dropped': self._sink.dropped if self._sink is not None else 0,
+        }
+
+    @staticmethod
+    def get():
+        with Tracer._lock:
+            if Tracer._instance is None:
+                Tracer._instance = Tracer()
+
+            return Tracer._instance
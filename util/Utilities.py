@@ -1,4 +1,5 @@
 import os
+import hashlib
 import platform
 
 def detect_os():
@@ -106,3 +107,21 @@ def load_file_content(file_path):
     else:
         return ""
 
+
+def file_fingerprint(file_path, sample_size=1024 * 1024):
+    """
+    Compute a fast fingerprint of a (multi-GB) file without reading all of it.
+    
+    :param file_path: The path to the file
+    :param sample_size: The number of bytes sampled at the beginning, the middle and the end of the file
+    :return: A sha256 hex digest over the file size and the sampled bytes
+    """
+    file_size = os.path.getsize(file_path)
+    digest = hashlib.sha256(str(file_size).encode('utf-8'))
+    
+    with open(file_path, 'rb') as file:
+        for offset in (0, max(0, file_size // 2 - sample_size // 2), max(0, file_size - sample_size)):
+            file.seek(offset)
+            digest.update(file.read(sample_size))
+            
+    return digest.hexdigest()